@@ -1,8 +1,22 @@
+import itertools
+import json
+import time
 from functools import wraps
 
-from back.datalake import DatalakeFactory, SizeLimitError
+from back.datalake import DatalakeFactory, QueryLimitError, SizeLimitError
+from back.jobs import enqueue
 from back.models import Database, Query
-from flask import Blueprint, g, jsonify, request
+from back.query_cache import query_cache
+from chat.sql_utils import RESULT_SAMPLE_SIZE, query_error, record_result
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    g,
+    jsonify,
+    request,
+    stream_with_context,
+)
 from middleware import database_middleware, user_middleware
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -15,16 +29,70 @@ api = Blueprint("ai_api", __name__)
 def run_query():
     """
     Run a query against the database
-    Return eg. {"rows":[{"count":"607"}],"count":1}
+    Return eg. {"rows":[{"count":"607"}],"count":1,"maskedColumns":[]}
+    The rows are streamed to the client batch by batch, an error after the
+    first batch is returned in an "error" key
+    If a queryId is given, the result is recorded on the saved query
+    With "cache": false, the query is run again even if its result is cached
     """
     sql_query = request.json.get("query")
-
+    query_id = request.json.get("queryId")
+
+    saved_query = None
+    if query_id:
+        saved_query = (
+            g.session.query(Query)
+            .filter_by(id=query_id, databaseId=request.json.get("databaseId"))
+            .first()
+        )
+        if not saved_query:
+            return jsonify({"message": "Query not found"}), 404
+
+    start = time.monotonic()
     try:
-        rows, count = g.datalake.query(sql_query)
-        return jsonify({"rows": rows, "count": count})
+        stream = g.datalake.stream(sql_query, cache=request.json.get("cache", True))
+        batches = iter(stream)
+        # Fetch the first batch now, so errors are returned with a 500
+        first_batch = next(batches, None)
+    except QueryLimitError as e:
+        error = query_error(e)
+        return jsonify({"message": error.pop("error"), **error}), 400
     except Exception as e:
         return jsonify({"message": str(e)}), 500
 
+    def generate():
+        yield '{"rows": ['
+        separator = ""
+        sample = []
+        try:
+            for batch in itertools.chain([first_batch] if first_batch else [], batches):
+                for row in batch.rows():
+                    if len(sample) < RESULT_SAMPLE_SIZE:
+                        sample.append(row)
+                    yield separator + current_app.json.dumps(row)
+                    separator = ","
+        except Exception as e:
+            # The 200 is already sent: the document ends with the error, eg.
+            # {"rows": [...], "error": {"error": "...", "code": "max_rows", ...}}
+            yield '], "error": ' + json.dumps(query_error(e)) + "}"
+            return
+        count = g.datalake.result_count(stream)
+        yield '], "count": ' + json.dumps(count)
+        yield ', "maskedColumns": ' + json.dumps(stream.masked_columns) + "}"
+
+        if saved_query:
+            record_result(saved_query, stream, sample, count, time.monotonic() - start)
+            g.session.commit()
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+@api.route("/query/_cache", methods=["GET"])
+@user_middleware
+def query_cache_stats():
+    """Return the hit / miss counters and the size of the query cache"""
+    return jsonify(query_cache.stats())
+
 
 @api.route("/query", methods=["POST"])
 @user_middleware
@@ -44,6 +112,9 @@ def create_query():
 
     g.session.add(new_query)
     g.session.commit()
+    if new_query.query:
+        # The embedding, used to find similar questions, is computed in background
+        enqueue(g.session, "embed_queries", new_query.databaseId)
 
     response = {
         "id": new_query.id,
@@ -72,15 +143,28 @@ def handle_query_by_id(query_id):
     if request.method == "PUT":
         updated_visualisationParams = request.json.get("visualisationParams")
         query.visualisationParams = updated_visualisationParams
-        query.query = request.json.get("query")
-        query.sql = request.json.get("sql")
+        question = request.json.get("query")
+        question_changed = question != query.query
+        if question_changed:
+            query.embedding = None
+        query.query = question
+        sql = request.json.get("sql")
+        if sql != query.sql:
+            # The saved result is from the previous SQL
+            query.result = None
+            query.tables = None
+        query.sql = sql
         g.session.commit()
+        if question_changed and question:
+            enqueue(g.session, "embed_queries", databaseId)
 
     response = {
         "databaseId": databaseId,
         "visualisationParams": query.visualisationParams,
         "query": query.query,
         "sql": query.sql,
+        "result": query.result,
+        "tables": query.tables,
     }
 
     if request.method == "PUT":
@@ -28,6 +28,14 @@ def create_app():
         if hasattr(g, "session"):
             g.session.close()
 
+    from back.jobs import JOB_RUNNER, job_runner
+
+    @app.before_request
+    def start_job_runner():
+        # Started by the server only, not by the CLI commands (flask chat, ...)
+        if JOB_RUNNER:
+            job_runner.start()
+
     socketio.init_app(app)
 
     return app
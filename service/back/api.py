@@ -1,11 +1,15 @@
-from back.datalake import DatalakeFactory, ConnectionError
+from back.datalake import ConnectionError, DatalakeFactory, DatalakeRegistry
 from back.models import (
     Conversation,
     ConversationMessage,
     Database,
+    Job,
     Project,
     ProjectTables,
 )
+from back.jobs import JOB_HANDLERS, JOB_STATUS, enqueue, latest_jobs, retry
+from back.metadata import SCHEMA_PAGE_SIZE, get_table, list_tables
+from back.query_cache import query_cache
 from flask import Blueprint, g, jsonify, request
 from middleware import user_middleware
 from sqlalchemy import and_, or_
@@ -14,11 +18,10 @@ api = Blueprint("back_api", __name__)
 
 import dataclasses
 import json
-import os
 from datetime import datetime
 from typing import List, Union
 
-AUTOCHAT_PROVIDER = os.getenv("AUTOCHAT_PROVIDER", "openai")
+MESSAGE_PAGE_SIZE = 50
 
 
 def dataclass_to_dict(obj: Union[object, List[object]]) -> Union[dict, List[dict]]:
@@ -54,14 +57,25 @@ def get_conversations():
     return jsonify(conversations)
 
 
+def fetch_messages(session, conversation_id, before=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Return the last messages of a conversation (before a message id if given),
+    oldest first, and whether there are older messages
+    """
+    query = session.query(ConversationMessage).filter(
+        ConversationMessage.conversationId == conversation_id
+    )
+    if before is not None:
+        query = query.filter(ConversationMessage.id < before)
+    messages = query.order_by(ConversationMessage.id.desc()).limit(limit + 1).all()
+    return messages[:limit][::-1], len(messages) > limit
+
+
 @api.route("/conversations/<int:conversation_id>", methods=["GET", "PUT"])
 @user_middleware
 def get_conversation(conversation_id):
     conversation = (
-        g.session.query(Conversation)
-        .join(ConversationMessage, Conversation.messages, isouter=True)
-        .filter(Conversation.id == conversation_id)
-        .one()
+        g.session.query(Conversation).filter(Conversation.id == conversation_id).one()
     )
 
     if request.method == "PUT":
@@ -69,13 +83,25 @@ def get_conversation(conversation_id):
         conversation.name = request.json["name"]
         g.session.commit()
 
-    # TODO: redesign this to use a single query
+    # Only the last messages, the older ones are paged with /messages
+    limit = request.args.get("limit", MESSAGE_PAGE_SIZE, type=int)
+    messages, has_more = fetch_messages(g.session, conversation_id, limit=limit)
     conversation_dict = dataclass_to_dict(conversation)
-    conversation_dict["messages"] = dataclass_to_dict(conversation.messages)
-    conversation_dict["messages"].sort(key=lambda x: x["id"])
+    conversation_dict["messages"] = dataclass_to_dict(messages)
+    conversation_dict["hasMoreMessages"] = has_more
     return jsonify(conversation_dict)
 
 
+@api.route("/conversations/<int:conversation_id>/messages", methods=["GET"])
+@user_middleware
+def get_conversation_messages(conversation_id):
+    """Page the messages of a conversation, from the most recent"""
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", MESSAGE_PAGE_SIZE, type=int)
+    messages, has_more = fetch_messages(g.session, conversation_id, before, limit)
+    return jsonify({"messages": dataclass_to_dict(messages), "hasMore": has_more})
+
+
 @api.route("/conversations/<int:conversation_id>", methods=["DELETE"])
 @user_middleware
 def delete_conversation(conversation_id):
@@ -114,12 +140,20 @@ def create_database():
         safe_mode=request.json["safe_mode"],
         dbt_catalog=request.json["dbt_catalog"],
         dbt_manifest=request.json["dbt_manifest"],
+        max_result_size=request.json.get("max_result_size"),
+        statement_timeout=request.json.get("statement_timeout"),
+        max_rows=request.json.get("max_rows"),
+        max_scanned_bytes=request.json.get("max_scanned_bytes"),
     )
 
-    database.tables_metadata = datalake.load_metadata()
+    datalake.dispose()
 
     g.session.add(database)
     g.session.commit()
+    # The tables are read in background, see GET /databases/<id>/jobs
+    enqueue(g.session, "load_metadata", database.id, {"full": True})
+    if database.dbt_catalog:
+        enqueue(g.session, "parse_dbt", database.id)
     return jsonify(database)
 
 
@@ -129,6 +163,15 @@ def delete_database(database_id):
     # Delete database
     g.session.query(Database).filter_by(id=database_id).delete()
     g.session.commit()
+    DatalakeRegistry.invalidate(database_id)
+    return jsonify({"success": True})
+
+
+@api.route("/databases/<int:database_id>/cache", methods=["DELETE"])
+@user_middleware
+def clear_database_cache(database_id):
+    # Forget the cached query results, eg. after the data was updated
+    query_cache.invalidate(database_id)
     return jsonify({"success": True})
 
 
@@ -141,32 +184,111 @@ def update_database(database_id):
     database.description = request.json["description"]
 
     # If the engine info has changed, we need to check the connection
-    datalake = DatalakeFactory.create(
-        request.json["engine"],
-        **request.json["details"],
-    )
-    if (
+    connection_changed = (
         database.engine != request.json["engine"]
         or database.details != request.json["details"]
-        or database.name != request.json["name"]
-    ):
+    )
+    if connection_changed:
         try:
-            datalake.test_connection()
+            datalake = DatalakeFactory.create(
+                request.json["engine"],
+                **request.json["details"],
+            )
+            try:
+                datalake.test_connection()
+            finally:
+                datalake.dispose()
         except Exception as e:
             return jsonify({"message": str(e.args[0])}), 400
+    dbt_changed = (
+        database.dbt_catalog != request.json["dbt_catalog"]
+        or database.dbt_manifest != request.json["dbt_manifest"]
+    )
 
-    database.tables_metadata = datalake.load_metadata()
     database._engine = request.json["engine"]
     database.details = request.json["details"]
     database.privacy_mode = request.json["privacy_mode"]
     database.safe_mode = request.json["safe_mode"]
     database.dbt_catalog = request.json["dbt_catalog"]
     database.dbt_manifest = request.json["dbt_manifest"]
+    if dbt_changed:
+        # Parsed again by the parse_dbt job
+        database.dbt_parsed = None
+    for setting in (
+        "max_result_size",
+        "statement_timeout",
+        "max_rows",
+        "max_scanned_bytes",
+    ):
+        if setting in request.json:
+            setattr(database, setting, request.json[setting])
 
     g.session.commit()
+    if connection_changed:
+        # Shared datalakes of this database are now outdated
+        DatalakeRegistry.invalidate(database_id)
+        enqueue(g.session, "load_metadata", database_id, {"full": True})
+    if dbt_changed and database.dbt_catalog:
+        enqueue(g.session, "parse_dbt", database_id)
     return jsonify(database)
 
 
+@api.route("/databases/<int:database_id>/metadata/refresh", methods=["POST"])
+@user_middleware
+def refresh_database_metadata(database_id):
+    # Read the tables again, eg. after a migration of the database
+    database = g.session.query(Database).filter_by(id=database_id).first()
+    if not database:
+        return jsonify({"error": "Database not found"}), 404
+    full = bool((request.get_json(silent=True) or {}).get("full"))
+    job = enqueue(g.session, "load_metadata", database_id, {"full": full})
+    return jsonify(job), 202
+
+
+@api.route("/databases/<int:database_id>/jobs", methods=["GET"])
+@user_middleware
+def get_database_jobs(database_id):
+    jobs = (
+        g.session.query(Job)
+        .filter_by(databaseId=database_id)
+        .order_by(Job.id.desc())
+        .limit(int(request.args.get("limit", 20)))
+        .all()
+    )
+    return jsonify(jobs)
+
+
+@api.route("/databases/<int:database_id>/jobs", methods=["POST"])
+@user_middleware
+def create_database_job(database_id):
+    # eg. {"kind": "embed_queries"}, see back.jobs.JOB_HANDLERS
+    kind = request.json.get("kind")
+    if kind not in JOB_HANDLERS:
+        return jsonify({"error": f"Unknown job kind: {kind}"}), 400
+    job = enqueue(g.session, kind, database_id, request.json.get("payload"))
+    return jsonify(job), 202
+
+
+@api.route("/jobs/<int:job_id>", methods=["GET"])
+@user_middleware
+def get_job(job_id):
+    job = g.session.query(Job).filter_by(id=job_id).first()
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@api.route("/jobs/<int:job_id>/retry", methods=["POST"])
+@user_middleware
+def retry_job(job_id):
+    job = g.session.query(Job).filter_by(id=job_id).first()
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job.status != JOB_STATUS.FAILED:
+        return jsonify({"error": "Only failed jobs can be retried"}), 400
+    return jsonify(retry(g.session, job)), 202
+
+
 @api.route("/databases", methods=["GET"])
 @user_middleware
 def get_databases():
@@ -183,76 +305,28 @@ def get_databases():
         # )
         .all()
     )
-    return jsonify(databases)
+    # The state of the background jobs, see back.jobs
+    jobs = latest_jobs(g.session, [database.id for database in databases])
+    return jsonify(
+        [
+            {**dataclasses.asdict(database), "jobs": jobs[database.id]}
+            for database in databases
+        ]
+    )
 
 
 @api.route("/contexts/<string:context_id>/questions", methods=["GET"])
 @user_middleware
 def get_questions(context_id):
-    # context is "project-{projectId}" or "database-{databaseId}"
-    if context_id.startswith("project-"):
-        project_id = int(context_id.split("-")[1])
-        project = g.session.query(Project).filter_by(id=project_id).first()
-        database = g.session.query(Database).filter_by(id=project.databaseId).first()
-    elif context_id.startswith(
-        "database-"
-    ):  # Note: will be removed once we have context / project
-        database_id = int(context_id.split("-")[1])
-        database = g.session.query(Database).filter_by(id=database_id).first()
-
-    # If project, filter database.tables_metadata with project.tables
-    tables_metadata = database.tables_metadata
-
-    if context_id.startswith("project-"):
-        tables_metadata = [
-            # if any (name match tableName and schema match schemaName) in project.tables
-            table_metadata
-            for table_metadata in tables_metadata
-            if any(
-                table_metadata["name"] == project_table.tableName
-                and table_metadata["schema"] == project_table.schemaName
-                for project_table in project.tables
-            )
-        ]
-        context = (
-            "# Project Name: "
-            + project.name
-            + "\n# Database Name: "
-            + database.name
-            + "\n# Database Description: "
-            + database.description
-            + "\n# Tables: "
-            + str(tables_metadata)
-        )
-    else:
-        context = (
-            "# Name: "
-            + database.name
-            + "\n# Description: "
-            + database.description
-            + "\n# Tables: "
-            + str(tables_metadata)
-        )
-
-    from autochat import Autochat
+    from chat.questions import VERSION_COLUMNS, cached_questions, load_context
 
-    questionAssistant = Autochat(
-        provider=AUTOCHAT_PROVIDER, context=json.dumps(context)
-    )
-    # TODO: if exist ; add database.memory, dbt.catalog, dbt.manifest
+    database, project = load_context(g.session, context_id, VERSION_COLUMNS)
+    if database is None:
+        return jsonify({"error": "Context not found"}), 404
 
-    def questions(question1: str, question2: str, question3: str):
-        pass
-
-    questionAssistant.add_function(questions)
-
-    message = questionAssistant.ask(
-        "Generate 3 business questions about different topics that the user can ask based on the context (database schema, past conversations, etc)",
-        tool_choice={"type": "tool", "name": "questions"},  # anthropic specific
-    )
-    response_dict = message.function_call["arguments"]
-    response_values = list(response_dict.values())
-    return jsonify(response_values)
+    # Generated in background, [] until the first ones are ready
+    questions, _ = cached_questions(g.session, context_id, database, project)
+    return jsonify(questions)
 
 
 @api.route("/databases/<int:database_id>/schema", methods=["GET"])
@@ -263,7 +337,34 @@ def get_schema(database_id):
     if not database:
         return jsonify({"error": "Database not found"}), 404
 
-    return jsonify(database.tables_metadata)
+    if not request.args:
+        # The whole schema, as a single document
+        return jsonify(database.tables_metadata)
+
+    # A page of the tables, eg. ?schema=public&search=order&offset=100
+    return jsonify(
+        list_tables(
+            g.session,
+            database_id,
+            schema=request.args.get("schema"),
+            search=request.args.get("search"),
+            columns=request.args.get("columns", "true") == "true",
+            offset=int(request.args.get("offset", 0)),
+            limit=int(request.args.get("limit", SCHEMA_PAGE_SIZE)),
+        )
+    )
+
+
+@api.route(
+    "/databases/<int:database_id>/schema/<string:schema>/<string:table>",
+    methods=["GET"],
+)
+@user_middleware
+def get_schema_table(database_id, schema, table):
+    metadata = get_table(g.session, database_id, schema, table)
+    if not metadata:
+        return jsonify({"error": "Table not found"}), 404
+    return jsonify(metadata)
 
 
 # Get all projects of the user or it's organisation
@@ -307,6 +408,26 @@ def get_project(project_id):
     return jsonify(project_dict)
 
 
+@api.route("/projects/<int:project_id>/schema", methods=["GET"])
+@user_middleware
+def get_project_schema(project_id):
+    project = g.session.query(Project).filter_by(id=project_id).first()
+    if not project:
+        return jsonify({"error": "Project not found"}), 404
+    # Looked up in the catalog index, by (database, schema, table)
+    return jsonify(
+        list_tables(
+            g.session,
+            project.databaseId,
+            search=request.args.get("search"),
+            tables=[(table.schemaName, table.tableName) for table in project.tables],
+            columns=request.args.get("columns", "true") == "true",
+            offset=int(request.args.get("offset", 0)),
+            limit=int(request.args.get("limit", SCHEMA_PAGE_SIZE)),
+        )
+    )
+
+
 # Create, update, delete projects
 @api.route("/projects", methods=["POST"])
 @user_middleware
@@ -333,6 +454,13 @@ def create_project():
 
     g.session.add(new_project)
     g.session.commit()
+    # The starter questions are ready when the project is opened
+    enqueue(
+        g.session,
+        "generate_questions",
+        new_project.databaseId,
+        {"context_id": f"project-{new_project.id}"},
+    )
     return jsonify(new_project)
 
 
@@ -1,29 +1,137 @@
+import hashlib
+import itertools
 import json
-import re
-import sys
+import os
+import time
 from abc import ABC, abstractmethod, abstractproperty
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
 from typing import Tuple
 
 import sqlalchemy
-from sqlalchemy import text
+from back.privacy import HIDDEN_TEXT, MaskingPlan
+from back.query_cache import QUERY_CACHE_MAX_ENTRY_SIZE, query_cache
+from back.sql_parser import (
+    READ,
+    WRITE,
+    add_hint,
+    changes_limits,
+    classify,
+    is_read_only,
+    is_select,
+    normalize,
+    result_shape,
+    strip_end,
+)
+from sqlalchemy import bindparam, text
 
 MAX_SIZE = 2 * 1024 * 1024  # 2MB in bytes
-HIDDEN_TEXT = "*** HIDDEN ***"
-UNSAFE_KEYWORDS = ["DROP", "DELETE", "TRUNCATE", "ALTER", "INSERT", "UPDATE"]
-PRIVACY_KEYWORDS = [  # TODO: use AI to detect sensitive data
-    "name",
-    "first_name",
-    "last_name",
-    "full_name",
-    "first name",
-    "last name",
-    "full name",
-    "address",
-    "email",
-    "phone",
-    "password",
-    "secret",
-]
+METADATA_WORKERS = int(os.getenv("METADATA_WORKERS", 4))  # Schemas read at once
+SQLITE_PROGRESS_STEPS = 10000  # SQLite instructions between two timeout checks
+# Messages of the driver errors raised when the statement timeout is reached
+TIMEOUT_MESSAGES = (
+    "canceling statement due to statement timeout",  # postgresql
+    "maximum statement execution time exceeded",  # mysql
+    "statement reached its statement or warehouse timeout",  # snowflake
+)
+BATCH_SIZE = 1000  # Rows fetched at once from the drivers
+# Connection pool settings, shared by every datalake of the process
+POOL_SIZE = int(os.getenv("DATALAKE_POOL_SIZE", 5))
+POOL_MAX_OVERFLOW = int(os.getenv("DATALAKE_POOL_MAX_OVERFLOW", 10))
+POOL_RECYCLE = int(os.getenv("DATALAKE_POOL_RECYCLE", 1800))  # seconds
+IDLE_TIMEOUT = int(os.getenv("DATALAKE_IDLE_TIMEOUT", 900))  # seconds
+SIZE_ESTIMATOR = os.getenv("DATALAKE_SIZE_ESTIMATOR", "approx")  # "approx" or "json"
+# How to get the total number of rows of a result without running it twice:
+# - rowcount: reported by the driver once the query is executed
+# - window: add a COUNT(*) OVER () column to the query
+# - subquery: run SELECT COUNT(*) on the query, as a fallback
+COUNT_STRATEGIES = {
+    "snowflake": "rowcount",
+    "postgresql": "window",
+    "mysql": "window",
+    "sqlite": "window",
+}
+COUNT_COLUMN = "_ada_total_count"
+WINDOW_COUNT_TEMPLATE = (
+    "SELECT *, COUNT(*) OVER () AS " + COUNT_COLUMN + " FROM (\n{sql}\n) AS _result"
+)
+# The window count makes the database compute the whole result before the first
+# row: only used when the result can be truncated, ie. without a LIMIT under
+# one batch. MySQL may ignore the ORDER BY of a derived table, ordered queries
+# aren't wrapped.
+UNORDERED_SUBQUERIES = {"mysql"}
+# Errors caused by the wrapping of the query, it is then run as is
+# eg. a MySQL derived table can't have 2 columns with the same name
+WINDOW_COUNT_ERRORS = ("duplicate column name",)
+
+# Statements allowed by the safe mode besides the reads, eg. SET search_path
+# (unless they change the limits of the queries, see changes_limits)
+SAFE_KEYWORDS = {"SET"}
+
+# Tables of the database, with a version that changes when they are altered
+# (MySQL: a checksum of the columns and comment, as create_time isn't changed
+# by an ALTER TABLE ... ALGORITHM=INSTANT)
+TABLES_QUERIES = {
+    "postgresql": """
+        SELECT t.table_schema, t.table_name, t.table_type,
+            obj_description(c.oid, 'pg_class') AS description,
+            c.xmin::text AS version
+        FROM information_schema.tables t
+        JOIN pg_catalog.pg_namespace n ON n.nspname = t.table_schema
+        JOIN pg_catalog.pg_class c ON c.relnamespace = n.oid AND c.relname = t.table_name
+        WHERE t.table_schema NOT IN ('information_schema', 'pg_catalog')
+    """,
+    "mysql": """
+        SELECT t.table_schema, t.table_name, t.table_type,
+            t.table_comment AS description,
+            CONCAT_WS(':', t.create_time, CRC32(t.table_comment), c.checksum)
+                AS version
+        FROM information_schema.tables t
+        LEFT JOIN (
+            SELECT table_schema, table_name,
+                SUM(CRC32(CONCAT_WS('|', ordinal_position, column_name,
+                    column_type, is_nullable, column_comment))) AS checksum
+            FROM information_schema.columns
+            GROUP BY table_schema, table_name
+        ) c ON c.table_schema = t.table_schema AND c.table_name = t.table_name
+        WHERE t.table_schema NOT IN
+            ('information_schema', 'mysql', 'performance_schema', 'sys')
+    """,
+    "snowflake": """
+        SELECT table_schema, table_name, table_type, comment AS description,
+            TO_VARCHAR(last_ddl) AS version
+        FROM information_schema.tables
+        WHERE table_schema != 'INFORMATION_SCHEMA'
+    """,
+}
+# Columns of some tables of a schema, read in bulk
+COLUMNS_QUERIES = {
+    "postgresql": """
+        SELECT table_name, column_name, data_type, is_nullable,
+            col_description(
+                format('%I.%I', table_schema, table_name)::regclass,
+                ordinal_position
+            ) AS description
+        FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name IN :names
+        ORDER BY table_name, ordinal_position
+    """,
+    "mysql": """
+        SELECT table_name, column_name, column_type AS data_type, is_nullable,
+            column_comment AS description
+        FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name IN :names
+        ORDER BY table_name, ordinal_position
+    """,
+    "snowflake": """
+        SELECT table_name, column_name, data_type, is_nullable,
+            comment AS description
+        FROM information_schema.columns
+        WHERE table_schema = %s AND table_name IN ({names})
+        ORDER BY table_name, ordinal_position
+    """,
+}
 
 
 class SizeLimitError(Exception):
@@ -38,14 +146,407 @@ class ConnectionError(Exception):
     pass
 
 
-def sizeof(obj):
-    # This function returns the size of an object in bytes
-    return sys.getsizeof(obj)
+class QueryCancelledError(Exception):
+    code = "cancelled"
+
+
+class QueryLimitError(Exception):
+    """A query exceeded one of the limits set on the database"""
+
+    code = "limit"
+
+    def __init__(self, message, limit=None):
+        super().__init__(message)
+        self.limit = limit
+
+
+class StatementTimeoutError(QueryLimitError):
+    code = "statement_timeout"
+
+
+class ScanLimitError(QueryLimitError):
+    code = "max_scanned_bytes"
+
+
+class SizeEstimator(ABC):
+    """
+    Estimate the size of the rows of a result once serialized in JSON
+    (as they are sent to the client and to the LLM), including the values.
+    """
+
+    def row_sizes(self, batch):
+        # Every row repeats the column names: {"column": value, ...}
+        overhead = sum(len(column) + 6 for column in batch.columns)
+        sizes = [overhead] * len(batch)
+        for values in batch.values:
+            for index, value in enumerate(values):
+                sizes[index] += self.value_size(value)
+        return sizes
+
+    @abstractmethod
+    def value_size(self, value):
+        pass
+
+
+class JSONSizeEstimator(SizeEstimator):
+    """Exact but slower, serialize every value"""
+
+    def value_size(self, value):
+        return len(json.dumps(value, default=str))
+
+
+class ApproxSizeEstimator(SizeEstimator):
+    """Estimate the serialized size from the type of the values"""
+
+    def value_size(self, value):
+        if value is None:
+            return 4
+        if isinstance(value, str):
+            if value.isascii():
+                return len(value) + 2
+            return len(json.dumps(value))
+        if isinstance(value, (bool, int, float)):
+            return len(str(value))
+        if isinstance(value, (dict, list)):
+            return len(json.dumps(value, default=str))
+        # Dates, decimals, uuids, ... are serialized as strings
+        return len(str(value)) + 2
+
+
+SIZE_ESTIMATORS = {
+    "json": JSONSizeEstimator,
+    "approx": ApproxSizeEstimator,
+}
+
+
+def strip_sql(sql, dialect=None):
+    """Remove the trailing semicolons and comments, to use the query as a subquery"""
+    return strip_end(sql, dialect)
+
+
+class ResultBatch:
+    """
+    A slice of a query result, stored by column.
+    Column names are shared by all the batches of a result.
+    """
+
+    def __init__(self, columns, values, total=None):
+        self.columns = columns
+        self.values = values  # One list of values per column
+        self.total = total  # Total rows of the result, if known by the driver
+
+    @classmethod
+    def from_rows(cls, columns, rows, total=None):
+        if rows:
+            values = [list(column) for column in zip(*rows)]
+        else:
+            values = [[] for _ in columns]
+        return cls(columns, values, total)
+
+    def __len__(self):
+        return len(self.values[0]) if self.values else 0
+
+    def head(self, n):
+        return ResultBatch(self.columns, [column[:n] for column in self.values])
+
+    def rows(self):
+        for row in zip(*self.values):
+            yield dict(zip(self.columns, row))
+
+
+class Execution:
+    """
+    Handle on the query run by a QueryStream, to cancel it from another thread
+    (eg. when the chat turn is stopped). While the query runs, the datalake
+    attaches the function cancelling it on the server.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout  # Statement timeout in seconds, applied by the datalake
+        self.cancelled = False
+        self.timed_out = False  # Set by the datalakes enforcing the timeout
+        self._cancel = None
+        self._lock = Lock()
+
+    def attach(self, cancel):
+        with self._lock:
+            if self.cancelled:
+                raise QueryCancelledError("Query cancelled")
+            self._cancel = cancel
+
+    def detach(self):
+        # Wait for a running cancel, the connection can then be reused
+        with self._lock:
+            self._cancel = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._cancel is not None:
+                self._cancel()
+
+
+class QueryStream:
+    """
+    Iterate over a query result by ResultBatch, so a large result is never
+    fully materialized. The size limit and the privacy mode are applied
+    batch by batch.
+    Once iterated, `count` is the number of rows read, `size` their estimated
+    size in bytes and `truncated` tells whether the result was cut at
+    `max_size` or at `max_rows`. `total` is the number of rows of the whole
+    result, when the count strategy could get it in the same pass. With the
+    privacy mode, `masked_columns` lists the columns where data was hidden.
+    The modes and limits are the ones of the datalake when the stream is
+    created, they don't change while the query runs.
+    With a `cache_key`, the result is read from / saved to the query cache.
+    `cancel` stops the query on the server, the iteration then raises
+    QueryCancelledError.
+    With `max_scanned_bytes`, read queries whose scan is estimated larger are
+    refused with a ScanLimitError, before they are run.
+    """
+
+    def __init__(
+        self,
+        datalake,
+        sql,
+        batch_size=BATCH_SIZE,
+        privacy_mode=False,
+        count_strategy=None,
+        cache_key=None,
+        writes=False,
+        max_rows=None,
+        max_scanned_bytes=None,
+        max_size=MAX_SIZE,
+        statement_timeout=None,
+    ):
+        self.datalake = datalake
+        self.sql = sql
+        self.batch_size = batch_size
+        self.privacy_mode = privacy_mode
+        self.count_strategy = count_strategy
+        self.cache_key = cache_key
+        self.writes = writes  # The query changes the data, invalidate the cache
+        self.max_rows = max_rows
+        self.max_scanned_bytes = max_scanned_bytes
+        self.max_size = max_size
+        self.statement_timeout = statement_timeout
+        self.columns = []
+        self.count = 0
+        self.size = 0
+        self.truncated = False
+        self.total = None
+        self.masking = None
+        self.masked_columns = []
+        self.cached = False
+        self.execution = Execution(statement_timeout)
+
+    def cancel(self):
+        self.execution.cancel()
+
+    def __iter__(self):
+        if self.cache_key:
+            entry = query_cache.get(self.cache_key)
+            if entry is not None:
+                yield from self._replay(entry)
+                return
+
+        batches = [] if self.cache_key else None  # Kept to fill the cache
+        try:
+            for batch in self._read():
+                if batches is not None:
+                    batches.append(batch)
+                    if self.size > QUERY_CACHE_MAX_ENTRY_SIZE:
+                        # Too large to be cached, don't keep the result in memory
+                        batches = None
+                yield batch
+        finally:
+            if self.writes:
+                query_cache.invalidate(self.datalake.database_id)
+
+        if batches is not None:
+            query_cache.set(
+                self.cache_key,
+                self._cache_entry(batches),
+                self.datalake.database_id,
+                size=self.size,
+            )
+
+    def _cache_entry(self, batches):
+        return {
+            "columns": self.columns,
+            "values": [
+                list(itertools.chain.from_iterable(b.values[i] for b in batches))
+                for i in range(len(self.columns))
+            ],
+            "count": self.count,
+            "size": self.size,
+            "truncated": self.truncated,
+            "total": self.total,
+            "masked_columns": self.masked_columns,
+        }
+
+    def _replay(self, entry):
+        self.cached = True
+        self.columns = entry["columns"]
+        self.count = entry["count"]
+        self.size = entry["size"]
+        self.truncated = entry["truncated"]
+        self.total = entry["total"]
+        self.masked_columns = entry["masked_columns"]
+        if self.count:
+            yield ResultBatch(self.columns, entry["values"])
+
+    def _batches(self):
+        dialect = self.datalake.dialect
+        if self.max_scanned_bytes and is_read_only(self.sql, dialect):
+            self.datalake.check_scanned_bytes(self.sql, self.max_scanned_bytes)
+
+        if self._window_count(dialect):
+            # Ask the total count as an extra column of the result
+            sql = WINDOW_COUNT_TEMPLATE.format(sql=strip_sql(self.sql, dialect))
+            try:
+                batches = self.datalake._stream(
+                    sql, self.batch_size, self.execution, self._read_limit
+                )
+                first_batch = next(batches, None)
+            except Exception as e:
+                if not self._wrapping_error(e):
+                    raise
+                # The query can't be wrapped, run as is
+            else:
+                if first_batch is None:
+                    self.total = 0
+                    return
+                for batch in itertools.chain([first_batch], batches):
+                    batch.columns = batch.columns[:-1]
+                    self.total = batch.values.pop()[0]
+                    yield batch
+                return
+
+        for batch in self.datalake._stream(
+            self.sql, self.batch_size, self.execution, self._read_limit
+        ):
+            if self.count_strategy == "rowcount" and batch.total is not None:
+                self.total = batch.total
+            yield batch
+
+    @property
+    def _read_limit(self):
+        # One more row than max_rows, to know if the result is truncated
+        return self.max_rows + 1 if self.max_rows is not None else None
+
+    def _window_count(self, dialect):
+        if self.count_strategy != "window" or not is_select(self.sql, dialect):
+            return False
+        ordered, limit = result_shape(self.sql, dialect)
+        if limit is not None and limit <= self.batch_size:
+            # Read in a single batch, can only be truncated by the size limit
+            return False
+        return not (ordered and dialect in UNORDERED_SUBQUERIES)
+
+    def _wrapping_error(self, error):
+        """Whether the error comes from the wrapping, not from the query"""
+        if self.execution.cancelled or self.execution.timed_out:
+            return False
+        if self.datalake.is_timeout(error):
+            return False
+        message = str(error).lower()
+        return any(wrap_error in message for wrap_error in WINDOW_COUNT_ERRORS)
+
+    def _read(self):
+        try:
+            yield from self._limit(self._batches())
+        except (QueryCancelledError, QueryLimitError):
+            raise
+        except Exception as e:
+            if self.execution.cancelled:
+                # eg. "canceling statement due to user request"
+                raise QueryCancelledError("Query cancelled") from e
+            if self.execution.timed_out or self.datalake.is_timeout(e):
+                timeout = self.statement_timeout
+                raise StatementTimeoutError(
+                    f"Query stopped after the statement timeout of {timeout} seconds",
+                    timeout,
+                ) from e
+            raise
+
+    def _limit(self, batches):
+        max_size = self.max_size
+        estimator = self.datalake.size_estimator
+        for batch in batches:
+            if self.execution.cancelled:
+                # The driver can't cancel the query, stop reading it
+                raise QueryCancelledError("Query cancelled")
+            self.columns = batch.columns
+            if self.max_rows is not None and self.count + len(batch) > self.max_rows:
+                self.truncated = True
+                batch = batch.head(self.max_rows - self.count)
+            for index, row_size in enumerate(estimator.row_sizes(batch)):
+                if self.size + row_size > max_size:
+                    self.truncated = True
+                    batch = batch.head(index)
+                    break
+                self.size += row_size
+
+            if self.privacy_mode:
+                if self.masking is None:
+                    self.masking = MaskingPlan.build(batch)
+                self.masking.apply(batch)
+                self.masked_columns = self.masking.masked_columns
+            self.count += len(batch)
+            if len(batch):
+                yield batch
+            if self.truncated:
+                return
+
+
+def fetch_rows(fetchmany, batch_size, max_rows=None):
+    """Rows of a cursor by batches, up to max_rows rows"""
+    remaining = max_rows
+    while remaining is None or remaining > 0:
+        rows = fetchmany(
+            batch_size if remaining is None else min(batch_size, remaining)
+        )
+        if not rows:
+            return
+        if remaining is not None:
+            remaining -= len(rows)
+        yield rows
+
+
+def table_metadata(schema, name, table_type, description, version):
+    return {
+        "schema": schema,
+        "name": name,
+        "description": description or None,
+        "is_view": "VIEW" in (table_type or "").upper(),
+        "version": version,
+        "columns": [],
+    }
+
+
+def column_metadata(name, data_type, nullable, description):
+    if isinstance(nullable, str):
+        # information_schema.columns.is_nullable is "YES" or "NO"
+        nullable = nullable.upper() == "YES"
+    return {
+        "name": name,
+        "type": data_type,
+        "nullable": nullable,
+        "description": description or None,
+    }
 
 
 class AbstractDatabase(ABC):
     safe_mode = False
     privacy_mode = False  # Remove name / address / email / phone number / password
+    max_size = MAX_SIZE  # Maximum size of a result, in bytes
+    # Limits of the queries, applied by the drivers (None for no limit)
+    statement_timeout = None  # seconds
+    max_rows = None
+    max_scanned_bytes = None  # Estimated before the query is run
+    size_estimator = SIZE_ESTIMATORS[SIZE_ESTIMATOR]()
+    database_id = None  # Set by DatalakeRegistry, enables the query cache
 
     @abstractmethod
     def __init__(self):
@@ -56,73 +557,206 @@ class AbstractDatabase(ABC):
         pass
 
     @abstractmethod
-    def load_metadata(self):
+    def _list_tables(self):
+        """Tables of the database, see table_metadata, without their columns"""
         pass
 
     @abstractmethod
-    def _query(self, query):
+    def _read_columns(self, schema, tables):
+        """Fill the columns of some tables of a schema"""
         pass
 
+    def load_metadata(self, previous=None, progress=None):
+        """
+        Describe the tables of the database, eg.
+        [{"schema": "public", "name": "users", "description": None,
+          "is_view": False, "version": "1234", "columns": [...]}]
+        Given the previous metadata, only the tables whose version changed
+        (their DDL) are read again. The schemas are read in parallel, and
+        progress(done, total) is called as their tables are read.
+        """
+        known = {
+            (table["schema"], table["name"]): table
+            for table in previous or []
+            if table.get("version") is not None
+        }
+        tables = self._list_tables()
+        metadata, changed = [], defaultdict(list)
+        for table in tables:
+            previous_table = known.get((table["schema"], table["name"]))
+            if previous_table and previous_table["version"] == table["version"]:
+                metadata.append(previous_table)
+            else:
+                changed[table["schema"]].append(table)
+
+        if progress:
+            progress(len(metadata), len(tables))
+        with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+            futures = [
+                executor.submit(self._read_columns, schema, schema_tables)
+                for schema, schema_tables in changed.items()
+            ]
+            for future in as_completed(futures):
+                metadata.extend(future.result())
+                if progress:
+                    progress(len(metadata), len(tables))
+
+        metadata.sort(key=lambda table: (table["schema"], table["name"]))
+        self.metadata = metadata
+        return metadata
+
+    @abstractmethod
+    def _stream(self, query, batch_size, execution=None, max_rows=None):
+        """
+        Run a query and yield its result by ResultBatch, of max_rows rows at most
+        While the query runs, the function cancelling it is attached to the
+        execution
+        """
+        pass
+
+    def estimate_scanned_bytes(self, sql):
+        """Bytes the query would read, as estimated by the planner (if supported)"""
+        return None
+
+    def check_scanned_bytes(self, sql, max_scanned_bytes):
+        try:
+            estimate = self.estimate_scanned_bytes(sql)
+        except Exception:
+            # eg. multiple statements can't be explained, the query will tell
+            return
+        if estimate is not None and estimate > max_scanned_bytes:
+            raise ScanLimitError(
+                f"Query would scan about {estimate} bytes, "
+                f"more than the limit of {max_scanned_bytes} bytes",
+                max_scanned_bytes,
+            )
+
+    def is_timeout(self, error):
+        """Whether a driver error was raised by the statement timeout"""
+        message = str(error).lower()
+        return any(timeout in message for timeout in TIMEOUT_MESSAGES)
+
+    @property
+    def count_strategy(self):
+        """How to count the rows of a truncated result, see COUNT_STRATEGIES"""
+        return COUNT_STRATEGIES.get(self.dialect, "subquery")
+
+    def _query(self, query):
+        """Run a query, without the safe and privacy modes"""
+        stream = QueryStream(
+            self,
+            query,
+            max_size=self.max_size,
+            statement_timeout=self.statement_timeout,
+        )
+        return [row for batch in stream for row in batch.rows()]
+
     def query_count(self, sql):
-        count_request = f"SELECT COUNT(*) FROM ({sql.replace(';', '')}) AS foo"
+        # Runs the query a second time: costly, result_count doesn't use it
+        count_request = (
+            f"SELECT COUNT(*) FROM (\n{strip_sql(sql, self.dialect)}\n) AS _result"
+        )
         result = self._query(count_request)
-        return result[0]["count"]
+        return next(iter(result[0].values()))
 
-    def query(self, sql):
+    def stream(self, sql, batch_size=BATCH_SIZE, cache=True):
+        """
+        Run a query and return a QueryStream over its result
+        The safe mode is checked before the query is sent
+        With cache=False, the query is run even if its result is cached
+        """
+        statements = classify(sql, self.dialect)
+        # Other statements (DO, VACUUM, ...) may also change the data
+        writes = any(statement.kind != READ for statement in statements)
         if self.safe_mode:
-            # Forbid DROP, DELETE, TRUNCATE, etc. queries
-            # If keyword is in query, raise ValueError
-            for keyword in UNSAFE_KEYWORDS:
-                if keyword + " " in sql.upper():
-                    raise UnsafeQueryError(
-                        f"Query contains forbidden keyword {keyword}"
-                    )
+            # Only reads (SELECT, SHOW, EXPLAIN, ...) and SET are allowed
+            for statement in statements:
+                if statement.kind == READ or statement.keyword in SAFE_KEYWORDS:
+                    continue
+                if statement.kind == WRITE and statement.keyword is None:
+                    raise UnsafeQueryError("Query has unterminated or ambiguous quotes")
+                raise UnsafeQueryError(
+                    f"Query contains forbidden keyword {statement.keyword}"
+                )
+            if changes_limits(sql, self.dialect):
+                raise UnsafeQueryError("Query changes the statement timeout")
 
-        rows = self._query(sql)
-        if sum([sizeof(r) for r in rows]) > MAX_SIZE * 0.9:
-            try:
-                count = self.query_count(sql)
-            except Exception:
-                # TODO: should throw error
-                count = None
-        else:
-            count = len(rows)
-
-        if self.privacy_mode:
-            # Hide sensitive data from the result
-            # 1. Use column names to detect sensitive data
-            for row in rows:
-                for key in PRIVACY_KEYWORDS:
-                    if key in row:
-                        row[key] = HIDDEN_TEXT
-            # 2. Use text patterns to detect sensitive data (regex email, phone, etc.)
-            EMAIL_REGEX = r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+"
-            PHONE_REGEX = r"""^(?:(?:\+|00)33|0)\s*[1-9](?:[\s.-]*\d{2}){4}$"""
-            for row in rows:
-                for key, value in row.items():
-                    if isinstance(value, str):
-                        # Regex email
-                        value = re.sub(EMAIL_REGEX, HIDDEN_TEXT, value)
-                        # Regex phone
-                        value = re.sub(PHONE_REGEX, HIDDEN_TEXT, value)
-                        row[key] = value
-
-        return rows, count
+        cacheable = self.database_id is not None and query_cache.enabled
+        return QueryStream(
+            self,
+            sql,
+            batch_size,
+            privacy_mode=self.privacy_mode,
+            count_strategy=self.count_strategy,
+            cache_key=self.cache_key(sql)
+            if cache and cacheable and is_read_only(sql, self.dialect)
+            else None,
+            writes=cacheable and writes,
+            max_rows=self.max_rows,
+            max_scanned_bytes=self.max_scanned_bytes,
+            # The settings may change during the query, see DatalakeRegistry.get
+            max_size=self.max_size,
+            statement_timeout=self.statement_timeout,
+        )
+
+    def cache_key(self, sql):
+        return query_cache.key(
+            self.database_id,
+            normalize(sql, self.dialect),
+            privacy_mode=self.privacy_mode,
+            safe_mode=self.safe_mode,
+            max_size=self.max_size,
+            max_rows=self.max_rows,
+        )
+
+    def result_count(self, stream):
+        """
+        Total number of rows of an iterated stream, None when it is unknown:
+        the result is truncated and the total wasn't read with the rows (eg.
+        MySQL ordered queries). The query isn't run again to count them
+        """
+        if not stream.truncated:
+            return stream.count
+        return stream.total
+
+    def query(self, sql, on_stop=None):
+        """
+        Run a query and return its rows and total count
+        on_stop(callback) registers the cancellation of the query, eg. when
+        the chat turn is stopped, and returns a function removing it
+        """
+        stream = self.stream(sql)
+        remove = on_stop(stream.cancel) if on_stop else None
+        try:
+            rows = [row for batch in stream for row in batch.rows()]
+        finally:
+            if remove:
+                remove()
+        return rows, self.result_count(stream)
 
     def test_connection(self):
         # Test connection by running a query
         self.query("SELECT 1;")
 
+    def dispose(self):
+        # Release the connections held by the datalake
+        pass
+
 
 class SQLDatabase(AbstractDatabase):
-    def __init__(self, uri):
+    def __init__(self, uri, **engine_options):
         try:
-            self.engine = sqlalchemy.create_engine(uri)
-            self.inspector = sqlalchemy.inspect(self.engine)
+            self.engine = sqlalchemy.create_engine(uri, **engine_options)
             self.metadata = []
         except sqlalchemy.exc.OperationalError as e:
             raise ConnectionError(e)
 
+    @property
+    def inspector(self):
+        # Created on demand: inspecting opens a connection, and a fresh
+        # inspector avoids serving stale reflection cache on long-lived engines
+        return sqlalchemy.inspect(self.engine)
+
     def dispose(self):
         # On destruct, close the engine
         self.engine.dispose()
@@ -132,56 +766,163 @@ class SQLDatabase(AbstractDatabase):
         # "postgresql", "mysql", "sqlite", "mssql"
         return self.engine.name
 
-    def load_metadata(self):
-        for schema in self.inspector.get_schema_names():
+    def _fetch(self, query, **params):
+        with self.engine.connect() as connection:
+            statement = text(query)
+            if "names" in params:
+                statement = statement.bindparams(bindparam("names", expanding=True))
+            return connection.execute(statement, params).fetchall()
+
+    def _list_tables(self):
+        if self.dialect in TABLES_QUERIES:
+            return [
+                table_metadata(schema, name, table_type, description, version)
+                for schema, name, table_type, description, version in self._fetch(
+                    TABLES_QUERIES[self.dialect]
+                )
+            ]
+
+        # No information_schema, eg. SQLite
+        versions = {}
+        if self.dialect == "sqlite":
+            # The DDL of the tables is stored as is
+            for name, sql in self._fetch(
+                "SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'view')"
+            ):
+                versions[name] = hashlib.md5((sql or "").encode()).hexdigest()
+        inspector = self.inspector
+        tables = []
+        for schema in inspector.get_schema_names():
             if schema == "information_schema":
                 continue
-            for table in self.inspector.get_table_names(schema=schema):
-                columns = []
-                for column in self.inspector.get_columns(table, schema):
-                    columns.append(
-                        {
-                            "name": column["name"],
-                            "type": str(column["type"]),
-                            "nullable": column["nullable"],
-                            "description": column.get("comment"),
-                        }
-                    )
+            for name in inspector.get_table_names(schema=schema):
+                tables.append(
+                    table_metadata(schema, name, "TABLE", None, versions.get(name))
+                )
+            for name in inspector.get_view_names(schema=schema):
+                tables.append(
+                    table_metadata(schema, name, "VIEW", None, versions.get(name))
+                )
+        return tables
 
-                self.metadata.append(
-                    {
-                        "name": table,
-                        "description": None,  # TODO
-                        "schema": schema,
-                        "is_view": False,
-                        "columns": columns,
-                    }
+    def _read_columns(self, schema, tables):
+        by_name = {table["name"]: table for table in tables}
+        if self.dialect in COLUMNS_QUERIES:
+            rows = self._fetch(
+                COLUMNS_QUERIES[self.dialect], schema=schema, names=list(by_name)
+            )
+            for table_name, name, data_type, is_nullable, description in rows:
+                by_name[table_name]["columns"].append(
+                    column_metadata(name, data_type, is_nullable, description)
                 )
+            return tables
 
-            # TODO add support for views
-        return self.metadata
+        inspector = self.inspector
+        for table in tables:
+            for column in inspector.get_columns(table["name"], schema):
+                table["columns"].append(
+                    column_metadata(
+                        column["name"],
+                        str(column["type"]),
+                        column["nullable"],
+                        column.get("comment"),
+                    )
+                )
+        return tables
 
-    def _query(self, query):
+    def _stream(self, query, batch_size, execution=None, max_rows=None):
+        execution = execution or Execution()
+        with self.engine.connect() as connection:
+            execution.attach(self._canceller(connection))
+            try:
+                self._set_timeout(connection, execution)
+                if is_select(query, self.dialect):
+                    # Only a single SELECT can use a server-side cursor
+                    # Fetch the rows by batches instead of buffering the whole result
+                    connection = connection.execution_options(
+                        stream_results=True,
+                        max_row_buffer=min(batch_size, max_rows or batch_size),
+                    )
+                    query = self._timeout_hint(query, execution.timeout)
+                result = connection.execute(text(query))
+                if not result.returns_rows:
+                    return
+
+                columns = list(result.keys())
+                for rows in fetch_rows(result.fetchmany, batch_size, max_rows):
+                    yield ResultBatch.from_rows(columns, rows)
+            finally:
+                if self.dialect == "sqlite":
+                    connection.connection.dbapi_connection.set_progress_handler(None, 0)
+                execution.detach()
+
+    def _set_timeout(self, connection, execution):
+        """Apply the statement timeout to the next queries of the connection"""
+        timeout = execution.timeout
+        if self.dialect == "postgresql" and timeout:
+            # Local to the transaction, reset when the connection is released
+            connection.execute(
+                text(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+            )
+        elif self.dialect == "sqlite" and timeout:
+            deadline = time.monotonic() + timeout
+
+            def check_deadline():
+                # A non-zero value interrupts the query
+                if time.monotonic() > deadline:
+                    execution.timed_out = True
+                    return 1
+                return 0
+
+            connection.connection.dbapi_connection.set_progress_handler(
+                check_deadline, SQLITE_PROGRESS_STEPS
+            )
+
+    def _timeout_hint(self, query, timeout):
         """
-        Run a query against the database
-        Limit the result to 2MB
+        MySQL: the statement timeout of a SELECT, as an optimizer hint so it
+        doesn't stay on the pooled connection like SET SESSION max_execution_time
         """
-        with self.engine.connect() as connection:
-            result = connection.execute(text(query))
+        if self.dialect != "mysql" or not timeout:
+            return query
+        hint = f"/*+ MAX_EXECUTION_TIME({int(timeout * 1000)}) */"
+        return add_hint(query, hint, self.dialect)
+
+    def estimate_scanned_bytes(self, sql):
+        if self.dialect != "postgresql":
+            return None
+        rows = self._query(f"EXPLAIN (FORMAT JSON) {strip_sql(sql, self.dialect)}")
+        plan = next(iter(rows[0].values()))
+        if isinstance(plan, str):
+            plan = json.loads(plan)
 
-            rows = []
-            total_size = 0
+        def scanned(node):
+            # Rows read from the tables, times their average width
+            size = 0
+            if "Relation Name" in node:
+                size += node["Plan Rows"] * node["Plan Width"]
+            return size + sum(scanned(child) for child in node.get("Plans", []))
 
-            for row in result:
-                row_dict = dict(row._mapping)
-                row_size = sizeof(row_dict)
+        return scanned(plan[0]["Plan"])
 
-                if total_size + row_size > MAX_SIZE:
-                    return rows
+    def _canceller(self, connection):
+        """Function cancelling the query running on the connection, if supported"""
+        dbapi_connection = connection.connection.dbapi_connection
+        if self.dialect == "sqlite":
+            # Thread-safe, the statement fails with "interrupted"
+            return dbapi_connection.interrupt
+        if self.dialect == "postgresql":
+            pid = int(dbapi_connection.get_backend_pid())
+            return lambda: self._execute(f"SELECT pg_cancel_backend({pid})")
+        if self.dialect == "mysql":
+            thread_id = int(dbapi_connection.thread_id())
+            return lambda: self._execute(f"KILL QUERY {thread_id}")
+        return None
 
-                rows.append(row_dict)
-                total_size += row_size
-            return rows
+    def _execute(self, query):
+        # On a connection of its own, the other one is busy running the query
+        with self.engine.connect() as connection:
+            connection.execute(text(query))
 
     def create_transformation(self, name, query, materialized="table", schema="public"):
         if materialized == "table":
@@ -207,12 +948,24 @@ class SnowflakeConnectionPool:
             import snowflake.connector
 
             try:
-                cls._instances[key] = snowflake.connector.connect(**connection_params)
+                connection = snowflake.connector.connect(**connection_params)
             except snowflake.connector.errors.OperationalError as e:
                 raise ConnectionError(e)
+            # Held while the session parameters are set and a query is sent
+            connection._ada_lock = Lock()
+            cls._instances[key] = connection
 
         return cls._instances[key]
 
+    @classmethod
+    def close(cls, connection):
+        for key in [k for k, c in cls._instances.items() if c is connection]:
+            del cls._instances[key]
+        try:
+            connection.close()
+        except Exception:
+            pass
+
     @classmethod
     def close_all(cls):
         for conn in cls._instances.values():
@@ -232,54 +985,87 @@ class SnowflakeDatabase(AbstractDatabase):
     def dialect(self):
         return "snowflake"
 
-    # TODO: should run the process asynchronously
-    def load_metadata(self):
-        query = "SHOW TABLES IN DATABASE {}".format(self.connection.database)
-        tables, _ = self.query(query)
-        for table in tables[:30]:
-            schema = table["schema_name"]
-            table_name = table["name"]
-
-            columns = []
-            result, _ = self.query(f"SHOW COLUMNS IN {schema}.{table_name}")
-            for column in result:
-                print("column", column)
-                # 'column_name': 'HEU', 'data_type': '{"type":"TIME","precision":0,"scale":9,"nullable":true}',
-                column["data_type"] = json.loads(column["data_type"])
-                columns.append(
-                    {
-                        "name": column["column_name"],
-                        "type": column["data_type"]["type"],
-                        "nullable": column["data_type"]["nullable"],
-                        "comment": column["comment"],
-                    }
-                )
+    def dispose(self):
+        SnowflakeConnectionPool.close(self.connection)
 
-            self.metadata.append(
-                {
-                    "schema": schema,
-                    "name": table_name,
-                    "is_view": False,
-                    "columns": columns,
-                }
+    def _fetch(self, query, params=None):
+        # A cursor per call, the schemas are read from several threads
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def _list_tables(self):
+        return [
+            table_metadata(schema, name, table_type, description, version)
+            for schema, name, table_type, description, version in self._fetch(
+                TABLES_QUERIES["snowflake"]
             )
+        ]
 
-        return self.metadata
+    def _read_columns(self, schema, tables):
+        by_name = {table["name"]: table for table in tables}
+        query = COLUMNS_QUERIES["snowflake"].format(
+            names=", ".join(["%s"] * len(by_name))
+        )
+        for table_name, name, data_type, is_nullable, description in self._fetch(
+            query, (schema, *by_name)
+        ):
+            by_name[table_name]["columns"].append(
+                column_metadata(name, data_type, is_nullable, description)
+            )
+        return tables
 
-    def _query(self, query):
+    def _stream(self, query, batch_size, execution=None, max_rows=None):
+        execution = execution or Execution()
+        if execution.cancelled:
+            raise QueryCancelledError("Query cancelled")
         with self.connection.cursor() as cursor:
-            cursor.execute(query)
-            # On fetch maximum 1000 rows
-            results = cursor.fetchmany(1000)
-            rows = results
-            # We continue fetching until there we pass MAX_SIZE
-            while results and sizeof(results) < MAX_SIZE:
-                results = cursor.fetchmany(1000)
-                rows += results
+            # The timeout of the session is read when the query is sent: other
+            # threads can't change it in between
+            with self.connection._ada_lock:
+                self._set_timeout(cursor, execution.timeout)
+                # Sent asynchronously to get the query id, needed to abort it
+                cursor.execute_async(query)
+            query_id = cursor.sfqid
+            try:
+                execution.attach(lambda: cursor.abort_query(query_id))
+            except QueryCancelledError:
+                # Cancelled while the query was sent, it would keep running
+                cursor.abort_query(query_id)
+                raise
+            try:
+                cursor.get_results_from_sfqid(query_id)
+                column_names = [column[0] for column in cursor.description]
+                for rows in fetch_rows(cursor.fetchmany, batch_size, max_rows):
+                    yield ResultBatch.from_rows(column_names, rows, cursor.rowcount)
+            finally:
+                execution.detach()
+
+    def _set_timeout(self, cursor, timeout):
+        # Session parameter of the connection, only changed when needed
+        # Called with the lock of the connection held
+        if getattr(self.connection, "_ada_statement_timeout", None) == timeout:
+            return
+        if timeout:
+            cursor.execute(
+                f"ALTER SESSION SET STATEMENT_TIMEOUT_IN_SECONDS = {int(timeout)}"
+            )
+        else:
+            cursor.execute("ALTER SESSION UNSET STATEMENT_TIMEOUT_IN_SECONDS")
+        self.connection._ada_statement_timeout = timeout
+
+    def estimate_scanned_bytes(self, sql):
+        rows = self._query(f"EXPLAIN USING JSON {strip_sql(sql, self.dialect)}")
+        plan = json.loads(next(iter(rows[0].values())))
+        return plan.get("GlobalStats", {}).get("bytesAssigned")
 
-            column_names = [column[0] for column in cursor.description]
 
-            return [dict(zip(column_names, row)) for row in rows]
+POOL_OPTIONS = {
+    "pool_size": POOL_SIZE,
+    "max_overflow": POOL_MAX_OVERFLOW,
+    "pool_recycle": POOL_RECYCLE,
+    "pool_pre_ping": True,
+}
 
 
 class DatalakeFactory:
@@ -298,7 +1084,7 @@ class DatalakeFactory:
                     [f"--{k}={v}" for k, v in kwargs["options"].items()]
                 )
             print(uri)
-            return SQLDatabase(uri)
+            return SQLDatabase(uri, **POOL_OPTIONS)
         elif dtype == "mysql":
             user = kwargs.get("user")
             password = kwargs.get("password", "")
@@ -311,7 +1097,7 @@ class DatalakeFactory:
                     [f"{k}={v}" for k, v in kwargs["options"].items()]
                 )
             print(uri)
-            return SQLDatabase(uri)
+            return SQLDatabase(uri, **POOL_OPTIONS)
 
         elif dtype == "sqlite":
             return SQLDatabase("sqlite:///" + kwargs["filename"])
@@ -319,6 +1105,83 @@ class DatalakeFactory:
             raise ValueError(f"Unknown database type: {dtype}")
 
 
+class DatalakeRegistry:
+    """
+    Process-wide registry of datalake objects, so their engine and connection
+    pool are reused across requests and chat turns.
+    Entries are keyed by database id and a hash of the connection details,
+    evicted after IDLE_TIMEOUT seconds without use.
+    """
+
+    _instances = {}  # key -> {"datalake": ..., "last_used": ...}
+    _lock = Lock()
+
+    @staticmethod
+    def _key(database):
+        details = json.dumps(database.details, sort_keys=True, default=str)
+        details_hash = hashlib.sha256(details.encode()).hexdigest()
+        return (database.id, database.engine, details_hash)
+
+    @classmethod
+    def get(cls, database):
+        key = cls._key(database)
+        with cls._lock:
+            cls._evict_idle()
+            entry = cls._instances.get(key)
+            if entry is None:
+                # Connection details changed, drop the previous pools
+                cls._remove(lambda k: k[0] == database.id)
+                entry = cls._instances[key] = {
+                    "datalake": DatalakeFactory.create(
+                        database.engine, **database.details
+                    ),
+                }
+            entry["last_used"] = time.monotonic()
+
+        datalake = entry["datalake"]
+        datalake.database_id = database.id
+        datalake.privacy_mode = database.privacy_mode
+        datalake.safe_mode = database.safe_mode
+        datalake.max_size = database.max_result_size or MAX_SIZE
+        datalake.statement_timeout = database.statement_timeout
+        datalake.max_rows = database.max_rows
+        datalake.max_scanned_bytes = database.max_scanned_bytes
+        return datalake
+
+    @classmethod
+    def invalidate(cls, database_id):
+        """Dispose the datalakes of a database (eg. when its details change)"""
+        with cls._lock:
+            cls._remove(lambda key: key[0] == database_id)
+        query_cache.invalidate(database_id)
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            cls._remove(lambda key: True)
+
+    @classmethod
+    def _evict_idle(cls):
+        deadline = time.monotonic() - IDLE_TIMEOUT
+        idle_keys = {
+            key
+            for key, entry in cls._instances.items()
+            if entry["last_used"] < deadline
+        }
+        cls._remove(lambda key: key in idle_keys)
+
+    @classmethod
+    def _remove(cls, predicate):
+        # Must be called with the lock held
+        for key in [key for key in cls._instances if predicate(key)]:
+            entry = cls._instances.pop(key)
+            try:
+                entry["datalake"].dispose()
+            except Exception:
+                pass
+
+
 def cleanup_connections():
     # TODO: use a context manager to close the connections
+    DatalakeRegistry.close_all()
     SnowflakeConnectionPool.close_all()
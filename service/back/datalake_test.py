@@ -0,0 +1,350 @@
+import itertools
+import json
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from back.datalake import (
+    COUNT_COLUMN,
+    HIDDEN_TEXT,
+    ApproxSizeEstimator,
+    DatalakeRegistry,
+    Execution,
+    QueryCancelledError,
+    ResultBatch,
+    ScanLimitError,
+    SnowflakeConnectionPool,
+    SnowflakeDatabase,
+    StatementTimeoutError,
+    UnsafeQueryError,
+    fetch_rows,
+)
+
+
+@pytest.fixture
+def database(sqlite_database):
+    yield sqlite_database(
+        1,
+        """
+        CREATE TABLE customer (id INTEGER, customer_email TEXT, city TEXT);
+        INSERT INTO customer VALUES (1, 'ada@example.com', 'Paris');
+        INSERT INTO customer VALUES (2, 'bob@example.com', 'Lyon');
+        INSERT INTO customer VALUES (3, 'eve@example.com', 'Paris');
+        """,
+    )
+    DatalakeRegistry.close_all()
+
+
+def test_registry_reuses_datalake(database):
+    datalake = DatalakeRegistry.get(database)
+    assert DatalakeRegistry.get(database) is datalake
+    assert datalake.safe_mode is True
+
+
+def test_registry_invalidation(database):
+    datalake = DatalakeRegistry.get(database)
+    DatalakeRegistry.invalidate(database.id)
+    assert DatalakeRegistry.get(database) is not datalake
+
+
+def test_registry_details_change(database, tmp_path):
+    datalake = DatalakeRegistry.get(database)
+    database.details = {"filename": str(tmp_path / "other.sqlite")}
+    assert DatalakeRegistry.get(database) is not datalake
+    assert len(DatalakeRegistry._instances) == 1
+
+
+def test_stream_batches(database):
+    datalake = DatalakeRegistry.get(database)
+    stream = datalake.stream("SELECT id, city FROM customer ORDER BY id", batch_size=2)
+    batches = list(stream)
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert batches[0].columns == ["id", "city"]
+    assert batches[0].values == [[1, 2], ["Paris", "Lyon"]]
+    assert datalake.result_count(stream) == 3
+
+
+def test_query_privacy_mode(database):
+    database.privacy_mode = True
+    datalake = DatalakeRegistry.get(database)
+    rows, count = datalake.query("SELECT * FROM customer ORDER BY id")
+    assert count == 3
+    assert rows[0] == {"id": 1, "customer_email": HIDDEN_TEXT, "city": "Paris"}
+
+
+def test_size_estimator_counts_values():
+    batch = ResultBatch(["id", "comment"], [[1, 22], ["a" * 1000, None]])
+    sizes = ApproxSizeEstimator().row_sizes(batch)
+    assert sizes == [
+        len(json.dumps({"id": 1, "comment": "a" * 1000})),
+        len(json.dumps({"id": 22, "comment": None})),
+    ]
+
+
+def test_stream_max_result_size(database):
+    database.max_result_size = 60
+    datalake = DatalakeRegistry.get(database)
+    stream = datalake.stream("SELECT id, city FROM customer ORDER BY id")
+    rows = [row for batch in stream for row in batch.rows()]
+    assert len(rows) == 2
+    assert stream.truncated
+
+
+def test_window_count_of_truncated_result(database):
+    database.max_result_size = 60
+    datalake = DatalakeRegistry.get(database)
+    with patch.object(datalake, "query_count") as query_count:
+        rows, count = datalake.query("SELECT id, city FROM customer ORDER BY id;")
+    query_count.assert_not_called()
+    assert rows == [{"id": 1, "city": "Paris"}, {"id": 2, "city": "Lyon"}]
+    assert count == 3
+
+
+def test_window_count_is_not_rerun_on_error(database):
+    database.statement_timeout = 0.2
+    datalake = DatalakeRegistry.get(database)
+    with patch.object(datalake, "_stream", wraps=datalake._stream) as _stream:
+        with pytest.raises(Exception):
+            datalake.query("SELECT * FROM missing_table")
+        with pytest.raises(StatementTimeoutError):
+            datalake.query(SLOW_QUERY)
+    assert _stream.call_count == 2
+
+
+def test_window_count_wrapping_error(database):
+    datalake = DatalakeRegistry.get(database)
+    stream = datalake._stream
+    calls = []
+
+    def _stream(sql, *args):
+        calls.append(sql)
+        if len(calls) == 1:
+            raise Exception("(1060, \"Duplicate column name 'id'\")")
+        return stream(sql, *args)
+
+    with patch.object(datalake, "_stream", side_effect=_stream):
+        rows, count = datalake.query("SELECT id, city FROM customer ORDER BY id")
+    # Run as is
+    assert calls[1] == "SELECT id, city FROM customer ORDER BY id"
+    assert count == 3
+
+
+def test_window_count_keeps_order(database):
+    datalake = DatalakeRegistry.get(database)
+    with patch.object(datalake, "_stream", wraps=datalake._stream) as _stream:
+        rows, _ = datalake.query("SELECT id FROM customer ORDER BY id DESC")
+        assert COUNT_COLUMN in _stream.call_args[0][0]
+        assert [row["id"] for row in rows] == [3, 2, 1]
+
+        # Wrapped without the trailing semicolon and comment
+        rows, _ = datalake.query("SELECT id FROM customer; -- all customers")
+        assert COUNT_COLUMN in _stream.call_args[0][0]
+        assert len(rows) == 3
+
+        # A single batch, not wrapped
+        datalake.query("SELECT id FROM customer ORDER BY id LIMIT 2")
+        assert COUNT_COLUMN not in _stream.call_args[0][0]
+
+
+def test_query_count_fallback(database):
+    datalake = DatalakeRegistry.get(database)
+    sql = "SELECT * FROM customer WHERE city != 'a;b';"
+    assert datalake.query_count(sql) == 3
+
+
+def test_safe_mode(database):
+    datalake = DatalakeRegistry.get(database)
+    rows, _ = datalake.query("SELECT 'DELETE ' AS last_update")
+    assert rows == [{"last_update": "DELETE "}]
+    with pytest.raises(UnsafeQueryError):
+        datalake.query("DELETE\nFROM customer")
+    # The escaped quote doesn't hide the DELETE
+    with pytest.raises(UnsafeQueryError):
+        datalake.query("SELECT E'a\\''; DELETE FROM customer; --'")
+    with pytest.raises(UnsafeQueryError):
+        datalake.query("SELECT 'abc")
+    # Only reads and SET are allowed
+    for sql in (
+        "DO $$ BEGIN DELETE FROM customer; END $$",
+        "ATTACH DATABASE ':memory:' AS other",
+        "PRAGMA writable_schema = ON",
+        "VACUUM",
+    ):
+        with pytest.raises(UnsafeQueryError):
+            datalake.query(sql)
+    # Columns named like keywords, checked without running them
+    datalake.stream("SELECT a AS delete, t.update FROM t")
+    # The limits can't be lifted
+    with pytest.raises(UnsafeQueryError):
+        datalake.query("SET statement_timeout = 0; SELECT * FROM customer")
+
+
+def test_query_cache(database):
+    database.safe_mode = False
+    datalake = DatalakeRegistry.get(database)
+    datalake.query("SELECT * FROM customer WHERE city = 'Paris'")
+    with patch.object(datalake, "_stream") as _stream:
+        stream = datalake.stream("select *\nFROM customer  WHERE city = 'Paris';")
+        rows = [row for batch in stream for row in batch.rows()]
+    _stream.assert_not_called()
+    assert stream.cached and len(rows) == 2
+
+    # Explicit runs bypass the cache
+    stream = datalake.stream("SELECT * FROM customer WHERE city = 'Paris'", cache=False)
+    assert len([row for batch in stream for row in batch.rows()]) == 2
+    assert not stream.cached
+
+    # Results too large aren't kept
+    with patch("back.datalake.QUERY_CACHE_MAX_ENTRY_SIZE", 10):
+        with patch("back.datalake.query_cache.set") as cache_set:
+            list(datalake.stream("SELECT * FROM customer WHERE id > 0"))
+    cache_set.assert_not_called()
+
+    # Writes invalidate the cache
+    datalake.query("UPDATE customer SET city = 'Paris'")
+    stream = datalake.stream("SELECT * FROM customer WHERE city = 'Paris'")
+    list(stream)
+    assert not stream.cached
+
+
+SLOW_QUERY = """
+WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n)
+SELECT COUNT(*) AS count FROM (SELECT i FROM n LIMIT 1000000000)
+"""
+
+
+def test_cancel_query(database):
+    datalake = DatalakeRegistry.get(database)
+    stream = datalake.stream(SLOW_QUERY)
+    threading.Timer(0.2, stream.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(QueryCancelledError):
+        list(stream)
+    assert time.monotonic() - start < 5
+
+    # The connection is released and usable
+    rows, _ = datalake.query("SELECT COUNT(*) AS count FROM customer")
+    assert rows == [{"count": 3}]
+
+
+def test_cancel_before_execution(database):
+    datalake = DatalakeRegistry.get(database)
+    stream = datalake.stream("SELECT * FROM customer")
+    stream.cancel()
+    with pytest.raises(QueryCancelledError):
+        list(stream)
+
+
+def test_statement_timeout(database):
+    database.statement_timeout = 0.2
+    datalake = DatalakeRegistry.get(database)
+    start = time.monotonic()
+    with pytest.raises(StatementTimeoutError) as error:
+        datalake.query(SLOW_QUERY)
+    assert time.monotonic() - start < 5
+    assert error.value.limit == 0.2
+
+    # The timeout is per query
+    rows, _ = datalake.query("SELECT COUNT(*) AS count FROM customer")
+    assert rows == [{"count": 3}]
+
+
+def test_max_rows(database):
+    database.max_rows = 2
+    datalake = DatalakeRegistry.get(database)
+    stream = datalake.stream("SELECT * FROM customer")
+    rows = [row for batch in stream for row in batch.rows()]
+    assert len(rows) == 2 and stream.truncated
+    assert datalake.result_count(stream) == 3
+
+    # In a single batch, not wrapped: the total is unknown
+    with patch.object(datalake, "query_count") as query_count:
+        rows, count = datalake.query("SELECT * FROM customer LIMIT 10")
+    query_count.assert_not_called()
+    assert len(rows) == 2 and count is None
+
+    # Only the rows needed are read from the driver
+    with patch.object(datalake, "_stream", wraps=datalake._stream) as _stream:
+        list(datalake.stream("SELECT * FROM customer WHERE id > 0"))
+    assert _stream.call_args[0][3] == 3
+
+
+def test_fetch_rows():
+    rows = iter(range(10))
+
+    def fetchmany(size):
+        return list(itertools.islice(rows, size))
+
+    assert list(fetch_rows(fetchmany, 4, max_rows=6)) == [[0, 1, 2, 3], [4, 5]]
+    assert list(fetch_rows(fetchmany, 4)) == [[6, 7, 8, 9]]
+
+
+def test_max_scanned_bytes(database):
+    database.max_scanned_bytes = 1000
+    datalake = DatalakeRegistry.get(database)
+    with patch.object(datalake, "estimate_scanned_bytes", return_value=5000):
+        with pytest.raises(ScanLimitError):
+            datalake.query("SELECT * FROM customer")
+    with patch.object(datalake, "estimate_scanned_bytes", return_value=500):
+        rows, _ = datalake.query("SELECT * FROM customer")
+    assert len(rows) == 3
+
+
+def test_load_metadata(database):
+    datalake = DatalakeRegistry.get(database)
+    progress = []
+    metadata = datalake.load_metadata(progress=lambda *p: progress.append(p))
+    assert [(t["schema"], t["name"]) for t in metadata] == [("main", "customer")]
+    assert [c["name"] for c in metadata[0]["columns"]] == [
+        "id",
+        "customer_email",
+        "city",
+    ]
+    assert progress[-1] == (1, 1)
+
+    # Unchanged tables are not read again
+    with patch.object(datalake, "_read_columns") as read_columns:
+        assert datalake.load_metadata(previous=metadata) == metadata
+    read_columns.assert_not_called()
+
+    datalake.safe_mode = False
+    datalake.query("ALTER TABLE customer ADD COLUMN country TEXT")
+    metadata = datalake.load_metadata(previous=metadata)
+    assert metadata[0]["columns"][-1]["name"] == "country"
+
+
+def test_snowflake_cancelled_while_sent():
+    datalake = SnowflakeDatabase.__new__(SnowflakeDatabase)
+    datalake.connection = MagicMock(_ada_lock=threading.Lock())
+    cursor = datalake.connection.cursor.return_value.__enter__.return_value
+    cursor.sfqid = "query-1"
+    execution = Execution()
+    # eg. the chat turn is stopped while the query is sent
+    cursor.execute_async.side_effect = lambda query: execution.cancel()
+    with pytest.raises(QueryCancelledError):
+        list(datalake._stream("SELECT 1", 10, execution))
+    cursor.abort_query.assert_called_once_with("query-1")
+
+
+def test_stream_keeps_its_settings(database):
+    database.statement_timeout = 5
+    datalake = DatalakeRegistry.get(database)
+    stream = datalake.stream("SELECT * FROM customer")
+    # Changed by another request while the query runs
+    database.max_result_size = 60
+    database.statement_timeout = None
+    DatalakeRegistry.get(database)
+    rows = [row for batch in stream for row in batch.rows()]
+    assert len(rows) == 3 and not stream.truncated
+    assert stream.execution.timeout == 5
+
+
+def test_snowflake_dispose():
+    connection = MagicMock()
+    SnowflakeConnectionPool._instances[("account", "test")] = connection
+    datalake = SnowflakeDatabase.__new__(SnowflakeDatabase)
+    datalake.connection = connection
+    datalake.dispose()
+    connection.close.assert_called_once()
+    assert ("account", "test") not in SnowflakeConnectionPool._instances
@@ -0,0 +1,226 @@
+"""
+Persistent queue of background jobs: metadata loading, dbt artifacts parsing,
+embeddings generation... so they don't run on the request path.
+Jobs are stored in the job table: they survive a restart and their state is
+exposed to the clients. Each process runs a few workers claiming the due jobs,
+a failed job is retried with an exponential backoff, up to maxAttempts.
+"""
+import importlib
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from back.models import Job
+from back.session import Session
+
+JOB_RUNNER = os.getenv("JOB_RUNNER", "1") == "1"  # Run the jobs in this process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 5))  # seconds
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_DELAY = int(os.getenv("JOB_RETRY_DELAY", 30))  # seconds, doubled each time
+# A job running for longer is considered lost (crashed process), and run again
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", 3600))  # seconds
+
+# Function running each kind of job: handler(session, job, progress)
+# The changes of the handler are committed with the job state
+JOB_HANDLERS = {
+    "load_metadata": "back.metadata:load_metadata",
+    "parse_dbt": "chat.dbt_utils:parse_artifacts",
+    "embed_queries": "chat.memory_utils:embed_queries",
+    "generate_questions": "chat.questions:generate_questions",
+}
+
+
+class JOB_STATUS:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+def load_handler(kind):
+    module, function = JOB_HANDLERS[kind].split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def enqueue(session, kind, database_id=None, payload=None, max_attempts=None):
+    """
+    Queue a job and commit it
+    If the same job is already waiting or running, it is returned instead
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    payload = payload or {}
+    waiting = (
+        session.query(Job)
+        .filter_by(kind=kind, databaseId=database_id)
+        .filter(Job.status.in_([JOB_STATUS.QUEUED, JOB_STATUS.RUNNING]))
+        .all()
+    )
+    for job in waiting:
+        if (job.payload or {}) == payload:
+            return job
+
+    job = Job(
+        kind=kind,
+        databaseId=database_id,
+        payload=payload,
+        status=JOB_STATUS.QUEUED,
+        attempts=0,
+        maxAttempts=max_attempts or JOB_MAX_ATTEMPTS,
+        runAt=datetime.utcnow(),
+    )
+    session.add(job)
+    session.commit()
+    job_runner.wake()
+    return job
+
+
+def latest_jobs(session, database_ids):
+    """State of the last job of each kind, by database, in a single query"""
+    if not database_ids:
+        return {}
+    latest = (
+        session.query(func.max(Job.id))
+        .filter(Job.databaseId.in_(database_ids))
+        .group_by(Job.databaseId, Job.kind)
+    )
+    state = {database_id: {} for database_id in database_ids}
+    for job in session.query(Job).filter(Job.id.in_(latest.scalar_subquery())):
+        state[job.databaseId][job.kind] = {
+            "id": job.id,
+            "status": job.status,
+            "progress": job.progress,
+            "error": job.error,
+            "finishedAt": job.finishedAt,
+        }
+    return state
+
+
+def retry(session, job):
+    """Queue a failed job again, with its attempts reset"""
+    job.status = JOB_STATUS.QUEUED
+    job.attempts = 0
+    job.error = None
+    job.runAt = datetime.utcnow()
+    job.finishedAt = None
+    session.commit()
+    job_runner.wake()
+    return job
+
+
+class JobRunner:
+    def __init__(
+        self,
+        workers=JOB_WORKERS,
+        poll_interval=JOB_POLL_INTERVAL,
+        session_factory=Session,
+    ):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.session_factory = session_factory
+        self._wake = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"job-worker-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        """A job was queued, don't wait for the next poll"""
+        self._wake.set()
+
+    def _work(self):
+        while True:
+            try:
+                ran = self.run_next()
+            except Exception as e:
+                # eg. the database is unavailable, try again later
+                print(f"Job runner error: {e}")
+                ran = False
+            if not ran:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def run_next(self):
+        """Claim and run the next due job, False if there is none"""
+        session = self.session_factory()
+        try:
+            job = self._claim(session)
+            if job is None:
+                return False
+            self._run(session, job)
+            return True
+        finally:
+            session.close()
+
+    def _claim(self, session):
+        now = datetime.utcnow()
+        # Jobs of a crashed process are queued again
+        session.query(Job).filter(
+            Job.status == JOB_STATUS.RUNNING,
+            Job.startedAt < now - timedelta(seconds=JOB_TIMEOUT),
+        ).update({Job.status: JOB_STATUS.QUEUED}, synchronize_session=False)
+        session.commit()
+
+        due = (
+            session.query(Job.id)
+            .filter(Job.status == JOB_STATUS.QUEUED, Job.runAt <= now)
+            .order_by(Job.runAt, Job.id)
+            .limit(10)
+            .all()
+        )
+        for (job_id,) in due:
+            # Only one worker (of any process) can switch the job to running
+            claimed = (
+                session.query(Job)
+                .filter(Job.id == job_id, Job.status == JOB_STATUS.QUEUED)
+                .update(
+                    {
+                        Job.status: JOB_STATUS.RUNNING,
+                        Job.attempts: Job.attempts + 1,
+                        Job.startedAt: now,
+                    },
+                    synchronize_session=False,
+                )
+            )
+            session.commit()
+            if claimed:
+                return session.get(Job, job_id)
+        return None
+
+    def _run(self, session, job):
+        def progress(done, total):
+            job.progress = {"done": done, "total": total}
+            session.commit()
+
+        try:
+            load_handler(job.kind)(session, job, progress)
+        except Exception as e:
+            session.rollback()
+            job.error = str(e)
+            if job.attempts < job.maxAttempts:
+                delay = JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+                job.status = JOB_STATUS.QUEUED
+                job.runAt = datetime.utcnow() + timedelta(seconds=delay)
+            else:
+                job.status = JOB_STATUS.FAILED
+                job.finishedAt = datetime.utcnow()
+        else:
+            job.status = JOB_STATUS.DONE
+            job.error = None
+            job.finishedAt = datetime.utcnow()
+        session.commit()
+
+
+job_runner = JobRunner()
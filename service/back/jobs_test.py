@@ -0,0 +1,78 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+import pytest
+from back.jobs import JOB_STATUS, JobRunner, enqueue
+
+
+def make_job(attempts=1, max_attempts=3):
+    return SimpleNamespace(
+        id=1,
+        kind="load_metadata",
+        databaseId=1,
+        payload={},
+        status=JOB_STATUS.RUNNING,
+        attempts=attempts,
+        maxAttempts=max_attempts,
+        progress=None,
+        error=None,
+        runAt=datetime.utcnow(),
+        finishedAt=None,
+    )
+
+
+def run(job, handler):
+    session = Mock()
+    with patch("back.jobs.load_handler", return_value=handler):
+        JobRunner(session_factory=lambda: session)._run(session, job)
+    return session
+
+
+def test_run_job():
+    def handler(session, job, progress):
+        progress(1, 2)
+
+    job = make_job()
+    session = run(job, handler)
+    assert job.status == JOB_STATUS.DONE
+    assert job.progress == {"done": 1, "total": 2}
+    assert job.finishedAt is not None
+    assert session.commit.call_count == 2
+
+
+def test_failed_job_is_retried():
+    job = make_job(attempts=2)
+    before = datetime.utcnow()
+    session = run(job, Mock(side_effect=Exception("Connection refused")))
+    session.rollback.assert_called_once()
+    assert job.status == JOB_STATUS.QUEUED
+    assert job.error == "Connection refused"
+    # Exponential backoff
+    assert (job.runAt - before).total_seconds() >= 60
+
+
+def test_failed_job_after_max_attempts():
+    job = make_job(attempts=3)
+    run(job, Mock(side_effect=Exception("Connection refused")))
+    assert job.status == JOB_STATUS.FAILED
+    assert job.finishedAt is not None
+
+
+def test_enqueue_returns_waiting_job():
+    # Queued or running
+    waiting = make_job()
+    session = Mock()
+    query = session.query.return_value.filter_by.return_value.filter.return_value
+    query.all.return_value = [waiting]
+    assert enqueue(session, "load_metadata", 1) is waiting
+    session.add.assert_not_called()
+
+    with patch("back.jobs.job_runner") as job_runner:
+        job = enqueue(session, "load_metadata", 1, {"full": True})
+    assert job is not waiting and job.status == JOB_STATUS.QUEUED
+    session.commit.assert_called_once()
+    job_runner.wake.assert_called_once()
+
+    with pytest.raises(ValueError):
+        enqueue(session, "unknown")
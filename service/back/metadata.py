@@ -0,0 +1,129 @@
+"""
+Loading of the tables metadata of the databases, run as a background job
+(see back.jobs) so creating or updating a database doesn't wait for the
+introspection.
+The tables are stored in the metadata_table / metadata_column catalog, read
+by page. Database.tables_metadata keeps them as a single JSON document, for
+the readers of the whole schema.
+"""
+from datetime import datetime
+
+from back.datalake import DatalakeRegistry
+from back.jobs import enqueue
+from back.models import Database, MetadataColumn, MetadataTable
+from sqlalchemy import tuple_
+from sqlalchemy.orm import selectinload
+
+SCHEMA_PAGE_SIZE = 100  # tables
+
+
+def load_metadata(session, job, progress):
+    """
+    Job: read the tables of the database
+    Only the altered tables are read again, unless the payload has "full"
+    """
+    database = session.query(Database).filter_by(id=job.databaseId).first()
+    if database is None:
+        raise ValueError(f"Database {job.databaseId} not found")
+    datalake = DatalakeRegistry.get(database)
+    previous = None if (job.payload or {}).get("full") else database.tables_metadata
+    tables = datalake.load_metadata(previous, progress)
+    sync_catalog(session, database.id, tables)
+    database.tables_metadata = tables
+    database.metadataRefreshedAt = datetime.utcnow()
+    # Pre-generate the starter questions of the new version, see chat.questions
+    enqueue(
+        session,
+        "generate_questions",
+        database.id,
+        {"context_id": f"database-{database.id}"},
+    )
+
+
+def sync_catalog(session, database_id, tables):
+    """Write the added and altered tables in the catalog, remove the dropped ones"""
+    existing = {
+        (table.schemaName, table.tableName): table
+        for table in session.query(MetadataTable).filter_by(databaseId=database_id)
+    }
+    for table in tables:
+        current = existing.pop((table["schema"], table["name"]), None)
+        if current is None:
+            current = MetadataTable(
+                databaseId=database_id,
+                schemaName=table["schema"],
+                tableName=table["name"],
+            )
+            session.add(current)
+        elif table.get("version") is not None and current.version == table["version"]:
+            continue
+        current.description = table.get("description")
+        current.isView = bool(table.get("is_view"))
+        current.version = table.get("version")
+        current.columns = [
+            MetadataColumn(
+                position=position,
+                name=column["name"],
+                type=column.get("type"),
+                nullable=column.get("nullable"),
+                description=column.get("description"),
+            )
+            for position, column in enumerate(table["columns"])
+        ]
+    dropped = [table.id for table in existing.values()]
+    if dropped:
+        session.query(MetadataColumn).filter(
+            MetadataColumn.tableId.in_(dropped)
+        ).delete(synchronize_session=False)
+        session.query(MetadataTable).filter(MetadataTable.id.in_(dropped)).delete(
+            synchronize_session=False
+        )
+
+
+def list_tables(
+    session,
+    database_id,
+    schema=None,
+    search=None,
+    tables=None,
+    columns=True,
+    offset=0,
+    limit=SCHEMA_PAGE_SIZE,
+):
+    """
+    Page of the tables of a database, by schema and name
+    - search: part of the table name, case insensitive
+    - tables: only these (schema, name), eg. the tables of a project
+    Return: total, tables (same format as Database.tables_metadata)
+    """
+    query = session.query(MetadataTable).filter(MetadataTable.databaseId == database_id)
+    if schema:
+        query = query.filter(MetadataTable.schemaName == schema)
+    if search:
+        # % and _ of the search are not wildcards
+        search = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.filter(MetadataTable.tableName.ilike(f"%{search}%", escape="\\"))
+    if tables is not None:
+        query = query.filter(
+            tuple_(MetadataTable.schemaName, MetadataTable.tableName).in_(list(tables))
+        )
+    total = query.count()
+    page = query.order_by(MetadataTable.schemaName, MetadataTable.tableName)
+    if columns:
+        # One query for the columns of the page
+        page = page.options(selectinload(MetadataTable.columns))
+    return {
+        "total": total,
+        "tables": [
+            table.to_dict(columns) for table in page.offset(offset).limit(limit)
+        ],
+    }
+
+
+def get_table(session, database_id, schema, name):
+    table = (
+        session.query(MetadataTable)
+        .filter_by(databaseId=database_id, schemaName=schema, tableName=name)
+        .first()
+    )
+    return table.to_dict() if table else None
@@ -0,0 +1,151 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+from back.datalake import DatalakeRegistry
+from back.metadata import get_table, list_tables, load_metadata, sync_catalog
+from back.models import Base, MetadataColumn, MetadataTable
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+@pytest.fixture
+def database(sqlite_database):
+    return sqlite_database(
+        3,
+        """
+        CREATE TABLE customer (id INTEGER, city TEXT);
+        CREATE VIEW paris_customer AS SELECT * FROM customer WHERE city = 'Paris';
+        """,
+        tables_metadata=None,
+        metadataRefreshedAt=None,
+    )
+
+
+def test_load_metadata(database, monkeypatch):
+    enqueue = Mock()
+    monkeypatch.setattr("back.metadata.enqueue", enqueue)
+    sync_catalog = Mock()
+    monkeypatch.setattr("back.metadata.sync_catalog", sync_catalog)
+    session = Mock()
+    session.query.return_value.filter_by.return_value.first.return_value = database
+    job = SimpleNamespace(databaseId=database.id, payload={"full": True})
+    progress = []
+    load_metadata(session, job, lambda *p: progress.append(p))
+
+    assert progress[-1] == (2, 2)
+    assert [(t["name"], t["is_view"]) for t in database.tables_metadata] == [
+        ("customer", False),
+        ("paris_customer", True),
+    ]
+    assert database.metadataRefreshedAt is not None
+    enqueue.assert_called_once_with(
+        session, "generate_questions", 3, {"context_id": "database-3"}
+    )
+    sync_catalog.assert_called_once_with(session, 3, database.tables_metadata)
+
+
+def test_load_metadata_missing_database():
+    session = Mock()
+    session.query.return_value.filter_by.return_value.first.return_value = None
+    job = SimpleNamespace(databaseId=4, payload=None)
+    with pytest.raises(ValueError):
+        load_metadata(session, job, lambda *p: None)
+
+
+@pytest.fixture
+def catalog_session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(
+        engine, tables=[MetadataTable.__table__, MetadataColumn.__table__]
+    )
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def catalog_table(schema, name, version, columns=("id",)):
+    return {
+        "schema": schema,
+        "name": name,
+        "description": None,
+        "is_view": False,
+        "version": version,
+        "columns": [
+            {"name": column, "type": "INTEGER", "nullable": True, "description": None}
+            for column in columns
+        ],
+    }
+
+
+def test_sync_catalog(catalog_session):
+    sync_catalog(
+        catalog_session,
+        1,
+        [
+            catalog_table("main", "customer", "1", ["id", "city"]),
+            catalog_table("main", "orders", "1"),
+        ],
+    )
+    catalog_session.commit()
+    customer = get_table(catalog_session, 1, "main", "customer")
+    assert [column["name"] for column in customer["columns"]] == ["id", "city"]
+
+    # customer is altered, orders is dropped
+    sync_catalog(
+        catalog_session,
+        1,
+        [
+            catalog_table("main", "customer", "2", ["id", "city", "country"]),
+            catalog_table("main", "product", "1"),
+        ],
+    )
+    catalog_session.commit()
+    customer = get_table(catalog_session, 1, "main", "customer")
+    assert [column["name"] for column in customer["columns"]] == [
+        "id",
+        "city",
+        "country",
+    ]
+    assert get_table(catalog_session, 1, "main", "orders") is None
+    assert catalog_session.query(MetadataColumn).count() == 4
+
+
+def test_list_tables(catalog_session):
+    sync_catalog(
+        catalog_session,
+        1,
+        [catalog_table("main", f"table_{i}", "1") for i in range(5)]
+        + [catalog_table("staging", "table_0", "1")],
+    )
+    sync_catalog(catalog_session, 2, [catalog_table("main", "other", "1")])
+    catalog_session.commit()
+
+    page = list_tables(catalog_session, 1, offset=2, limit=2)
+    assert page["total"] == 6
+    assert [t["name"] for t in page["tables"]] == ["table_2", "table_3"]
+
+    page = list_tables(catalog_session, 1, schema="main", search="E_4", columns=False)
+    assert page == {
+        "total": 1,
+        "tables": [
+            {
+                "schema": "main",
+                "name": "table_4",
+                "description": None,
+                "is_view": False,
+                "version": "1",
+            }
+        ],
+    }
+
+    assert list_tables(catalog_session, 1, search="%4")["total"] == 0
+    assert list_tables(catalog_session, 1, search="E_")["total"] == 6
+
+    page = list_tables(
+        catalog_session, 1, tables=[("staging", "table_0"), ("main", "table_1")]
+    )
+    assert [(t["schema"], t["name"]) for t in page["tables"]] == [
+        ("main", "table_1"),
+        ("staging", "table_0"),
+    ]
@@ -1,14 +1,17 @@
 import json
 from dataclasses import dataclass
+from datetime import datetime
 
 from autochat.model import Message as AutoChatMessage, Image as AutoChatImage
 from pgvector.sqlalchemy import Vector
 from sqlalchemy import (
     TIMESTAMP,
+    BigInteger,
     Boolean,
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     func,
@@ -17,7 +20,7 @@ from sqlalchemy import (
 )
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 
 Base = declarative_base()
 
@@ -65,6 +68,11 @@ class Database(DefaultBase, Base):
     privacy_mode: bool
     dbt_catalog: dict
     dbt_manifest: dict
+    max_result_size: int
+    statement_timeout: int
+    max_rows: int
+    max_scanned_bytes: int
+    metadataRefreshedAt: datetime
 
     __tablename__ = "database"
 
@@ -81,12 +89,22 @@ class Database(DefaultBase, Base):
     tables_metadata = Column(JSONB)
     dbt_catalog = Column(JSONB)
     dbt_manifest = Column(JSONB)
+    # Parts of the artifacts used by the chat, see chat.dbt_utils.parse_artifacts
+    dbt_parsed = deferred(Column(JSONB))
 
     organisation = relationship("Organisation")
     owner = relationship("User")
 
     safe_mode = Column(Boolean, nullable=False, default=True, server_default="true")
     privacy_mode = Column(Boolean, nullable=False, default=True, server_default="true")
+    # Maximum size of a query result, in bytes (default to datalake.MAX_SIZE)
+    max_result_size = Column(Integer)
+    # Limits of the queries, enforced by the drivers (no limit if null)
+    statement_timeout = Column(Integer)  # seconds
+    max_rows = Column(Integer)
+    max_scanned_bytes = Column(BigInteger)  # As estimated by the query planner
+    # Last time tables_metadata was loaded, see back.metadata
+    metadataRefreshedAt = Column(DateTime)
 
     # Hotfix for engine, "postgres" should be "postgresql"
     @property
@@ -126,7 +144,8 @@ class ConversationMessage(DefaultBase, Base):
     queryId = Column(Integer, ForeignKey("query.id"), nullable=True)
     reqId = Column(String, nullable=True)
     functionCallId = Column(String, nullable=True)
-    image = Column(LargeBinary, nullable=True)
+    # Loaded on access, only the chatbot needs it
+    image = deferred(Column(LargeBinary, nullable=True))
     isAnswer = Column(Boolean, nullable=False, default=False)
 
     conversation = relationship("Conversation", back_populates="messages")
@@ -215,10 +234,11 @@ class Conversation(DefaultBase, Base):
 
     owner = relationship("User")
     database = relationship("Database")
+    # Loaded on access, conversations can be long, see fetch_messages
     messages = relationship(
         "ConversationMessage",
         back_populates="conversation",
-        lazy="joined",
+        lazy="select",
         # Order by id
         order_by="ConversationMessage.id",
     )
@@ -239,10 +259,25 @@ class Query(DefaultBase, Base):
     tables = Column(String)
     wheres = Column(String)
     embedding = Column(Vector(1536))
+    # Hash of the question embedded, see chat.embeddings.text_hash
+    embeddingHash = Column(String)
+    # Provider and model of the embedding, see chat.embeddings.embedding_model
+    embeddingModel = Column(String)
 
     database = relationship("Database")
     creator = relationship("User")
 
+    __table_args__ = (
+        Index("ix_query_databaseId", "databaseId"),
+        # Nearest neighbours search of the similar questions, see chat.memory_utils
+        Index(
+            "ix_query_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_ops={"embedding": "vector_l2_ops"},
+        ),
+    )
+
     visualisationParams = Column(JSONB)
 
 
@@ -335,6 +370,148 @@ class Note(DefaultBase, Base):
     project = relationship("Project", back_populates="notes")
 
 
+class ChatTurn(Base):
+    """Running chat turns, see chat.turns.PostgresTurnRegistry"""
+
+    __tablename__ = "chat_turn"
+
+    id = Column(String, primary_key=True)
+    stopped = Column(Boolean, nullable=False, default=False)
+    startedAt = Column(DateTime, nullable=False, server_default=func.now())
+    owner = Column(String)
+
+
+@dataclass
+class Job(DefaultBase, Base):
+    """Background job, see back.jobs"""
+
+    id: int
+    kind: str
+    databaseId: int
+    payload: dict
+    status: str
+    attempts: int
+    maxAttempts: int
+    progress: dict
+    error: str
+    runAt: datetime
+    startedAt: datetime
+    finishedAt: datetime
+
+    __tablename__ = "job"
+    __table_args__ = (Index("ix_job_status_runAt", "status", "runAt"),)
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    databaseId = Column(Integer, ForeignKey("database.id", ondelete="CASCADE"))
+    payload = Column(JSONB)
+    status = Column(String, nullable=False, default="queued", server_default="queued")
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    maxAttempts = Column(Integer, nullable=False, default=3, server_default="3")
+    progress = Column(JSONB)  # {"done": ..., "total": ...}
+    error = Column(String)
+    # Not run before, pushed back when the job is retried
+    runAt = Column(DateTime, nullable=False, server_default=func.now())
+    startedAt = Column(DateTime)
+    finishedAt = Column(DateTime)
+
+
+@dataclass
+class ContextQuestions(DefaultBase, Base):
+    """Starter questions generated for a context, see chat.questions"""
+
+    contextId: str
+    version: str
+    questions: list
+    generatedAt: datetime
+
+    __tablename__ = "context_questions"
+
+    # "database-{databaseId}" or "project-{projectId}"
+    contextId = Column(String, primary_key=True)
+    databaseId = Column(
+        Integer, ForeignKey("database.id", ondelete="CASCADE"), nullable=False
+    )
+    # Version of the context the questions were generated from
+    version = Column(String, nullable=False)
+    questions = Column(JSONB, nullable=False)
+    generatedAt = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class MetadataTable(DefaultBase, Base):
+    """
+    Table of a database, read by back.metadata
+    Database.tables_metadata is derived from it, as a single JSON document
+    """
+
+    __tablename__ = "metadata_table"
+    __table_args__ = (
+        Index(
+            "ix_metadata_table_databaseId_schemaName_tableName",
+            "databaseId",
+            "schemaName",
+            "tableName",
+            unique=True,
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    databaseId = Column(
+        Integer, ForeignKey("database.id", ondelete="CASCADE"), nullable=False
+    )
+    schemaName = Column(String, nullable=False)
+    tableName = Column(String, nullable=False)
+    description = Column(String)
+    isView = Column(Boolean, nullable=False, default=False, server_default="false")
+    # Changes when the table is altered, see AbstractDatabase.load_metadata
+    version = Column(String)
+
+    columns = relationship(
+        "MetadataColumn",
+        order_by="MetadataColumn.position",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+    def to_dict(self, columns=True):
+        # Same format as the tables of Database.tables_metadata
+        table = {
+            "schema": self.schemaName,
+            "name": self.tableName,
+            "description": self.description,
+            "is_view": self.isView,
+            "version": self.version,
+        }
+        if columns:
+            table["columns"] = [column.to_dict() for column in self.columns]
+        return table
+
+
+class MetadataColumn(Base):
+    __tablename__ = "metadata_column"
+
+    id = Column(Integer, primary_key=True)
+    tableId = Column(
+        Integer,
+        ForeignKey("metadata_table.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    position = Column(Integer, nullable=False)
+    name = Column(String, nullable=False)
+    type = Column(String)
+    nullable = Column(Boolean)
+    description = Column(String)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "type": self.type,
+            "nullable": self.nullable,
+            "description": self.description,
+        }
+
+
 if __name__ == "__main__":
     from session import DATABASE_URL
     from sqlalchemy import create_engine
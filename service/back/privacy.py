@@ -0,0 +1,124 @@
+"""
+Privacy mode: hide sensitive data (names, emails, phones, ...) from results.
+A MaskingPlan is built once per result, from the column names and the first
+batch of values, then applied column by column to every batch.
+"""
+import re
+
+HIDDEN_TEXT = "*** HIDDEN ***"
+PRIVACY_KEYWORDS = [  # TODO: use AI to detect sensitive data
+    "name",
+    "first_name",
+    "last_name",
+    "full_name",
+    "first name",
+    "last name",
+    "full name",
+    "address",
+    "email",
+    "phone",
+    "password",
+    "secret",
+]
+# A column containing one of these words is hidden (eg. customer_email)
+SENSITIVE_WORDS = {
+    "address",
+    "email",
+    "emails",
+    "phone",
+    "phones",
+    "mobile",
+    "password",
+    "passwd",
+    "secret",
+    "firstname",
+    "lastname",
+    "fullname",
+    "surname",
+}
+EMAIL_PATTERN = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+")
+PHONE_PATTERN = re.compile(r"^(?:(?:\+|00)33|0)\s*[1-9](?:[\s.-]*\d{2}){4}$")
+SAMPLE_SIZE = 100
+
+
+def column_words(column):
+    """Split a column name in lowercase words: customerEmail -> customer, email"""
+    column = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(column))
+    return re.findall(r"[a-z0-9]+", column.lower())
+
+
+KEYWORDS = {" ".join(column_words(keyword)) for keyword in PRIVACY_KEYWORDS}
+
+
+def is_sensitive_column(column):
+    words = column_words(column)
+    if " ".join(words) in KEYWORDS or "".join(words) in SENSITIVE_WORDS:
+        return True
+    return any(word in SENSITIVE_WORDS for word in words)
+
+
+def mask_text(value):
+    if "@" in value:
+        value = EMAIL_PATTERN.sub(HIDDEN_TEXT, value)
+    if value[:1] in ("+", "0"):
+        value = PHONE_PATTERN.sub(HIDDEN_TEXT, value)
+    return value
+
+
+def is_sensitive_value(value):
+    return bool(EMAIL_PATTERN.fullmatch(value) or PHONE_PATTERN.match(value))
+
+
+class MaskingPlan:
+    """What to do with each column of a result: hide, scan or keep"""
+
+    HIDE = "hide"  # Sensitive column, every value is hidden
+    SCAN = "scan"  # Text column, sensitive patterns are replaced
+    KEEP = "keep"  # Numbers, dates, ... nothing to hide
+
+    def __init__(self, columns, actions):
+        self.columns = columns
+        self.actions = actions
+        self.masked = {
+            column
+            for column, action in zip(columns, actions)
+            if action == MaskingPlan.HIDE
+        }
+
+    @classmethod
+    def build(cls, batch):
+        actions = []
+        for column, values in zip(batch.columns, batch.values):
+            sample = [value for value in values[:SAMPLE_SIZE] if value is not None]
+            if is_sensitive_column(column):
+                actions.append(cls.HIDE)
+            elif sample and not any(isinstance(value, str) for value in sample):
+                actions.append(cls.KEEP)
+            elif sample and all(
+                isinstance(value, str) and is_sensitive_value(value) for value in sample
+            ):
+                # eg. a "contact" column full of emails
+                actions.append(cls.HIDE)
+            else:
+                actions.append(cls.SCAN)
+        return cls(batch.columns, actions)
+
+    @property
+    def masked_columns(self):
+        """Columns where some data was hidden, in the result order"""
+        return [column for column in self.columns if column in self.masked]
+
+    def apply(self, batch):
+        """Hide sensitive data from the batch, in place"""
+        for index, action in enumerate(self.actions):
+            values = batch.values[index]
+            if action == MaskingPlan.HIDE:
+                batch.values[index] = [HIDDEN_TEXT] * len(values)
+            elif action == MaskingPlan.SCAN:
+                masked_values = [
+                    mask_text(value) if isinstance(value, str) else value
+                    for value in values
+                ]
+                if masked_values != values:
+                    self.masked.add(self.columns[index])
+                batch.values[index] = masked_values
@@ -0,0 +1,34 @@
+from back.datalake import ResultBatch
+from back.privacy import HIDDEN_TEXT, MaskingPlan, is_sensitive_column
+
+
+def test_sensitive_columns():
+    assert is_sensitive_column("customer_email")
+    assert is_sensitive_column("Email")
+    assert is_sensitive_column("billingAddress")
+    assert is_sensitive_column("First Name")
+    assert is_sensitive_column("name")
+    assert not is_sensitive_column("product_name")
+    assert not is_sensitive_column("last_update")
+
+
+def test_masking_plan():
+    batch = ResultBatch(
+        ["id", "contact", "comment", "Phone_Number"],
+        [
+            [1, 2],
+            ["ada@example.com", "bob@example.com"],
+            ["call me at 0612345678", "write to eve@example.com"],
+            ["0612345678", None],
+        ],
+    )
+    plan = MaskingPlan.build(batch)
+    plan.apply(batch)
+    assert plan.actions == ["keep", "hide", "scan", "hide"]
+    assert batch.values == [
+        [1, 2],
+        [HIDDEN_TEXT, HIDDEN_TEXT],
+        ["call me at 0612345678", "write to " + HIDDEN_TEXT],
+        [HIDDEN_TEXT, HIDDEN_TEXT],
+    ]
+    assert plan.masked_columns == ["contact", "comment", "Phone_Number"]
@@ -0,0 +1,171 @@
+"""
+Cache of query results, layered under AbstractDatabase.stream.
+Entries are keyed by database, normalized SQL, the modes of the datalake and
+a per-database generation, bumped by `invalidate` when the data is known to
+have changed. Entries also expire after QUERY_CACHE_TTL seconds.
+The results may hold personal data: the cache is kept in memory by default,
+the disk backend (shared by the processes of the host) is opt-in and only
+readable by the user of the service.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+QUERY_CACHE_BACKEND = os.getenv("QUERY_CACHE_BACKEND", "memory")  # memory, disk, none
+QUERY_CACHE_DIR = os.getenv("QUERY_CACHE_DIR", "/tmp/ada/query_cache")
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", 600))  # seconds
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 256 * 1024 * 1024))  # bytes
+# Larger results are not cached
+QUERY_CACHE_MAX_ENTRY_SIZE = int(os.getenv("QUERY_CACHE_MAX_ENTRY_SIZE", 1024 * 1024))
+
+
+class MemoryBackend:
+    """LRU cache of the process, bounded by the size of its entries"""
+
+    def __init__(self, size_limit):
+        self.size_limit = size_limit
+        self.entries = OrderedDict()  # key -> (expire_at, size, tag, value)
+        self.volume = 0
+        self.generations = {}  # tag -> generation, never evicted
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.monotonic():
+                self._pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[3]
+
+    def set(self, key, value, size=0, expire=None, tag=None):
+        expire_at = time.monotonic() + expire if expire else None
+        with self.lock:
+            if key in self.entries:
+                self._pop(key)
+            self.entries[key] = (expire_at, size, tag, value)
+            self.volume += size
+            while self.volume > self.size_limit and self.entries:
+                self._pop(next(iter(self.entries)))
+
+    def generation(self, tag):
+        with self.lock:
+            return self.generations.get(tag, 0)
+
+    def bump(self, tag):
+        with self.lock:
+            self.generations[tag] = self.generations.get(tag, 0) + 1
+
+    def evict(self, tag):
+        with self.lock:
+            for key in [k for k, entry in self.entries.items() if entry[2] == tag]:
+                self._pop(key)
+
+    def stats(self):
+        return {"entries": len(self.entries), "volume": self.volume}
+
+    def _pop(self, key):
+        self.volume -= self.entries.pop(key)[1]
+
+
+class DiskBackend:
+    """diskcache based, shared by the processes of the host"""
+
+    def __init__(self, directory, size_limit):
+        import diskcache
+
+        # Private to the user of the service, whatever its umask
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.chmod(directory, 0o700)
+        self.cache = diskcache.Cache(
+            directory,
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+            tag_index=True,
+        )
+        # Apart from the results, so they are never evicted
+        self.generations = diskcache.Cache(
+            os.path.join(directory, "generations"), eviction_policy="none"
+        )
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, size=0, expire=None, tag=None):
+        self.cache.set(key, value, expire=expire, tag=tag)
+
+    def generation(self, tag):
+        return self.generations.get(tag, 0)
+
+    def bump(self, tag):
+        self.generations.incr(tag)
+
+    def evict(self, tag):
+        self.cache.evict(tag)
+
+    def stats(self):
+        return {"entries": len(self.cache), "volume": self.cache.volume()}
+
+
+class QueryCache:
+    def __init__(self, backend=QUERY_CACHE_BACKEND, ttl=QUERY_CACHE_TTL):
+        self.backend_name = backend
+        self.ttl = ttl
+        self._backend = None
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.backend_name != "none"
+
+    @property
+    def backend(self):
+        # Created on first use, so importing the module has no side effect
+        with self._lock:
+            if self._backend is None:
+                if self.backend_name == "disk":
+                    self._backend = DiskBackend(QUERY_CACHE_DIR, QUERY_CACHE_SIZE)
+                else:
+                    self._backend = MemoryBackend(QUERY_CACHE_SIZE)
+            return self._backend
+
+    def key(self, database_id, sql, **options):
+        generation = self.backend.generation(str(database_id))
+        key = json.dumps([database_id, generation, sql, options], sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key, entry, database_id, size=0):
+        if size > QUERY_CACHE_MAX_ENTRY_SIZE:
+            return
+        self.backend.set(key, entry, size=size, expire=self.ttl, tag=str(database_id))
+
+    def invalidate(self, database_id):
+        """Forget the results of a database, eg. after a write or a refresh"""
+        if not self.enabled:
+            return
+        self.backend.bump(str(database_id))
+        self.backend.evict(str(database_id))
+
+    def stats(self):
+        stats = {"backend": self.backend_name, "hits": self.hits, "misses": self.misses}
+        if self.enabled:
+            stats.update(self.backend.stats())
+        return stats
+
+
+query_cache = QueryCache()
@@ -0,0 +1,15 @@
+from back.query_cache import MemoryBackend, QueryCache
+
+
+def test_generation_is_not_evicted():
+    cache = QueryCache(backend="memory")
+    cache._backend = MemoryBackend(size_limit=10)
+    key = cache.key(1, "SELECT 1")
+    cache.invalidate(1)
+    assert cache.key(1, "SELECT 1") != key
+
+    # The results fill the cache, the generation stays
+    key = cache.key(1, "SELECT 1")
+    for index in range(5):
+        cache.set(f"result {index}", {}, 1, size=5)
+    assert cache.key(1, "SELECT 1") == key
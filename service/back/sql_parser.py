@@ -0,0 +1,427 @@
+"""
+Lightweight SQL tokenizer, used to classify statements for the safe mode.
+Comments, string literals and quoted identifiers are recognized, so their
+content is never mistaken for a keyword.
+Quoting depends on the dialect, eg. backslash escapes are only read in
+MySQL / Snowflake strings and Postgres E'...' strings. When the dialect is
+unknown, the query is read with each quoting: if they don't agree, or if a
+quote or comment isn't closed, the query is considered a write.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+READ = "read"
+WRITE = "write"
+DDL = "ddl"
+OTHER = "other"  # Session / maintenance statements: SET, USE, PRAGMA, ...
+
+STATEMENT_KINDS = {
+    "SELECT": READ,
+    "WITH": READ,
+    "VALUES": READ,
+    "TABLE": READ,
+    "SHOW": READ,
+    "DESCRIBE": READ,
+    "DESC": READ,
+    "EXPLAIN": READ,
+    "INSERT": WRITE,
+    "UPDATE": WRITE,
+    "DELETE": WRITE,
+    "MERGE": WRITE,
+    "UPSERT": WRITE,
+    "REPLACE": WRITE,
+    "COPY": WRITE,
+    "CALL": WRITE,
+    "EXEC": WRITE,
+    "EXECUTE": WRITE,
+    "CREATE": DDL,
+    "DROP": DDL,
+    "ALTER": DDL,
+    "TRUNCATE": DDL,
+    "RENAME": DDL,
+    "GRANT": DDL,
+    "REVOKE": DDL,
+    "COMMENT": DDL,
+}
+# Keywords that turn a read statement into a write when found inside it,
+# eg. WITH deleted AS (DELETE ... RETURNING *) SELECT ...; SELECT ... INTO t
+NESTED_KINDS = {
+    "INSERT": WRITE,
+    "UPDATE": WRITE,
+    "DELETE": WRITE,
+    "MERGE": WRITE,
+    "INTO": WRITE,
+    "CREATE": DDL,
+    "DROP": DDL,
+    "ALTER": DDL,
+    "TRUNCATE": DDL,
+}
+# ... except after these tokens: SELECT ... FOR UPDATE, ON DELETE CASCADE,
+# a column or an alias named like a keyword: t.delete, a AS update
+NESTED_EXCEPTIONS = {"FOR", "ON", ".", "AS"}
+
+# Session settings enforcing the limits of the queries, see back.datalake
+LIMIT_SETTINGS = {
+    "STATEMENT_TIMEOUT",
+    "MAX_EXECUTION_TIME",
+    "STATEMENT_TIMEOUT_IN_SECONDS",
+}
+
+# Case-insensitive keywords, uppercased by normalize (identifiers keep their case)
+KEYWORDS = set(STATEMENT_KINDS) | {
+    "ALL",
+    "AND",
+    "AS",
+    "ASC",
+    "AVG",
+    "BETWEEN",
+    "BY",
+    "CASE",
+    "CAST",
+    "COUNT",
+    "CROSS",
+    "DISTINCT",
+    "ELSE",
+    "END",
+    "EXISTS",
+    "FALSE",
+    "FROM",
+    "FULL",
+    "GROUP",
+    "HAVING",
+    "ILIKE",
+    "IN",
+    "INNER",
+    "INTO",
+    "IS",
+    "JOIN",
+    "LEFT",
+    "LIKE",
+    "LIMIT",
+    "MAX",
+    "MIN",
+    "NOT",
+    "NULL",
+    "OFFSET",
+    "ON",
+    "OR",
+    "ORDER",
+    "OUTER",
+    "OVER",
+    "PARTITION",
+    "RIGHT",
+    "SUM",
+    "THEN",
+    "TRUE",
+    "UNION",
+    "WHEN",
+    "WHERE",
+}
+
+TOKEN_TEMPLATE = r"""
+      (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<string>{string})
+    | (?P<identifier>{identifier})
+    | (?P<unterminated>/\*|['"`]|\$\w*\${unterminated})
+    | (?P<word>[A-Za-z_][\w$]*)
+    | (?P<number>\d+(?:\.\d*)?)
+    | (?P<punctuation>\S)
+"""
+STANDARD_STRING = r"'(?:[^']|'')*'"
+BACKSLASH_STRING = r"'(?:[^'\\]|\\.|'')*'"
+E_STRING = r"[Ee]'(?:[^'\\]|\\.|'')*'"  # Postgres escape string
+DOLLAR_STRING = r"\$(?P<tag>\w*)\$.*?\$(?P=tag)\$"
+QUOTED_IDENTIFIER = r'"(?:[^"]|"")*"'
+BACKTICK_IDENTIFIER = r"`[^`]*`"
+
+# Quoting of each dialect: string and identifier patterns, and the openings
+# of strings specific to the dialect
+QUOTINGS = {
+    "standard": (
+        "|".join([E_STRING, STANDARD_STRING, DOLLAR_STRING]),
+        "|".join([QUOTED_IDENTIFIER, BACKTICK_IDENTIFIER]),
+        "|[Ee]'",
+    ),
+    # Without ANSI_QUOTES, MySQL reads "..." as a string
+    "mysql": (
+        "|".join([BACKSLASH_STRING, r'"(?:[^"\\]|\\.|"")*"']),
+        BACKTICK_IDENTIFIER,
+        "",
+    ),
+    "backslash": (
+        "|".join([BACKSLASH_STRING, DOLLAR_STRING]),
+        "|".join([QUOTED_IDENTIFIER, BACKTICK_IDENTIFIER]),
+        "",
+    ),
+}
+TOKEN_REGEXES = {
+    quoting: re.compile(
+        TOKEN_TEMPLATE.format(
+            string=string, identifier=identifier, unterminated=unterminated
+        ),
+        re.VERBOSE | re.DOTALL,
+    )
+    for quoting, (string, identifier, unterminated) in QUOTINGS.items()
+}
+DIALECT_QUOTINGS = {
+    "postgresql": "standard",
+    "sqlite": "standard",
+    "mysql": "mysql",
+    "snowflake": "backslash",
+    "bigquery": "backslash",
+}
+
+Token = namedtuple("Token", ["type", "value", "text"])  # value is uppercased
+Statement = namedtuple("Statement", ["kind", "keyword"])
+
+
+def tokenize(sql, dialect=None):
+    """
+    Split a query in tokens, comments are dropped
+    An unclosed quote or comment is an "unterminated" token
+    """
+    quoting = DIALECT_QUOTINGS.get(dialect, "standard")
+    tokens = []
+    for match in TOKEN_REGEXES[quoting].finditer(sql):
+        token_type = match.lastgroup
+        if token_type == "comment":
+            continue
+        text = value = match.group()
+        if token_type == "word":
+            value = value.upper()
+        tokens.append(Token(token_type, value, text))
+    return tokens
+
+
+def strip_end(sql, dialect=None):
+    """Remove the trailing semicolons and comments, eg. to use it as a subquery"""
+    quoting = DIALECT_QUOTINGS.get(dialect, "standard")
+    end = 0
+    for match in TOKEN_REGEXES[quoting].finditer(sql):
+        if match.lastgroup != "comment" and match.group() != ";":
+            end = match.end()
+    return sql[:end].strip()
+
+
+def split_statements(tokens):
+    statements, current = [], []
+    for token in tokens:
+        if token.value == ";":
+            if current:
+                statements.append(current)
+            current = []
+        else:
+            current.append(token)
+    if current:
+        statements.append(current)
+    return statements
+
+
+def classify_statement(tokens):
+    words = [token for token in tokens if token.type == "word"]
+    if not words:
+        return Statement(OTHER, None)
+
+    keyword = words[0].value
+    kind = STATEMENT_KINDS.get(keyword, OTHER)
+    if kind != READ:
+        return Statement(kind, keyword)
+
+    for index, token in enumerate(tokens):
+        nested_kind = NESTED_KINDS.get(token.value) if token.type == "word" else None
+        if not nested_kind:
+            continue
+        previous = tokens[index - 1] if index else None
+        following = tokens[index + 1] if index + 1 < len(tokens) else None
+        if previous and previous.value in NESTED_EXCEPTIONS:
+            continue
+        if following and following.value in ("(", ".", ",") and token.value != "INTO":
+            # Function call or column, eg. replace(...), update.id, delete, ...
+            continue
+        return Statement(nested_kind, token.value)
+    return Statement(READ, keyword)
+
+
+def _classify(tokens):
+    if any(token.type == "unterminated" for token in tokens):
+        # Can't tell where the statements end
+        return (Statement(WRITE, None),)
+    return tuple(
+        classify_statement(statement) for statement in split_statements(tokens)
+    )
+
+
+@lru_cache(maxsize=4096)
+def classify(sql, dialect=None):
+    """
+    Return the kind of each statement of the query (read, write, ddl, other)
+    The keyword of a write is None when the quoting is unterminated or
+    ambiguous
+    """
+    if dialect in DIALECT_QUOTINGS:
+        return _classify(tokenize(sql, dialect))
+    # Unknown dialect: every quoting has to give the same statements
+    readings = {
+        _classify(tokenize(sql, dialect))
+        for dialect in ("postgresql", "mysql", "snowflake")
+    }
+    if len(readings) > 1:
+        return (Statement(WRITE, None),)
+    return readings.pop()
+
+
+def is_select(sql, dialect=None):
+    """Whether the query is a single SELECT, that can be wrapped or streamed"""
+    statements = classify(sql, dialect)
+    return (
+        len(statements) == 1
+        and statements[0].kind == READ
+        and statements[0].keyword in ("SELECT", "WITH")
+    )
+
+
+def is_read_only(sql, dialect=None):
+    statements = classify(sql, dialect)
+    return bool(statements) and all(s.kind == READ for s in statements)
+
+
+def changes_limits(sql, dialect=None):
+    """
+    Whether the query changes a setting enforcing the limits of the queries,
+    eg. SET statement_timeout = 0, RESET ALL or set_config('statement_timeout', ...)
+    """
+    for statement in split_statements(tokenize(sql, dialect)):
+        names = {
+            token.value if token.type == "word" else token.text.strip("'\"`").upper()
+            for token in statement
+        }
+        words = [token.value for token in statement if token.type == "word"]
+        if (
+            words
+            and words[0] in ("SET", "RESET")
+            and names & (LIMIT_SETTINGS | {"ALL"})
+        ):
+            return True
+        if "SET_CONFIG" in names and names & LIMIT_SETTINGS:
+            return True
+    return False
+
+
+def add_hint(sql, hint, dialect=None):
+    """
+    Add an optimizer hint after the first SELECT outside of the parentheses,
+    eg. SELECT /*+ MAX_EXECUTION_TIME(1000) */ ... (after the WITH clause)
+    """
+    quoting = DIALECT_QUOTINGS.get(dialect, "standard")
+    depth = 0
+    for match in TOKEN_REGEXES[quoting].finditer(sql):
+        text = match.group()
+        if text == "(":
+            depth += 1
+        elif text == ")":
+            depth -= 1
+        elif depth == 0 and match.lastgroup == "word" and text.upper() == "SELECT":
+            return f"{sql[: match.end()]} {hint}{sql[match.end() :]}"
+    return sql
+
+
+def top_level(tokens):
+    """Tokens outside of the parentheses, eg. not in subqueries"""
+    depth = 0
+    for token in tokens:
+        if token.value == "(":
+            depth += 1
+        elif token.value == ")":
+            depth -= 1
+        elif depth == 0:
+            yield token
+
+
+@lru_cache(maxsize=4096)
+def result_shape(sql, dialect=None):
+    """
+    Return: whether a SELECT ends with an ORDER BY, and its LIMIT (None if
+    there isn't one), eg. (True, 10) for SELECT ... ORDER BY a LIMIT 10
+    """
+    tokens = list(top_level(tokenize(sql, dialect)))
+    ordered, limit = False, None
+    for index, token in enumerate(tokens):
+        following = tokens[index + 1 : index + 4]
+        if token.value == "ORDER" and following and following[0].value == "BY":
+            ordered = True
+        elif token.value == "LIMIT" and following and following[0].type == "number":
+            limit = int(float(following[0].value))
+            if len(following) > 2 and following[1].value == ",":
+                # MySQL: LIMIT offset, count
+                limit = int(float(following[2].value))
+        elif token.value == "FETCH" and len(following) > 1:
+            # FETCH FIRST 10 ROWS ONLY
+            if following[1].type == "number":
+                limit = int(float(following[1].value))
+    return ordered, limit
+
+
+@lru_cache(maxsize=4096)
+def normalize(sql, dialect=None):
+    """
+    Canonical form of a query, to detect equivalent queries:
+    comments, extra whitespace and trailing semicolons are removed,
+    keywords are uppercased
+    """
+    statements = split_statements(tokenize(sql, dialect))
+    return "; ".join(
+        " ".join(
+            token.value if token.value in KEYWORDS else token.text
+            for token in statement
+        )
+        for statement in statements
+    )
+
+
+def referenced_tables(sql, dialect=None):
+    """Tables read or written by the query, eg. ["public.users", "orders"]"""
+    tokens = tokenize(sql, dialect)
+    # Names defined by WITH ... AS (...) are not tables
+    ctes = {
+        tokens[index - 1].value
+        for index, token in enumerate(tokens)
+        if token.value == "AS"
+        and index
+        and index + 1 < len(tokens)
+        and tokens[index + 1].value == "("
+    }
+    tables = []
+    calls = []  # For each open parenthesis: is it a function call?
+    for index, token in enumerate(tokens[:-1]):
+        if token.value == "(":
+            previous = tokens[index - 1] if index else None
+            calls.append(
+                previous is not None
+                and previous.type == "word"
+                and previous.value not in KEYWORDS
+            )
+        elif token.value == ")" and calls:
+            calls.pop()
+        if token.value not in ("FROM", "JOIN", "INTO", "UPDATE", "TABLE"):
+            continue
+        if calls and calls[-1]:
+            # eg. EXTRACT(YEAR FROM day)
+            continue
+        # Read a (possibly qualified) name: schema.table
+        parts, position = [], index + 1
+        while position < len(tokens) and tokens[position].type in (
+            "word",
+            "identifier",
+        ):
+            parts.append(tokens[position].text)
+            if position + 1 < len(tokens) and tokens[position + 1].value == ".":
+                position += 2
+            else:
+                break
+        if not parts or (len(parts) == 1 and parts[0].upper() in ctes):
+            continue
+        name = ".".join(parts)
+        if name not in tables and parts[0].upper() not in KEYWORDS:
+            tables.append(name)
+    return tables
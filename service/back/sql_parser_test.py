@@ -0,0 +1,130 @@
+import pytest
+from back.sql_parser import (
+    DDL,
+    OTHER,
+    READ,
+    WRITE,
+    Statement,
+    add_hint,
+    changes_limits,
+    classify,
+    is_read_only,
+    is_select,
+    normalize,
+    referenced_tables,
+)
+
+
+@pytest.mark.parametrize(
+    "sql, kinds",
+    [
+        ("SELECT last_update FROM film", [READ]),
+        ("SELECT 'DELETE FROM users' AS text", [READ]),
+        ('SELECT "update" FROM t -- DROP TABLE t', [READ]),
+        ("SELECT replace(name, 'a', 'b') FROM t;", [READ]),
+        ("SELECT * FROM t FOR UPDATE", [READ]),
+        ("DELETE\nFROM users", [WRITE]),
+        ("delete from users", [WRITE]),
+        ("WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d", [WRITE]),
+        ("SELECT * INTO backup FROM t", [WRITE]),
+        ("EXPLAIN ANALYZE UPDATE t SET a = 1", [WRITE]),
+        ("/* hello */ DROP TABLE t", [DDL]),
+        ("SELECT 1; TRUNCATE t;", [READ, DDL]),
+        ("SET search_path TO public", [OTHER]),
+        ("ATTACH DATABASE 'other.db' AS other", [OTHER]),
+        ("PRAGMA writable_schema = ON", [OTHER]),
+        ("UNDROP TABLE t", [OTHER]),
+        ("VACUUM", [OTHER]),
+        ("LOCK TABLE t", [OTHER]),
+        ("SELECT a AS delete FROM t", [READ]),
+        ("SELECT x.update FROM x", [READ]),
+        ("SELECT t.delete FROM t", [READ]),
+    ],
+)
+def test_classify(sql, kinds):
+    assert [statement.kind for statement in classify(sql)] == kinds
+
+
+def test_is_select():
+    assert is_select("  WITH a AS (SELECT 1) SELECT * FROM a;")
+    assert not is_select("SELECT 1; SELECT 2")
+    assert not is_select("SHOW TABLES")
+
+
+def test_normalize():
+    assert (
+        normalize("select *\n  FROM t -- all rows\nwhere a = 'x  y';")
+        == normalize("SELECT * FROM t WHERE a = 'x  y'")
+        == "SELECT * FROM t WHERE a = 'x  y'"
+    )
+
+
+def test_referenced_tables():
+    sql = """
+    WITH recent AS (
+        SELECT EXTRACT(YEAR FROM day) FROM public.orders WHERE day > '2024-01-01'
+    )
+    SELECT * FROM recent JOIN "Customers" c ON c.id = recent.customer_id
+    LEFT JOIN (SELECT 1) AS one ON true
+    """
+    assert referenced_tables(sql) == ["public.orders", '"Customers"']
+
+
+@pytest.mark.parametrize(
+    "sql, dialect, kinds",
+    [
+        # The backslash escapes the quote: the DELETE is a statement
+        ("SELECT E'a\\''; DELETE FROM users; --'", None, [READ, WRITE]),
+        ("SELECT E'a\\''; DELETE FROM users; --'", "postgresql", [READ, WRITE]),
+        ("SELECT 'a\\''; DELETE FROM users; --'", "mysql", [READ, WRITE]),
+        # ... or not, depending on the dialect
+        ("SELECT 'a\\'; DELETE FROM users; --'", "postgresql", [READ, WRITE]),
+        ("SELECT 'a\\'; DELETE FROM users; --'", "mysql", [READ]),
+        ("SELECT 'a\\'; DELETE FROM users; --'", "snowflake", [READ]),
+        ('SELECT "a\\"; DELETE FROM users; --"', "mysql", [READ]),
+        ("SELECT 'it''s'", None, [READ]),
+        ("SELECT $$ drop table t $$", "postgresql", [READ]),
+        ("DO $$ BEGIN DELETE FROM users; END $$", "postgresql", [OTHER]),
+    ],
+)
+def test_classify_quoting(sql, dialect, kinds):
+    assert [statement.kind for statement in classify(sql, dialect)] == kinds
+
+
+@pytest.mark.parametrize(
+    "sql, dialect",
+    [
+        # Ambiguous: the dialects don't agree on where the string ends
+        ("SELECT 'a\\'; DELETE FROM users; --'", None),
+        # Unterminated
+        ("SELECT 'abc", "postgresql"),
+        ("SELECT E'abc\\'", "postgresql"),
+        ("SELECT 1 /* DELETE", "mysql"),
+        ("SELECT $$ abc", None),
+        # $$ is an identifier in MySQL, a string in Postgres
+        ("SELECT $$; DROP TABLE t; $$", None),
+    ],
+)
+def test_classify_unsafe_quoting(sql, dialect):
+    assert classify(sql, dialect) == (Statement(WRITE, None),)
+    assert not is_read_only(sql, dialect)
+
+
+def test_changes_limits():
+    assert changes_limits("SET statement_timeout = 0")
+    assert changes_limits("select 1; set local STATEMENT_TIMEOUT to 0", "postgresql")
+    assert changes_limits("SET @@session.max_execution_time = 0", "mysql")
+    assert changes_limits("RESET ALL")
+    assert changes_limits("SELECT set_config('statement_timeout', '0', false)")
+    assert not changes_limits("SET search_path TO public")
+    assert not changes_limits("SELECT 'SET statement_timeout = 0'")
+
+
+def test_add_hint():
+    hint = "/*+ MAX_EXECUTION_TIME(1000) */"
+    assert add_hint("select * from t", hint) == f"select {hint} * from t"
+    assert (
+        add_hint("WITH a AS (SELECT 1) SELECT * FROM a", hint)
+        == f"WITH a AS (SELECT 1) SELECT {hint} * FROM a"
+    )
+    assert add_hint("SHOW TABLES", hint) == "SHOW TABLES"
@@ -1,75 +1,90 @@
+from functools import partial
+
 from back.models import ConversationMessage, Project, User
 from back.session import Session
 from chat.datachat import DatabaseChat
-from chat.lock import (
-    STATUS,
-    conversation_stop_flags,
-    emit_status,
-    handle_stop_flag,
-    stop_flag_lock,
-)
-from flask import Blueprint, g
-from flask_socketio import emit
+from chat.lock import STATUS, emit_status, handle_stop_flag
+from chat.pool import TurnPool, TurnRejected
+from chat.turns import turn_registry
+from flask import Blueprint, g, request
 
 api = Blueprint("chat_api", __name__)
 
 from app import socketio
 
-socket_session = None
+# Chat turns run in green threads under eventlet / gevent, threads otherwise
+turn_pool = TurnPool(start=socketio.start_background_task)
 
 
 @socketio.on("stop")
 def handle_stop(conversation_id):
     print("Received stop signal for conversation_id", conversation_id)
-    # Stop the query
-    with stop_flag_lock:
-        if conversation_id in conversation_stop_flags:
-            conversation_stop_flags[conversation_id] = True
-            emit_status(conversation_id, STATUS.TO_STOP)
-
-        else:
-            print(
-                f"No active 'ask' process found for conversation_id {conversation_id}"
-            )
+    # Stop the turn, the turn may run in another process
+    # Its running SQL query is cancelled, see DatabaseChat.on_stop
+    if conversation_id and turn_registry.stop(conversation_id):
+        emit_status(conversation_id, STATUS.TO_STOP)
+    else:
+        print(f"No active 'ask' process found for conversation_id {conversation_id}")
 
 
-def extract_context(context_id):
+def extract_context(session, context_id):
     """
     Extract the databaseId from the context_id
     context is "project-{projectId}" or "database-{databaseId}"
     """
     if context_id.startswith("project-"):
         project_id = int(context_id.split("-")[1])
-        project = socket_session.query(Project).filter_by(id=project_id).first()
+        project = session.query(Project).filter_by(id=project_id).first()
         return project.databaseId, project_id
     elif context_id.startswith("database-"):
         return int(context_id.split("-")[1]), None
 
 
-@socketio.on("ask")
+def submit_turn(turn, conversation_id, context_id, *args):
+    """
+    Run the turn in the pool, with its own session, and stream its messages
+    to the client that sent the event
+    """
+    send = partial(socketio.emit, to=request.sid)
+    with Session() as session:
+        database_id, project_id = extract_context(session, context_id)
+
+    def run():
+        # The turn commits its messages as they come, without reloading them
+        # (a reload would open a transaction for the next model call)
+        session = Session(expire_on_commit=False)
+        try:
+            turn(send, conversation_id, session, database_id, project_id, *args)
+        finally:
+            session.close()
+
+    try:
+        # Socket clients are not authenticated, the connection is the user
+        turn_pool.submit(request.sid, database_id, run)
+    except TurnRejected as e:
+        emit_status(conversation_id or "new", STATUS.ERROR, e)
+
+
 @handle_stop_flag
-def handle_ask(question, conversation_id=None, context_id=None):
-    database_id, project_id = extract_context(context_id)
+def ask_turn(send, conversation_id, session, database_id, project_id, question):
     iterator = DatabaseChat(
-        socket_session,
+        session,
         database_id,
         conversation_id,
-        conversation_stop_flags,
+        turn_registry,
         project_id=project_id,
     ).ask(question)
     for message in iterator:
-        emit("response", message.to_dict())
+        send("response", message.to_dict())
 
 
-@socketio.on("query")
 @handle_stop_flag
-def handle_query(query, conversation_id=None, context_id=None):
-    database_id, project_id = extract_context(context_id)
+def query_turn(send, conversation_id, session, database_id, project_id, query):
     chat = DatabaseChat(
-        socket_session,
+        session,
         database_id,
         conversation_id,
-        conversation_stop_flags,
+        turn_registry,
         project_id=project_id,
     )
 
@@ -83,16 +98,16 @@ def handle_query(query, conversation_id=None, context_id=None):
         },
         conversationId=chat.conversation.id,
     )
-    socket_session.add(user_message)
-    socket_session.commit()
-    emit("response", user_message.to_dict())
+    session.add(user_message)
+    session.commit()
+    send("response", user_message.to_dict())
     # Run the SQL
     message = user_message.to_autochat_message()
     content = chat.sql_query(query, from_response=message)
     user_message.queryId = message.query_id
     # Update the message with the linked query
-    socket_session.add(user_message)
-    emit("response", user_message.to_dict())
+    session.add(user_message)
+    send("response", user_message.to_dict())
 
     # Display the response
     message = ConversationMessage(
@@ -101,60 +116,62 @@ def handle_query(query, conversation_id=None, context_id=None):
         content=content,
         conversationId=chat.conversation.id,
     )
-    socket_session.add(message)
-    socket_session.commit()
-    emit("response", message.to_dict())
+    session.add(message)
+    session.commit()
+    send("response", message.to_dict())
 
 
-@socketio.on("regenerateFromMessage")
 @handle_stop_flag
-def handle_regenerate_from_message(message_id, conversation_id=None, context_id=None):
-    """
-    Regenerate the conversation from a specific message
-    Delete all messages after the message_id and regenerate the conversation
-    If the message is from the assistant, delete it
-    If the message is from the user, regenerate the conversation from the next message
-    """
-    database_id, project_id = extract_context(context_id)
+def regenerate_turn(
+    send, conversation_id, session, database_id, project_id, message_id
+):
     chat = DatabaseChat(
-        socket_session,
+        session,
         database_id,
         conversation_id,
-        conversation_stop_flags,
+        turn_registry,
         project_id=project_id,
     )
     # Clear all messages after the message_id
     messages = (
-        socket_session.query(ConversationMessage)
+        session.query(ConversationMessage)
         .filter(ConversationMessage.id > message_id)
         .all()
     )
     for message in messages:
-        emit("delete-message", message.id)
-        socket_session.delete(message)
+        send("delete-message", message.id)
+        session.delete(message)
     # Also, if the message is from the assistant, delete it
 
-    message = socket_session.query(ConversationMessage).filter_by(id=message_id).first()
+    message = session.query(ConversationMessage).filter_by(id=message_id).first()
     if message.role == "assistant":
-        emit("delete-message", message.id)
-        socket_session.delete(message)
+        send("delete-message", message.id)
+        session.delete(message)
 
-    socket_session.commit()
+    session.commit()
+    chat.forget_messages()
     # Regenerate the conversation
     for message in chat._run_conversation():
         print("MESSAGE", message.to_dict())
-        emit("response", message.to_dict())
+        send("response", message.to_dict())
+
+
+@socketio.on("ask")
+def handle_ask(question, conversation_id=None, context_id=None):
+    submit_turn(ask_turn, conversation_id, context_id, question)
 
 
-@socketio.on("connect")
-def on_connect():
-    # This is where you would initialize your session
-    # or any other per-connection resources.
-    global socket_session
-    socket_session = Session()
+@socketio.on("query")
+def handle_query(query, conversation_id=None, context_id=None):
+    submit_turn(query_turn, conversation_id, context_id, query)
 
 
-@socketio.on("disconnect")
-def on_disconnect():
-    # Cleanup: Close or remove any resources you initialized on connect
-    socket_session.close()
+@socketio.on("regenerateFromMessage")
+def handle_regenerate_from_message(message_id, conversation_id=None, context_id=None):
+    """
+    Regenerate the conversation from a specific message
+    Delete all messages after the message_id and regenerate the conversation
+    If the message is from the assistant, delete it
+    If the message is from the user, regenerate the conversation from the next message
+    """
+    submit_turn(regenerate_turn, conversation_id, context_id, message_id)
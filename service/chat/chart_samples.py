@@ -0,0 +1,24 @@
+"""
+Catalog of FusionCharts configuration samples, one per chart type of
+PLOT_WIDGET, shipped with the service instead of fetched from fusioncharts.com
+"""
+import json
+import os
+from functools import lru_cache
+
+CHART_SAMPLES_PATH = os.path.join(os.path.dirname(__file__), "chart_samples.json")
+
+
+@lru_cache(maxsize=1)
+def load_chart_samples():
+    """Samples indexed by lowercase chart type, loaded on first use"""
+    with open(CHART_SAMPLES_PATH) as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def fetch_chart_code_sample(chart_type: str) -> str:
+    sample = load_chart_samples().get(chart_type.lower())
+    if sample is None:
+        return f"No sample available for {chart_type}"
+    return json.dumps(sample)
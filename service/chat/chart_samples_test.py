@@ -0,0 +1,23 @@
+import json
+import os
+
+from chat.chart_samples import fetch_chart_code_sample, load_chart_samples
+
+with open(
+    os.path.join(os.path.dirname(__file__), "functions", "PLOT_WIDGET.json")
+) as f:
+    PLOT_WIDGET = json.load(f)
+
+
+def test_catalog_covers_plot_widget_types():
+    output_types = PLOT_WIDGET["parameters"]["properties"]["outputType"]["enum"]
+    samples = load_chart_samples()
+    for output_type in output_types:
+        assert output_type.lower() in samples
+
+
+def test_fetch_chart_code_sample():
+    sample = json.loads(fetch_chart_code_sample("MSColumn2D"))
+    assert sample["type"] == "mscolumn2d"
+    assert "dataset" in sample["dataSource"]
+    assert fetch_chart_code_sample("unknown") == "No sample available for unknown"
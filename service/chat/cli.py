@@ -1,34 +1,56 @@
 import json
 
 import click
-from back.models import Conversation, Query
+from back.models import Conversation
 from back.session import Session
-from chat.memory_utils import find_closest_embeddings, generate_embedding
+from chat.memory_utils import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_RATE_LIMIT,
+    backfill_embeddings,
+    find_closest_embeddings,
+)
+from chat.render import FUSIONCHARTS_DIR, download_assets
 from flask import Blueprint, g
-from sqlalchemy import and_
 
 chat_cli = Blueprint("chat_cli", __name__)
 
 
 @chat_cli.cli.command("fetch-query-embedding")
-def fetch_query_embedding():
-    # Get all queries that don't have embedding yet
-    queries = g.session.query(Query).filter(
-        and_(
-            Query.databaseId == 131,
-            Query.query != "???",
-            Query.embedding == None,
-            Query.sql != None,  # Add this condition
+@click.option(
+    "--database-id",
+    "database_ids",
+    type=int,
+    multiple=True,
+    help="Database of the queries, can be repeated. Default: all databases",
+)
+@click.option("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+@click.option("--concurrency", type=int, default=EMBEDDING_CONCURRENCY)
+@click.option(
+    "--rate-limit",
+    type=int,
+    default=EMBEDDING_RATE_LIMIT,
+    help="Maximum requests per minute, 0 for no limit",
+)
+@click.option("--force", is_flag=True, help="Also embed the unchanged questions")
+def fetch_query_embedding(database_ids, batch_size, concurrency, rate_limit, force):
+    """Compute the missing or outdated embeddings of the saved queries"""
+    with click.progressbar(length=0, label="Embedding queries") as bar:
+
+        def progress(done, total):
+            bar.length = total
+            bar.update(done - bar.pos)
+
+        done = backfill_embeddings(
+            g.session,
+            database_ids,
+            batch_size=batch_size,
+            concurrency=concurrency,
+            rate_limit=rate_limit,
+            force=force,
+            progress=progress,
         )
-    )
-    total = queries.count()
-    click.echo(f"Found {total} queries to process.")
-    # progress bar
-    with click.progressbar(queries, length=total) as bar:
-        for query in bar:
-            query.embedding = generate_embedding(query.query)
-        g.session.commit()
-    click.echo("Query embeddings have been processed.")
+    click.echo(f"{done} query embeddings have been processed.")
 
 
 @chat_cli.cli.command("search-query")
@@ -39,3 +61,10 @@ def search_query(query):
     # queries = Query.memory_search(session, "select * from users")
     for query in queries:
         print(query.query)
+
+
+@chat_cli.cli.command("download-chart-assets")
+def download_chart_assets():
+    """Copy the FusionCharts scripts locally, used to render the charts"""
+    download_assets()
+    click.echo(f"FusionCharts scripts downloaded in {FUSIONCHARTS_DIR}")
@@ -1,18 +1,28 @@
+import copy
 import json
 import os
-import requests
+import textwrap
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
 import yaml
 from autochat import Autochat, Message
 from autochat.chat import StopLoopException
-from back.datalake import DatalakeFactory
+from autochat.utils import parse_chat_template
+from back.datalake import DatalakeRegistry
 from back.models import Conversation, ConversationMessage, Query
-from chat.dbt_utils import DBT
+from chat.chart_samples import fetch_chart_code_sample
+from chat.dbt_utils import load_dbt
 from chat.lock import StopException
 from chat.memory_utils import find_closest_embeddings
 from chat.render import render_chart
+from chat.schema_context import load_schema_context
 from chat.sql_utils import run_sql
+from chat.turns import turn_registry
 from chat.notes import Notes
 from PIL import Image as PILImage
+from sqlalchemy.orm import undefer
 import io
 
 
@@ -25,6 +35,85 @@ for filename in os.listdir(functions_path):
         FUNCTIONS[filename[:-5]] = json.load(f)
 
 AUTOCHAT_PROVIDER = os.getenv("AUTOCHAT_PROVIDER", "openai")
+CHAT_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "chat_template.txt")
+# Messages sent to the chatbot, the older ones are summarized in the context
+MESSAGE_WINDOW = int(os.getenv("CHAT_MESSAGE_WINDOW", 40))
+SUMMARY_MESSAGES = 50  # Older questions and answers kept in the summary
+SUMMARY_MESSAGE_LENGTH = 300  # characters
+# Conversations whose converted messages are kept between the turns
+MESSAGE_CACHE_SIZE = int(os.getenv("CHAT_MESSAGE_CACHE_SIZE", 100))
+# Saved queries similar to the question, added to the context (0 to disable)
+# Opt-in: the question of each turn is embedded, see chat.embeddings
+SIMILAR_QUERIES = int(os.getenv("CHAT_SIMILAR_QUERIES", 0))
+SUMMARY_TEMPLATE = """
+EARLIER_MESSAGES: (summary of the beginning of the conversation)
+{messages}
+"""
+
+
+@lru_cache(maxsize=None)
+def load_chat_template(path=CHAT_TEMPLATE_PATH):
+    """Instruction and examples of the template, parsed once per process"""
+    return parse_chat_template(path)
+
+
+def window_start(roles):
+    """
+    Index of the first message of the window, so it starts with a question
+    and function results are never separated from their call
+    """
+    for accepted in (("user",), ("user", "assistant")):
+        for index, role in enumerate(roles):
+            if role in accepted:
+                return index
+    return 0
+
+
+class Chatbot(Autochat):
+    def prepare_messages(self, *args, **kwargs):
+        # Autochat adds the context to the first message in place, which would
+        # repeat it on each call: work on a copy, so messages can be reused
+        first_message = self.messages[0]
+        self.messages[0] = copy.deepcopy(first_message)
+        try:
+            return super().prepare_messages(*args, **kwargs)
+        finally:
+            self.messages[0] = first_message
+
+
+class MessageCache:
+    """
+    Autochat messages of the last conversations, by ConversationMessage id
+    Kept between the turns, so only the messages added since the last turn
+    are fetched and converted
+    """
+
+    def __init__(self, size=MESSAGE_CACHE_SIZE):
+        self.size = size
+        self.conversations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, conversation_id):
+        with self.lock:
+            messages = self.conversations.get(conversation_id)
+            if messages is None:
+                return {}
+            self.conversations.move_to_end(conversation_id)
+            return messages
+
+    def set(self, conversation_id, messages):
+        with self.lock:
+            self.conversations[conversation_id] = messages
+            self.conversations.move_to_end(conversation_id)
+            while len(self.conversations) > self.size:
+                self.conversations.popitem(last=False)
+
+    def invalidate(self, conversation_id):
+        with self.lock:
+            self.conversations.pop(conversation_id, None)
+
+
+message_cache = MessageCache()
 
 
 def python_transform(code, result):
@@ -41,12 +130,6 @@ def python_transform(code, result):
     return local_namespace.get("processed_result")
 
 
-def fetch_chart_code_sample(chart_type: str) -> str:
-    return requests.get(
-        f"https://www.fusioncharts.com/dev/portal/attribute/{chart_type.lower()}/code"
-    ).json()["json"]
-
-
 class DatabaseChat:
     """
     Chatbot assistant with a database, execute functions.
@@ -60,7 +143,7 @@ class DatabaseChat:
         session,
         database_id,
         conversation_id=None,
-        stop_flags={},
+        turns=turn_registry,
         model=None,
         project_id=None,
     ):
@@ -75,25 +158,23 @@ class DatabaseChat:
                 self.session.query(Conversation).filter_by(id=conversation_id).first()
             )
 
-        # Add a datalake object to the request
-        self.datalake = DatalakeFactory.create(
-            self.conversation.database.engine,
-            **self.conversation.database.details,
-        )
-        self.stop_flags = stop_flags
+        # Datalakes are shared across turns, see DatalakeRegistry
+        self.datalake = DatalakeRegistry.get(self.conversation.database)
+        self.turns = turns
         self.model = model
-
-        self.dbt = None
-        if self.conversation.database.dbt_catalog:
-            self.dbt = DBT(
-                catalog=self.conversation.database.dbt_catalog,
-                manifest=self.conversation.database.dbt_manifest,
-            )
-
-    def __del__(self):
-        # On destruct, close the engine
-        if hasattr(self, "datalake"):
-            self.datalake.dispose()
+        self._chatbot = None
+        # Autochat messages by ConversationMessage id, converted once
+        self._messages = message_cache.get(self.conversation.id)
+        # Last question, the context is adapted to it, see ask
+        self.question = None
+        self.similar_queries = []
+
+        # Indexed once per catalog version, shared by the conversations
+        self.dbt = load_dbt(self.conversation.database)
+        # Compiled once per metadata version, shared by the conversations
+        self.schema = load_schema_context(
+            self.conversation.database, self.conversation.project
+        )
 
     def _create_conversation(self, databaseId, name=None, project_id=None):
         # Create conversation object
@@ -108,9 +189,18 @@ class DatabaseChat:
         return conversation
 
     def check_stop_flag(self):
-        if self.stop_flags.get(str(self.conversation.id)):
+        if self.turns.is_stopped(self.conversation.id):
             raise StopException("Query stopped by user")
 
+    def on_stop(self, callback):
+        """Call callback when the turn is stopped, eg. to cancel a running query"""
+        remove = self.turns.on_stop(self.conversation.id, callback)
+        if self.turns.is_stopped(self.conversation.id):
+            # Stopped before the callback was registered
+            remove()
+            callback()
+        return remove
+
     @property
     def context(self):
         context = {
@@ -120,6 +210,11 @@ class DatabaseChat:
             },
             "MEMORY": self.conversation.database.memory,
         }
+        if self.schema:
+            # The tables most relevant to the question, within a token budget
+            context["SCHEMA"] = self.schema.compile(self.question)
+        if self.similar_queries:
+            context["SIMILAR_QUERIES"] = self.similar_queries
         if self.conversation.project:
             context["PROJECT"] = {
                 "name": self.conversation.project.name,
@@ -134,12 +229,18 @@ class DatabaseChat:
 
     @property
     def chatbot(self):
-        messages = [m.to_autochat_message() for m in self.conversation.messages]
-        chatbot = Autochat.from_template(
-            os.path.join(os.path.dirname(__file__), "..", "chat", "chat_template.txt"),
+        """Built on first use, then kept for the life of the conversation"""
+        if self._chatbot is None:
+            self._chatbot = self._build_chatbot()
+        return self._chatbot
+
+    def _build_chatbot(self):
+        instruction, examples = load_chat_template()
+        chatbot = Chatbot(
+            instruction=instruction,
+            examples=list(examples),
             provider=AUTOCHAT_PROVIDER,
             context=self.context,
-            messages=messages,
         )
         chatbot.add_function(self.sql_query, FUNCTIONS["SQL_QUERY"])
         chatbot.add_function(self.save_to_memory, FUNCTIONS["SAVE_TO_MEMORY"])
@@ -164,6 +265,78 @@ class DatabaseChat:
         chatbot.should_pause_conversation = message_is_answer
         return chatbot
 
+    def _window(self):
+        """Ids of the messages sent to the chatbot, and whether there are older ones"""
+        rows = (
+            self.session.query(ConversationMessage.id, ConversationMessage.role)
+            .filter(ConversationMessage.conversationId == self.conversation.id)
+            .order_by(ConversationMessage.id.desc())
+            .limit(MESSAGE_WINDOW + 1)
+            .all()
+        )[::-1]
+        if len(rows) <= MESSAGE_WINDOW:
+            return [row.id for row in rows], False
+        rows = rows[1:]
+        rows = rows[window_start([row.role for row in rows]) :]
+        return [row.id for row in rows], True
+
+    def _fetch_messages(self, ids):
+        return (
+            self.session.query(ConversationMessage)
+            .options(undefer(ConversationMessage.image))
+            .filter(ConversationMessage.id.in_(ids))
+            .all()
+        )
+
+    def _summary(self, before_id):
+        """Questions and answers before the window, shortened"""
+        rows = (
+            self.session.query(ConversationMessage.role, ConversationMessage.content)
+            .filter(
+                ConversationMessage.conversationId == self.conversation.id,
+                ConversationMessage.id < before_id,
+                ConversationMessage.role.in_(["user", "assistant"]),
+                ConversationMessage.content.isnot(None),
+            )
+            .order_by(ConversationMessage.id.desc())
+            .limit(SUMMARY_MESSAGES)
+            .all()
+        )[::-1]
+        messages = "\n".join(
+            f"- {role}: "
+            + textwrap.shorten(content, SUMMARY_MESSAGE_LENGTH, placeholder="...")
+            for role, content in rows
+            if content.strip()
+        )
+        return SUMMARY_TEMPLATE.format(messages=messages)
+
+    def _load_messages(self):
+        """
+        Load the last messages of the conversation in the chatbot, only the
+        messages added since the last turn are fetched and converted
+        """
+        ids, has_older = self._window()
+        new_ids = [id for id in ids if id not in self._messages]
+        if new_ids:
+            # Images are deferred, fetch them with the messages
+            for m in self._fetch_messages(new_ids):
+                self._messages[m.id] = m.to_autochat_message()
+        # Forget the messages out of the window
+        self._messages = {id: self._messages[id] for id in ids}
+        message_cache.set(self.conversation.id, self._messages)
+        self.chatbot.load_messages([self._messages[id] for id in ids])
+
+        # The memory may have changed since the chatbot was built
+        context = self.context
+        if has_older:
+            context += self._summary(ids[0])
+        self.chatbot.context = context
+
+    def forget_messages(self):
+        """The messages were changed or deleted, convert them again"""
+        message_cache.invalidate(self.conversation.id)
+        self._messages = {}
+
     def sql_query(
         self, query: str = "", name: str = None, from_response: Message = None
     ):
@@ -173,13 +346,14 @@ class DatabaseChat:
             sql=query,
         )
         self.session.add(_query)
-        self.session.commit()
+        # Assign the id, no transaction is kept open while the query runs
+        self._commit()
 
         if from_response:
             # We update the message with the query id
             from_response.query_id = _query.id
 
-        output, _ = run_sql(self.datalake, query)
+        output, _ = run_sql(self.datalake, query, query=_query, on_stop=self.on_stop)
         return output
 
     def save_to_memory(self, text: str):
@@ -195,8 +369,11 @@ class DatabaseChat:
             databaseId=self.conversation.databaseId,
             sql=query,
         )
+        # Record the result, so the answer can be displayed without running it
+        # (usually served by the query cache, as the query was just tested)
+        run_sql(self.datalake, query, query=_query, on_stop=self.on_stop)
         self.session.add(_query)
-        self.session.commit()
+        self.session.flush()
 
         # We update the message with the query id
         from_response.query_id = _query.id
@@ -214,7 +391,7 @@ class DatabaseChat:
     ):
         """TODO: add verification on the widget parameters and the sql query"""
         # Execute SQL query
-        rows, _ = self.datalake.query(sql)
+        rows, _ = self.datalake.query(sql, on_stop=self.on_stop)
 
         if data_preprocessing:
             # Fields can be "data", "categories", "dataset", ..
@@ -251,21 +428,76 @@ class DatabaseChat:
             image=image,
         )
 
-    def _run_conversation(self):
-        # Message
-        messages = [m.to_autochat_message() for m in self.conversation.messages]
-        self.chatbot.load_messages(messages)
-        for m in self.chatbot.run_conversation():
-            self.check_stop_flag()
-            message = ConversationMessage.from_autochat_message(m)
-            message.conversationId = self.conversation.id
+    def _save_messages(self, pending):
+        """Commit the messages at once, ids are assigned in order"""
+        for m, message in pending:
             self.session.add(message)
+        self._commit()
+        for m, message in pending:
+            # Already an autochat message, no need to convert it on the next turn
+            self._messages[message.id] = m
+        return [message for _, message in pending]
+
+    def _commit(self):
+        try:
             self.session.commit()
-            yield message
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def _run_conversation(self):
+        """
+        Messages are committed as they come, no transaction is kept open
+        during the model calls
+        """
+        pending = []
+        try:
+            self._load_messages()
+            # End the transaction of the reads before the model call
+            self._commit()
+            for m in self.chatbot.run_conversation():
+                self.check_stop_flag()
+                message = ConversationMessage.from_autochat_message(m)
+                message.conversationId = self.conversation.id
+                pending.append((m, message))
+                if any(part.type == "function_call" for part in m.parts):
+                    # The function result is yielded right after its call,
+                    # insert both at once
+                    continue
+                messages, pending = self._save_messages(pending), []
+                yield from messages
+            if pending:
+                messages, pending = self._save_messages(pending), []
+                yield from messages
+        finally:
+            if pending:
+                self._save_messages(pending)
+            self._commit()
+
+    def find_similar_queries(self, question):
+        """Saved queries of the database with a question close to this one"""
+        if not SIMILAR_QUERIES:
+            return []
+        try:
+            # In a savepoint, a failed search doesn't abort the turn
+            with self.session.begin_nested():
+                queries = find_closest_embeddings(
+                    self.session,
+                    question,
+                    self.conversation.databaseId,
+                    top_n=SIMILAR_QUERIES,
+                )
+        except Exception as e:
+            # eg. the embedding provider is unavailable
+            print(f"Similar queries not available: {e}")
+            return []
+        return [{"question": query.query, "sql": query.sql} for query in queries]
 
     def ask(self, question: str):
         if not self.conversation.name:
             self.conversation.name = question
+        self.question = question
+        self.similar_queries = self.find_similar_queries(question)
 
         # If message is instance of string, then convert to ConversationMessage
         message = ConversationMessage(
@@ -274,7 +506,8 @@ class DatabaseChat:
             conversationId=self.conversation.id,
         )
         self.session.add(message)
-        self.session.commit()
+        # Before the model call, see _run_conversation
+        self._commit()
         yield message
 
         yield from self._run_conversation()
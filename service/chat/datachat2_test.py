@@ -2,7 +2,9 @@ import json
 from unittest.mock import Mock, patch
 
 import pytest
-from chat.datachat import DatabaseChat, python_transform
+from autochat import Message
+from chat.datachat import DatabaseChat, python_transform, window_start
+from chat.turns import MemoryTurnRegistry
 
 
 @pytest.fixture
@@ -17,6 +19,7 @@ def database_chat():
     mock_conversation = Mock()
     mock_conversation.database = mock_database
     mock_conversation.database.dbt_catalog = {}
+    mock_conversation.database.tables_metadata = []
     # Create a DatabaseChat instance with mocked dependencies
     with patch.object(DatabaseChat, "_create_conversation") as mock_create_conversation:
         mock_create_conversation.return_value = mock_conversation
@@ -238,3 +241,97 @@ processed_result = df.groupby(['date', 'category'])['value'].sum().reset_index()
     assert processed_result[1]["value"] == 150.0
     assert processed_result[2]["value"] == 120.0
     assert processed_result[3]["value"] == 180.0
+
+
+def test_chatbot_is_built_once(database_chat, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    database_chat.conversation.database.name = "test"
+    database_chat.conversation.database.memory = None
+    database_chat.conversation.project = None
+    message = Mock(
+        id=1, to_autochat_message=Mock(return_value=Message("user", "Hello"))
+    )
+    chatbot = database_chat.chatbot
+    assert database_chat.chatbot is chatbot
+
+    with patch.object(
+        database_chat, "_window", return_value=([1], False)
+    ), patch.object(
+        database_chat, "_fetch_messages", return_value=[message]
+    ) as fetch_messages:
+        database_chat._load_messages()
+        database_chat._load_messages()
+    fetch_messages.assert_called_once_with([1])
+    message.to_autochat_message.assert_called_once()
+
+    # The context is not added to the stored message
+    chatbot.prepare_messages(lambda m: m.content)
+    chatbot.prepare_messages(lambda m: m.content)
+    assert chatbot.messages[0].content == "Hello"
+
+
+def test_messages_are_converted_once_per_conversation(database_chat):
+    conversation = database_chat.conversation
+    conversation.id = 7
+    conversation.database.name = "test"
+    conversation.database.memory = None
+    conversation.project = None
+    messages = {
+        id: Mock(id=id, to_autochat_message=Mock(return_value=Message("user", str(id))))
+        for id in (1, 2)
+    }
+
+    def turn(ids):
+        # Each turn has its own DatabaseChat
+        with patch.object(
+            DatabaseChat, "_create_conversation", return_value=conversation
+        ):
+            chat = DatabaseChat(Mock(), "test_db_id")
+        chat._chatbot = Mock()
+        with patch.object(chat, "_window", return_value=(ids, False)), patch.object(
+            chat, "_fetch_messages", side_effect=lambda new: [messages[i] for i in new]
+        ) as fetch_messages:
+            chat._load_messages()
+        return chat, fetch_messages
+
+    turn([1])
+    chat, fetch_messages = turn([1, 2])
+    fetch_messages.assert_called_once_with([2])
+    messages[1].to_autochat_message.assert_called_once()
+
+    # eg. after a regeneration
+    chat.forget_messages()
+    _, fetch_messages = turn([1, 2])
+    fetch_messages.assert_called_once_with([1, 2])
+
+
+def test_window_start():
+    # The window starts with a question, never with a function result
+    assert window_start(["function", "assistant", "user", "assistant"]) == 2
+    assert window_start(["function", "assistant", "function"]) == 1
+    assert window_start(["function"]) == 0
+
+
+def test_run_conversation_commits_each_message(database_chat):
+    call = Message(
+        role="assistant",
+        function_call={"name": "SQL_QUERY", "arguments": {"query": "SELECT 1"}},
+        function_call_id="call-1",
+    )
+    result = Message(role="function", name="SQL_QUERY", content="1")
+    answer = Message(role="assistant", content="One")
+    database_chat.conversation.id = 1
+    database_chat.turns = MemoryTurnRegistry()
+    database_chat._chatbot = Mock()
+    database_chat._chatbot.run_conversation.return_value = iter([call, result, answer])
+    session = database_chat.session
+    session.reset_mock()
+
+    commits = []
+    with patch.object(database_chat, "_load_messages"):
+        for message in database_chat._run_conversation():
+            commits.append((message.role, session.commit.call_count))
+
+    # The reads are committed before the model call, then each message is
+    # committed when yielded, the function call and its result together
+    assert commits == [("assistant", 2), ("function", 2), ("assistant", 3)]
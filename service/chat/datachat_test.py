@@ -11,8 +11,6 @@ TEST_DATABASE_URL = "postgresql://localhost/adatest"
 class TestDatabase(unittest.TestCase):
     @patch.dict(os.environ, {"DATABASE_URL": TEST_DATABASE_URL})
     def setUp(self):
-        self.stop_flags = {}  # TODO: remove ?
-
         from back.models import Database, User
         from back.session import setup_database
 
@@ -75,7 +73,6 @@ class TestDatabase(unittest.TestCase):
             chat = datachat.DatabaseChat(
                 self.session,
                 self.database_id,
-                stop_flags=self.stop_flags,
             )
 
             results = list(chat.ask("How many tables are there ?"))
@@ -119,7 +116,6 @@ class TestDatabase(unittest.TestCase):
                 chat = datachat.DatabaseChat(
                     self.session,
                     self.database_id,
-                    stop_flags=self.stop_flags,
                 )
 
                 results = list(chat.ask("How many cars are blue?"))
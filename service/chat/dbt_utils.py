@@ -1,4 +1,23 @@
 import json
+import math
+import os
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict
+
+from back.models import Database
+
+DBT_CACHE_SIZE = int(os.getenv("DBT_CACHE_SIZE", 16))  # Databases kept in memory
+SEARCH_PAGE_SIZE = 10
+MODEL_LIST_PAGE_SIZE = 100
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Weight of the tokens of each field of a model
+FIELD_WEIGHTS = {"name": 3, "columns": 2, "description": 1}
+
+TOKEN_REGEX = re.compile(r"[a-z0-9]+")
 
 
 def read_json(file_path):
@@ -6,6 +25,66 @@ def read_json(file_path):
         return json.load(file)
 
 
+def tokenize(text):
+    """eg. "model.shop.fct_Orders" -> ["model", "shop", "fct", "orders"]"""
+    return TOKEN_REGEX.findall((text or "").lower())
+
+
+class SearchIndex:
+    """
+    BM25 inverted index over documents made of weighted tokens
+    A query term missing from the index matches the terms it prefixes,
+    eg. "cust" matches "customer" and "customers"
+    """
+
+    def __init__(self, documents):
+        self.postings = defaultdict(list)  # term -> [(document, frequency)]
+        self.lengths = []
+        for index, tokens in enumerate(documents):
+            frequencies = Counter(tokens)
+            self.lengths.append(sum(frequencies.values()))
+            for term, frequency in frequencies.items():
+                self.postings[term].append((index, frequency))
+        self.size = len(self.lengths)
+        self.average_length = sum(self.lengths) / self.size if self.size else 0
+        self.terms = sorted(self.postings)
+
+    def idf(self, term):
+        count = len(self.postings[term])
+        return math.log(1 + (self.size - count + 0.5) / (count + 0.5))
+
+    def expand(self, term):
+        if term in self.postings:
+            return [term]
+        start = bisect_left(self.terms, term)
+        expanded = []
+        for candidate in self.terms[start:]:
+            if not candidate.startswith(term):
+                break
+            expanded.append(candidate)
+        return expanded
+
+    def search(self, query):
+        """Return the (score, document) matching the query, best first"""
+        scores = defaultdict(float)
+        for query_term in set(tokenize(query)):
+            for term in self.expand(query_term):
+                idf = self.idf(term)
+                for document, frequency in self.postings[term]:
+                    norm = (
+                        1
+                        - BM25_B
+                        + BM25_B * (self.lengths[document] / self.average_length)
+                    )
+                    scores[document] += (
+                        idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * norm)
+                    )
+        return sorted(
+            ((score, document) for document, score in scores.items()),
+            key=lambda item: (-item[0], item[1]),
+        )
+
+
 class DBT:
     def __init__(self, catalog: dict, manifest: dict):
         self.catalog = catalog["sources"] | catalog["nodes"]
@@ -22,6 +101,25 @@ class DBT:
             model["description"] = (
                 model["metadata"]["comment"] or model["manifest"]["description"] or ""
             )
+        self.index = SearchIndex(self._document(model) for model in self.models)
+
+    @staticmethod
+    def _document(model):
+        fields = {
+            "name": tokenize(model["key"]),
+            "columns": [
+                token
+                for name, column in (model.get("columns") or {}).items()
+                for token in tokenize(name) + tokenize(column.get("comment"))
+            ],
+            "description": tokenize(model["description"]),
+        }
+        return [
+            token
+            for field, tokens in fields.items()
+            for token in tokens
+            for _ in range(FIELD_WEIGHTS[field])
+        ]
 
     @classmethod
     def from_directory(cls, directory: str):
@@ -29,31 +127,108 @@ class DBT:
         manifest = read_json(directory + "/manifest.json")
         return cls(catalog, manifest)
 
-    def fetch_model_list(self):
-        """Return a list of models in the DBT catalog.
-        Return: key, description
+    def fetch_model_list(self, offset: int = 0, limit: int = MODEL_LIST_PAGE_SIZE):
+        """Return a page of the models in the DBT catalog.
+        Return: total, models (key, description)
         """
-        return [
-            {
-                "key": model["key"],
-                "description": model["description"],
-            }
-            for model in self.models
-        ]
+        return {
+            "total": len(self.models),
+            "models": [
+                {
+                    "key": model["key"],
+                    "description": model["description"],
+                }
+                for model in self.models[offset : offset + limit]
+            ],
+        }
 
-    def search_models(self, query: str):
-        """Search for a model in the DBT catalog.
-        Return: key, description
+    def search_models(self, query: str, offset: int = 0, limit: int = SEARCH_PAGE_SIZE):
+        """Search models of the DBT catalog by name, description and columns.
+        Return: total, models (key, description), best matches first
         """
-        return [
-            {
-                "key": model["key"],
-                "description": model["description"],
-            }
-            for model in self.models
-            if query in model["key"] or query in model["description"]
-        ]
+        results = self.index.search(query)
+        return {
+            "total": len(results),
+            "models": [
+                {
+                    "key": self.models[document]["key"],
+                    "description": self.models[document]["description"],
+                }
+                for _, document in results[offset : offset + limit]
+            ],
+        }
 
     def fetch_model(self, key: str):
         """Fetch all model details from the DBT catalog."""
         return self.catalog[key]
+
+
+def catalog_version(database):
+    """Changes when new dbt artifacts are uploaded"""
+    metadata = database.dbt_catalog.get("metadata") or {}
+    return (
+        metadata.get("invocation_id")
+        or metadata.get("generated_at")
+        or str(database.updatedAt)
+    )
+
+
+dbt_cache = OrderedDict()  # database id -> (catalog version, DBT)
+dbt_cache_lock = threading.Lock()
+
+
+def load_dbt(database):
+    """DBT of a database, built once per catalog version and shared"""
+    if not database.dbt_catalog:
+        return None
+    version = catalog_version(database)
+    with dbt_cache_lock:
+        entry = dbt_cache.get(database.id)
+        if entry is not None and entry[0] == version:
+            dbt_cache.move_to_end(database.id)
+            return entry[1]
+
+    parsed = getattr(database, "dbt_parsed", None)
+    if parsed and parsed.get("version") == version:
+        # Smaller, see parse_artifacts
+        dbt = DBT(catalog=parsed["catalog"], manifest=parsed["manifest"])
+    else:
+        dbt = DBT(catalog=database.dbt_catalog, manifest=database.dbt_manifest)
+    with dbt_cache_lock:
+        dbt_cache[database.id] = (version, dbt)
+        dbt_cache.move_to_end(database.id)
+        while len(dbt_cache) > DBT_CACHE_SIZE:
+            dbt_cache.popitem(last=False)
+    return dbt
+
+
+def parse_artifacts(session, job, progress):
+    """
+    Job: check the dbt artifacts of a database, and store the parts used by
+    DBT in dbt_parsed (the manifest also has the macros, docs, compiled code...)
+    The uploaded artifacts are kept as is
+    """
+    database = session.query(Database).filter_by(id=job.databaseId).first()
+    if database is None:
+        raise ValueError(f"Database {job.databaseId} not found")
+    if not database.dbt_catalog:
+        database.dbt_parsed = None
+        return
+    # Raise on invalid artifacts, eg. a manifest not matching the catalog
+    dbt = DBT(catalog=database.dbt_catalog, manifest=database.dbt_manifest)
+    database.dbt_parsed = {
+        "version": catalog_version(database),
+        "catalog": {
+            "sources": database.dbt_catalog["sources"],
+            "nodes": database.dbt_catalog["nodes"],
+        },
+        "manifest": {
+            section: {
+                key: node
+                for key, node in database.dbt_manifest[section].items()
+                if key in dbt.catalog
+            }
+            for section in ("sources", "nodes")
+        },
+    }
+    progress(len(dbt.models), len(dbt.models))
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from chat.dbt_utils import DBT, dbt_cache, load_dbt, parse_artifacts
+
+
+def make_model(comment=None, columns=()):
+    return {
+        "metadata": {"comment": comment},
+        "columns": {name: {"name": name, "comment": None} for name in columns},
+    }
+
+
+CATALOG = {
+    "metadata": {"invocation_id": "run-1"},
+    "sources": {
+        "source.shop.raw_orders": make_model(columns=["id", "customer_id"]),
+    },
+    "nodes": {
+        "model.shop.customers": make_model("One row per customer", ["id", "email"]),
+        "model.shop.fct_orders": make_model(
+            "Orders with their amount", ["order_id", "customer_id", "amount"]
+        ),
+        "model.shop.stg_payments": make_model(None, ["payment_id", "amount"]),
+    },
+}
+MANIFEST = {
+    "sources": {"source.shop.raw_orders": {"description": "Orders from the shop"}},
+    "nodes": {
+        "model.shop.customers": {"description": ""},
+        "model.shop.fct_orders": {"description": ""},
+        "model.shop.stg_payments": {"description": "Payments of the orders"},
+    },
+}
+
+
+def test_search_models_ranking():
+    dbt = DBT(CATALOG, MANIFEST)
+    result = dbt.search_models("Orders")
+    keys = [model["key"] for model in result["models"]]
+    # Matches in the name rank first, search is case insensitive
+    assert set(keys[:2]) == {"model.shop.fct_orders", "source.shop.raw_orders"}
+    assert result["total"] == 3
+
+    # Column names, prefixes
+    result = dbt.search_models("payment amount")
+    assert result["models"][0]["key"] == "model.shop.stg_payments"
+    assert dbt.search_models("cust")["total"] == 3
+    assert dbt.search_models("unknown") == {"total": 0, "models": []}
+
+
+def test_search_models_pagination():
+    dbt = DBT(CATALOG, MANIFEST)
+    first = dbt.search_models("orders", limit=1)
+    second = dbt.search_models("orders", offset=1, limit=1)
+    assert len(first["models"]) == len(second["models"]) == 1
+    assert first["models"] != second["models"]
+    assert dbt.fetch_model_list(offset=4)["models"] == []
+
+
+def test_load_dbt_is_cached_per_version():
+    dbt_cache.clear()
+    database = SimpleNamespace(
+        id=1, dbt_catalog=CATALOG, dbt_manifest=MANIFEST, updatedAt=None
+    )
+    dbt = load_dbt(database)
+    assert load_dbt(database) is dbt
+
+    database.dbt_catalog = {**CATALOG, "metadata": {"invocation_id": "run-2"}}
+    assert load_dbt(database) is not dbt
+    assert load_dbt(SimpleNamespace(id=2, dbt_catalog=None)) is None
+
+
+def test_parse_artifacts_keeps_the_uploaded_artifacts():
+    dbt_cache.clear()
+    manifest = {**MANIFEST, "macros": {"macro.shop.cents": {}}}
+    database = SimpleNamespace(
+        id=1, dbt_catalog=CATALOG, dbt_manifest=manifest, updatedAt=None
+    )
+    session = Mock()
+    session.query.return_value.filter_by.return_value.first.return_value = database
+    parse_artifacts(session, SimpleNamespace(databaseId=1), Mock())
+    assert database.dbt_catalog is CATALOG and database.dbt_manifest is manifest
+    assert database.dbt_parsed["version"] == "run-1"
+    assert "macros" not in database.dbt_parsed["manifest"]
+    assert len(load_dbt(database).models) == 4
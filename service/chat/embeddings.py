@@ -0,0 +1,186 @@
+"""
+Embedding providers, used to find the saved queries similar to a question.
+- openai: OpenAI embeddings API
+- local: a sentence-transformers model, run in-process
+- hashing: hashed word and trigram counts, no model nor network needed
+Vectors are padded to EMBEDDING_DIM, the size of Query.embedding (zeros don't
+change the distances). Embeddings of different providers can't be compared:
+recompute them after switching.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import numpy as np
+
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")  # Default model of the provider
+EMBEDDING_DIM = 1536
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 1024))  # Texts
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+
+class EmbeddingProvider(ABC):
+    name = None
+
+    def __init__(self, model=None):
+        self.model = model
+
+    @abstractmethod
+    def embed(self, texts):
+        """Return one vector per text"""
+        pass
+
+
+class OpenAIEmbeddings(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(self, model=None):
+        from openai import OpenAI
+
+        self.model = model or "text-embedding-ada-002"
+        self.client = OpenAI()
+
+    def embed(self, texts):
+        response = self.client.embeddings.create(input=texts, model=self.model)
+        data = sorted(response.data, key=lambda item: item.index)
+        return [pad(item.embedding) for item in data]
+
+
+class LocalEmbeddings(EmbeddingProvider):
+    name = "local"
+
+    def __init__(self, model=None):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError(
+                "EMBEDDING_PROVIDER=local requires sentence-transformers: "
+                "pip install sentence-transformers"
+            )
+        self.model = SentenceTransformer(model or "all-MiniLM-L6-v2")
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), normalize_embeddings=True)
+        return [pad(vector) for vector in vectors]
+
+
+class HashingEmbeddings(EmbeddingProvider):
+    """Words and character trigrams hashed in EMBEDDING_DIM buckets"""
+
+    name = "hashing"
+
+    def embed(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def _embed(self, text):
+        vector = np.zeros(EMBEDDING_DIM)
+        for word in TOKEN_REGEX.findall(text.lower()):
+            padded = f" {word} "
+            features = [word] + [padded[i : i + 3] for i in range(len(padded) - 2)]
+            for feature in features:
+                digest = hashlib.md5(feature.encode()).digest()
+                bucket = int.from_bytes(digest[:4], "little") % EMBEDDING_DIM
+                vector[bucket] += 1 if digest[4] % 2 else -1
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+
+PROVIDERS = {
+    provider.name: provider
+    for provider in (OpenAIEmbeddings, LocalEmbeddings, HashingEmbeddings)
+}
+
+
+def pad(vector):
+    vector = list(map(float, vector))
+    if len(vector) > EMBEDDING_DIM:
+        raise ValueError(f"Embeddings can't have more than {EMBEDDING_DIM} values")
+    return vector + [0.0] * (EMBEDDING_DIM - len(vector))
+
+
+class CachedEmbeddings:
+    """Keep the embeddings of the last texts, eg. repeated questions"""
+
+    def __init__(self, provider, size=EMBEDDING_CACHE_SIZE):
+        self.provider = provider
+        self.size = size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.provider.name
+
+    def embed(self, texts):
+        texts = list(texts)
+        vectors = {}
+        with self.lock:
+            for text in texts:
+                if text in self.cache:
+                    self.cache.move_to_end(text)
+                    vectors[text] = self.cache[text]
+        missing = list(dict.fromkeys(t for t in texts if t not in vectors))
+        if missing:
+            # One request for all the missing texts
+            for text, vector in zip(missing, self.provider.embed(missing)):
+                vectors[text] = vector
+            with self.lock:
+                for text in missing:
+                    self.cache[text] = vectors[text]
+                while len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+        return [vectors[text] for text in texts]
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_provider():
+    """Provider set by EMBEDDING_PROVIDER, created on first use"""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            if EMBEDDING_PROVIDER not in PROVIDERS:
+                raise ValueError(f"Unknown embedding provider: {EMBEDDING_PROVIDER}")
+            provider = PROVIDERS[EMBEDDING_PROVIDER](EMBEDDING_MODEL)
+            _provider = CachedEmbeddings(provider)
+        return _provider
+
+
+def embed(texts, cache=True):
+    """Without cache, eg. for a backfill, the recent texts are kept cached"""
+    provider = get_provider()
+    return provider.embed(texts) if cache else provider.provider.embed(texts)
+
+
+def embedding_model():
+    """Provider and model of the embeddings, only the same ones are compared"""
+    return f"{EMBEDDING_PROVIDER}:{EMBEDDING_MODEL}"
+
+
+def text_hash(text):
+    """Changes with the text, the provider and its model, see Query.embeddingHash"""
+    return hashlib.sha256(f"{embedding_model()}:{text}".encode()).hexdigest()
+
+
+class RateLimiter:
+    """Space the calls shared by threads to at most `rate` per minute"""
+
+    def __init__(self, rate):
+        self.interval = 60 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            call = max(now, self.next_call)
+            self.next_call = call + self.interval
+        time.sleep(call - now)
@@ -0,0 +1,58 @@
+from unittest.mock import Mock
+
+import numpy as np
+from chat.embeddings import (
+    EMBEDDING_DIM,
+    CachedEmbeddings,
+    HashingEmbeddings,
+    embedding_model,
+    pad,
+    text_hash,
+)
+
+
+def test_hashing_embeddings_similarity():
+    provider = HashingEmbeddings()
+    revenue, revenue_month, users = map(
+        np.array,
+        provider.embed(
+            [
+                "total revenue by country",
+                "total revenue by country per month",
+                "number of active users",
+            ]
+        ),
+    )
+    assert revenue.shape == (EMBEDDING_DIM,)
+    assert np.isclose(np.linalg.norm(revenue), 1)
+    assert np.linalg.norm(revenue - revenue_month) < np.linalg.norm(revenue - users)
+
+
+def test_cached_embeddings():
+    provider = Mock()
+    provider.embed.side_effect = lambda texts: [[len(text)] for text in texts]
+    cached = CachedEmbeddings(provider, size=2)
+
+    assert cached.embed(["a", "bb", "a"]) == [[1], [2], [1]]
+    provider.embed.assert_called_once_with(["a", "bb"])
+    assert cached.embed(["bb"]) == [[2]]
+    assert provider.embed.call_count == 1
+
+    # "a" is the least recently used, evicted
+    cached.embed(["ccc"])
+    assert list(cached.cache) == ["bb", "ccc"]
+
+
+def test_pad():
+    assert pad([1, 2]) == [1.0, 2.0] + [0.0] * (EMBEDDING_DIM - 2)
+
+
+def test_text_hash(monkeypatch):
+    assert text_hash("total revenue") == text_hash("total revenue")
+    assert text_hash("total revenue") != text_hash("total revenues")
+    # Embedded again with another model
+    previous = text_hash("total revenue")
+    model = embedding_model()
+    monkeypatch.setattr("chat.embeddings.EMBEDDING_MODEL", "text-embedding-3-large")
+    assert text_hash("total revenue") != previous
+    assert embedding_model() != model
@@ -1,10 +1,8 @@
-from threading import Lock
+from uuid import uuid4
 
+from chat.turns import turn_registry
 from flask_socketio import emit
 
-conversation_stop_flags = {}
-stop_flag_lock = Lock()
-
 
 class StopException(Exception):
     pass
@@ -17,8 +15,8 @@ class STATUS:
     ERROR = "error"
 
 
-def emit_status(conversation_id, status, error=None):
-    emit(
+def emit_status(conversation_id, status, error=None, send=emit):
+    send(
         "status",
         {"conversation_id": conversation_id, "status": status, "error": str(error)},
     )
@@ -26,47 +24,42 @@ def emit_status(conversation_id, status, error=None):
 
 def handle_stop_flag(func):
     """
-    Decorator that handles the stop flag for a conversation.
+    Decorator that registers the turn of a conversation, see chat.turns
     Work like this:
-    - When a 'ask' event is received, we create a stop flag for the conversation
-    - When a 'stop' event is received, we set the stop flag to True
-    - When the query is done, we remove the stop flag
+    - When a 'ask' event is received, we start a turn for the conversation
+      (or re-emit the status if it is already running, in any process)
+    - When a 'stop' event is received, the turn is stopped
+    - When the query is done, the turn is finished
+    The function takes the emit function of the client and the conversation_id
+    as first arguments
     """
 
-    def wrapper(*args, **kwargs):
-        # Extract the conversation_id from the arguments
-        conversation_id = args[1] or "new"
-
-        # with stop_flag_lock:
-        #     # Avoid running the same query twice
-        #     if conversation_id in conversation_stop_flags:
-        #         # We re-emit the running status to the client
-        #         if conversation_stop_flags[conversation_id]:
-        #             emit_status(conversation_id, STATUS.TO_STOP)
-        #         else:
-        #             emit_status(conversation_id, STATUS.RUNNING)
-        #         return
-
-        # with stop_flag_lock:
-        #     # Remove the stop flag
-        #     del conversation_stop_flags[conversation_id]
-        #     emit_status(conversation_id, STATUS.RUNNING)
-
-        conversation_stop_flags[conversation_id] = False
-        emit_status(conversation_id, STATUS.RUNNING)
+    def wrapper(send, conversation_id, *args, **kwargs):
+        flag_id = conversation_id or "new"
+        # New conversations can't run twice
+        turn_id = str(conversation_id) if conversation_id else f"new-{uuid4()}"
+
+        if not turn_registry.start(turn_id):
+            # Avoid running the same query twice
+            # We re-emit the running status to the client
+            if turn_registry.is_stopped(turn_id):
+                emit_status(flag_id, STATUS.TO_STOP, send=send)
+            else:
+                emit_status(flag_id, STATUS.RUNNING, send=send)
+            return
+
+        emit_status(flag_id, STATUS.RUNNING, send=send)
         try:
-            res = func(*args, **kwargs)
+            res = func(send, conversation_id, *args, **kwargs)
         except StopException:
-            emit_status(conversation_id, STATUS.CLEAR)
+            emit_status(flag_id, STATUS.CLEAR, send=send)
         except Exception as e:
-            emit_status(conversation_id, STATUS.ERROR, e)
+            emit_status(flag_id, STATUS.ERROR, e, send=send)
             raise e
         else:
-            emit_status(conversation_id, STATUS.CLEAR)
+            emit_status(flag_id, STATUS.CLEAR, send=send)
         finally:
-            with stop_flag_lock:
-                # Remove the stop flag
-                del conversation_stop_flags[conversation_id]
+            turn_registry.finish(turn_id)
 
         return res
 
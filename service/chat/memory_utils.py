@@ -1,25 +1,165 @@
-import openai
+"""
+Search of the saved queries whose question is similar to a text.
+On Postgres, the search uses the pgvector HNSW index of query.embedding.
+Other databases (eg. SQLite) use an in-process index of the embeddings of
+each database, rebuilt when they change.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from back.models import Query
+from chat.embeddings import RateLimiter, embed, embedding_model, text_hash
+from sqlalchemy import func
+
+# Backfill of the embeddings, see backfill_embeddings
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 100))  # Texts/request
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 4))  # Requests
+EMBEDDING_RATE_LIMIT = int(os.getenv("EMBEDDING_RATE_LIMIT", 300))  # Requests/minute
 
 
 def generate_embedding(string):
-    response = openai.Embedding.create(input=string, model="text-embedding-ada-002")
-    # len => 1536
-    embedding = response["data"][0]["embedding"]
-    return embedding
+    # Cached, see chat.embeddings.CachedEmbeddings
+    return embed([string])[0]
 
 
-def find_closest_embeddings(session, query, top_n=5):
-    embedding = generate_embedding(query)
-    results = (
-        session.query(Query.query)
-        # With embedding not null
-        .filter(Query.embedding != None)
-        # TODO: Should be at least 80% similar
-        # .filter(func.similarity(func.array(Query.embedding), embedding) >= 0.8)
-        # .filter(Query.embedding.op("<->")(func.array(embedding)) <= 1)
-        .order_by(Query.embedding.op("<->")(embedding))
-        .limit(top_n)
+class VectorIndex:
+    """Embeddings of the saved queries of a database, searched in memory"""
+
+    def __init__(self, ids, vectors):
+        self.ids = list(ids)
+        self.matrix = np.array(vectors, dtype=np.float32)
+
+    def search(self, vector, top_n=5):
+        """Return the (id, distance) of the closest embeddings"""
+        if not self.ids:
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+        distances = np.linalg.norm(self.matrix - vector, axis=1)
+        top_n = min(top_n, len(self.ids))
+        closest = np.argpartition(distances, top_n - 1)[:top_n]
+        closest = closest[np.argsort(distances[closest])]
+        return [(self.ids[i], float(distances[i])) for i in closest]
+
+
+vector_indexes = {}  # database_id -> (version, VectorIndex)
+vector_indexes_lock = threading.Lock()
+
+
+def embedded_queries(session, database_id):
+    # Embeddings of another provider or model can't be compared
+    queries = session.query(Query).filter(
+        Query.embedding != None, Query.embeddingModel == embedding_model()
+    )
+    if database_id is not None:
+        queries = queries.filter(Query.databaseId == database_id)
+    return queries
+
+
+def load_vector_index(session, database_id):
+    # The version changes when an embedding is added, updated or removed
+    version = tuple(
+        embedded_queries(session, database_id)
+        .with_entities(func.count(Query.id), func.max(Query.updatedAt))
+        .one()
+    )
+    with vector_indexes_lock:
+        entry = vector_indexes.get(database_id)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+    rows = (
+        embedded_queries(session, database_id)
+        .with_entities(Query.id, Query.embedding)
         .all()
     )
-    return [r[0] for r in results]
+    index = VectorIndex([id for id, _ in rows], [vector for _, vector in rows])
+    with vector_indexes_lock:
+        vector_indexes[database_id] = (version, index)
+    return index
+
+
+def find_closest_embeddings(session, query, database_id=None, top_n=5):
+    """Saved queries (of a database) with the closest questions, closest first"""
+    embedding = generate_embedding(query)
+    if session.get_bind().dialect.name == "postgresql":
+        # Ordered by the HNSW index
+        return (
+            embedded_queries(session, database_id)
+            .order_by(Query.embedding.op("<->")(embedding))
+            .limit(top_n)
+            .all()
+        )
+
+    index = load_vector_index(session, database_id)
+    ids = [id for id, _ in index.search(embedding, top_n)]
+    queries = {q.id: q for q in session.query(Query).filter(Query.id.in_(ids))}
+    return [queries[id] for id in ids if id in queries]
+
+
+def outdated_embeddings(session, database_ids=None, force=False):
+    """
+    Id and question of the saved queries to embed: the ones without embedding,
+    or whose question (or the provider) changed since it was computed
+    """
+    queries = session.query(Query.id, Query.query, Query.embeddingHash).filter(
+        Query.query != None, Query.query != "", Query.query != "???"
+    )
+    if database_ids:
+        queries = queries.filter(Query.databaseId.in_(database_ids))
+    return [
+        (id, question)
+        for id, question, hash in queries.order_by(Query.id)
+        if force or hash != text_hash(question)
+    ]
+
+
+def backfill_embeddings(
+    session,
+    database_ids=None,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    concurrency=EMBEDDING_CONCURRENCY,
+    rate_limit=EMBEDDING_RATE_LIMIT,
+    force=False,
+    progress=None,
+):
+    """
+    Compute the outdated embeddings of the saved queries (of some databases)
+    Requests of batch_size texts are sent concurrently, at most rate_limit per
+    minute. Each round of requests is committed: an interrupted backfill
+    restarts where it stopped, the unchanged questions are skipped.
+    Return the number of embeddings computed
+    """
+    rows = outdated_embeddings(session, database_ids, force)
+    batches = [rows[i : i + batch_size] for i in range(0, len(rows), batch_size)]
+    limiter = RateLimiter(rate_limit)
+
+    def embed_batch(batch):
+        limiter.wait()
+        return embed([question for _, question in batch], cache=False)
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(batches), concurrency):
+            chunk = batches[start : start + concurrency]
+            for batch, vectors in zip(chunk, executor.map(embed_batch, chunk)):
+                for (id, question), vector in zip(batch, vectors):
+                    session.query(Query).filter_by(id=id).update(
+                        {
+                            Query.embedding: vector,
+                            Query.embeddingHash: text_hash(question),
+                            Query.embeddingModel: embedding_model(),
+                        },
+                        synchronize_session=False,
+                    )
+                done += len(batch)
+            session.commit()
+            if progress:
+                progress(done, len(rows))
+    return done
+
+
+def embed_queries(session, job, progress):
+    """Job: compute the outdated embeddings of the saved queries of a database"""
+    backfill_embeddings(session, [job.databaseId], progress=progress)
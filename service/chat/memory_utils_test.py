@@ -0,0 +1,42 @@
+from unittest.mock import Mock, call
+
+from chat import memory_utils
+from chat.memory_utils import VectorIndex
+
+
+def test_vector_index_search():
+    index = VectorIndex([10, 20, 30], [[0, 0], [1, 0], [5, 5]])
+    results = index.search([0.9, 0.1], top_n=2)
+    assert [id for id, _ in results] == [20, 10]
+    assert results[0][1] < results[1][1]
+    assert len(index.search([0, 0], top_n=10)) == 3
+
+
+def test_vector_index_empty():
+    assert VectorIndex([], []).search([0, 0]) == []
+
+
+def test_backfill_embeddings_commits_each_round(monkeypatch):
+    rows = [(id, f"question {id}") for id in range(1, 8)]
+    monkeypatch.setattr(memory_utils, "outdated_embeddings", lambda *args: rows)
+    requests = []
+
+    def embed(texts, cache=True):
+        assert not cache
+        requests.append(texts)
+        return [[len(text)] for text in texts]
+
+    monkeypatch.setattr(memory_utils, "embed", embed)
+    session = Mock()
+    progress = Mock()
+
+    done = memory_utils.backfill_embeddings(
+        session, batch_size=2, concurrency=2, rate_limit=0, progress=progress
+    )
+
+    assert done == 7
+    assert sorted(len(texts) for texts in requests) == [1, 2, 2, 2]
+    # 4 requests of 2 rows, in 2 rounds
+    assert session.commit.call_count == 2
+    assert progress.call_args_list == [call(4, 7), call(7, 7)]
+    assert session.query.return_value.filter_by.return_value.update.call_count == 7
@@ -0,0 +1,105 @@
+"""
+Bounded pool running the chat turns outside of the Socket.IO handlers.
+Turns are queued, then started when a worker is free and their user and
+database are under their concurrency limits.
+"""
+import os
+import threading
+from collections import Counter, deque, namedtuple
+
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", 8))
+CHAT_MAX_TURNS_PER_USER = int(os.getenv("CHAT_MAX_TURNS_PER_USER", 2))
+CHAT_MAX_TURNS_PER_DATABASE = int(os.getenv("CHAT_MAX_TURNS_PER_DATABASE", 4))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", 100))
+CHAT_MAX_QUEUE_PER_USER = int(os.getenv("CHAT_MAX_QUEUE_PER_USER", 5))
+
+Turn = namedtuple("Turn", ["user_id", "database_id", "func", "args"])
+
+
+class TurnRejected(Exception):
+    pass
+
+
+def start_thread(func, *args):
+    thread = threading.Thread(target=func, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class TurnPool:
+    def __init__(
+        self,
+        max_workers=CHAT_WORKERS,
+        max_per_user=CHAT_MAX_TURNS_PER_USER,
+        max_per_database=CHAT_MAX_TURNS_PER_DATABASE,
+        max_queue=CHAT_MAX_QUEUE,
+        max_queue_per_user=CHAT_MAX_QUEUE_PER_USER,
+        start=start_thread,
+    ):
+        self.max_workers = max_workers
+        self.max_per_user = max_per_user
+        self.max_per_database = max_per_database
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        # Starts a worker, eg. socketio.start_background_task (green threads)
+        self.start = start
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.running = 0
+        self.running_by_user = Counter()
+        self.running_by_database = Counter()
+
+    def submit(self, user_id, database_id, func, *args):
+        """Queue func(*args), raise TurnRejected if the queue is full"""
+        with self.lock:
+            if len(self.queue) >= self.max_queue:
+                raise TurnRejected("Too many requests, try again later")
+            queued = sum(1 for turn in self.queue if turn.user_id == user_id)
+            if queued >= self.max_queue_per_user:
+                raise TurnRejected("Too many requests in progress")
+            self.queue.append(Turn(user_id, database_id, func, args))
+        self._dispatch()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "queued": len(self.queue),
+                "runningByDatabase": dict(self.running_by_database),
+            }
+
+    def _can_start(self, turn):
+        return (
+            self.running < self.max_workers
+            and self.running_by_user[turn.user_id] < self.max_per_user
+            and self.running_by_database[turn.database_id] < self.max_per_database
+        )
+
+    def _dispatch(self):
+        started = []
+        with self.lock:
+            # First come first served, a busy user or database doesn't block the others
+            for turn in list(self.queue):
+                if not self._can_start(turn):
+                    continue
+                self.queue.remove(turn)
+                self.running += 1
+                self.running_by_user[turn.user_id] += 1
+                self.running_by_database[turn.database_id] += 1
+                started.append(turn)
+        for turn in started:
+            self.start(self._run, turn)
+
+    def _run(self, turn):
+        try:
+            turn.func(*turn.args)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.running_by_user[turn.user_id] -= 1
+                self.running_by_database[turn.database_id] -= 1
+                if not self.running_by_user[turn.user_id]:
+                    del self.running_by_user[turn.user_id]
+                if not self.running_by_database[turn.database_id]:
+                    del self.running_by_database[turn.database_id]
+            self._dispatch()
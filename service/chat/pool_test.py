@@ -0,0 +1,61 @@
+import pytest
+from chat.pool import TurnPool, TurnRejected
+
+
+class ManualStart:
+    """Record the started workers, run them on demand"""
+
+    def __init__(self):
+        self.started = []
+
+    def __call__(self, func, *args):
+        self.started.append((func, args))
+
+    def run_next(self):
+        func, args = self.started.pop(0)
+        func(*args)
+
+
+def test_pool_limits_concurrency():
+    start = ManualStart()
+    pool = TurnPool(max_workers=2, max_per_user=1, max_per_database=2, start=start)
+    done = []
+    pool.submit("ada", 1, done.append, "ada-1")
+    pool.submit("ada", 1, done.append, "ada-2")
+    pool.submit("bob", 1, done.append, "bob-1")
+    pool.submit("eve", 1, done.append, "eve-1")
+    # One turn per user, two per database
+    assert len(start.started) == 2
+    assert pool.stats() == {"running": 2, "queued": 2, "runningByDatabase": {1: 2}}
+
+    start.run_next()
+    assert done == ["ada-1"]
+    # ada-2 is started in place of ada-1
+    assert len(start.started) == 2
+    while start.started:
+        start.run_next()
+    assert sorted(done) == ["ada-1", "ada-2", "bob-1", "eve-1"]
+    assert pool.stats() == {"running": 0, "queued": 0, "runningByDatabase": {}}
+
+
+def test_pool_rejects_when_queue_is_full():
+    start = ManualStart()
+    pool = TurnPool(max_workers=1, max_queue_per_user=1, start=start)
+    pool.submit("ada", 1, print)
+    pool.submit("ada", 1, print)
+    with pytest.raises(TurnRejected):
+        pool.submit("ada", 1, print)
+    pool.submit("bob", 1, print)
+
+
+def test_pool_releases_failed_turns():
+    start = ManualStart()
+    pool = TurnPool(max_workers=1, start=start)
+
+    def fail():
+        raise ValueError()
+
+    pool.submit("ada", 1, fail)
+    with pytest.raises(ValueError):
+        start.run_next()
+    assert pool.stats()["running"] == 0
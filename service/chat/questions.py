@@ -0,0 +1,159 @@
+"""
+Starter questions suggested when a database or project is opened.
+They are generated in background (the generate_questions job) and stored per
+context: the endpoint only reads them. Questions generated from an older
+version of the context (or too old) are still returned, and refreshed.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from back.jobs import enqueue
+from back.models import ContextQuestions, Database, Project
+from sqlalchemy.orm import load_only
+from chat.schema_context import load_schema_context, metadata_version
+
+AUTOCHAT_PROVIDER = os.getenv("AUTOCHAT_PROVIDER", "openai")
+QUESTIONS_TTL = int(os.getenv("QUESTIONS_TTL", 7 * 24 * 3600))  # seconds
+# What context_version reads, without the tables metadata
+VERSION_COLUMNS = (
+    Database.id,
+    Database.name,
+    Database.description,
+    Database.metadataRefreshedAt,
+    Database.updatedAt,
+)
+
+
+def load_context(session, context_id, columns=None):
+    """
+    Database and project (or None) of a context
+    context is "project-{projectId}" or "database-{databaseId}"
+    columns: only load these columns of the database
+    """
+    kind, _, id = context_id.partition("-")
+    if not id.isdigit():
+        return None, None
+    databases = session.query(Database)
+    if columns:
+        databases = databases.options(load_only(*columns))
+    if kind == "project":
+        project = session.query(Project).filter_by(id=int(id)).first()
+        if project is None:
+            return None, None
+        database = databases.filter_by(id=project.databaseId).first()
+        return database, project
+    if kind == "database":
+        # Note: will be removed once we have context / project
+        return databases.filter_by(id=int(id)).first(), None
+    return None, None
+
+
+def context_version(database, project=None):
+    """Changes with what the questions are generated from"""
+    version = [metadata_version(database), database.name, database.description]
+    if project is not None:
+        version += [
+            project.name,
+            project.description,
+            sorted([table.schemaName, table.tableName] for table in project.tables),
+        ]
+    return hashlib.md5(json.dumps(version, default=str).encode()).hexdigest()
+
+
+def context_prompt(database, project=None):
+    # Compact summary of the tables (of the project), within a token budget
+    schema = load_schema_context(database, project)
+    tables = "\n".join(schema.compile()) if schema else ""
+    if project is not None:
+        return (
+            "# Project Name: "
+            + project.name
+            + "\n# Database Name: "
+            + database.name
+            + "\n# Database Description: "
+            + (database.description or "")
+            + "\n# Tables:\n"
+            + tables
+        )
+    return (
+        "# Name: "
+        + database.name
+        + "\n# Description: "
+        + (database.description or "")
+        + "\n# Tables:\n"
+        + tables
+    )
+
+
+def ask_questions(database, project=None):
+    """Ask the LLM for 3 questions about the context"""
+    from autochat import Autochat
+
+    questionAssistant = Autochat(
+        provider=AUTOCHAT_PROVIDER,
+        context=json.dumps(context_prompt(database, project)),
+    )
+    # TODO: if exist ; add database.memory, dbt.catalog, dbt.manifest
+
+    def questions(question1: str, question2: str, question3: str):
+        pass
+
+    questionAssistant.add_function(questions)
+
+    message = questionAssistant.ask(
+        "Generate 3 business questions about different topics that the user can ask based on the context (database schema, past conversations, etc)",
+        tool_choice={"type": "tool", "name": "questions"},  # anthropic specific
+    )
+    return list(message.function_call["arguments"].values())
+
+
+def is_stale(entry, version):
+    return (
+        entry.version != version
+        or entry.generatedAt < datetime.utcnow() - timedelta(seconds=QUESTIONS_TTL)
+    )
+
+
+def refresh_questions(session, context_id, database_id):
+    """Queue the generation of the questions of a context"""
+    return enqueue(
+        session, "generate_questions", database_id, {"context_id": context_id}
+    )
+
+
+def cached_questions(session, context_id, database, project=None):
+    """
+    Stored questions of the context, without waiting for the LLM
+    Return: questions ([] until the first ones are generated), stale
+    """
+    entry = session.get(ContextQuestions, context_id)
+    if entry is None:
+        refresh_questions(session, context_id, database.id)
+        return [], True
+    if is_stale(entry, context_version(database, project)):
+        # Stale while revalidate
+        refresh_questions(session, context_id, database.id)
+        return entry.questions, True
+    return entry.questions, False
+
+
+def generate_questions(session, job, progress):
+    """Job: generate and store the questions of a context"""
+    context_id = job.payload["context_id"]
+    database, project = load_context(session, context_id)
+    if database is None:
+        raise ValueError(f"Context {context_id} not found")
+    version = context_version(database, project)
+    entry = session.get(ContextQuestions, context_id)
+    if entry is not None and not is_stale(entry, version):
+        # Already refreshed, eg. by a job queued before
+        return
+    questions = ask_questions(database, project)
+    if entry is None:
+        entry = ContextQuestions(contextId=context_id, databaseId=database.id)
+        session.add(entry)
+    entry.version = version
+    entry.questions = questions
+    entry.generatedAt = datetime.utcnow()
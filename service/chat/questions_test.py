@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+from chat import questions
+from chat.questions import context_version, generate_questions, cached_questions
+
+DATABASE = SimpleNamespace(
+    id=1,
+    name="bike",
+    description="Bike sharing",
+    tables_metadata=[],
+    metadataRefreshedAt=datetime(2026, 1, 1),
+    updatedAt=None,
+)
+
+
+@pytest.fixture
+def enqueue(monkeypatch):
+    enqueue = Mock()
+    monkeypatch.setattr(questions, "enqueue", enqueue)
+    return enqueue
+
+
+def entry(version, age=0):
+    return SimpleNamespace(
+        version=version,
+        questions=["How many trips?"],
+        generatedAt=datetime.utcnow() - timedelta(seconds=age),
+    )
+
+
+def test_get_questions_fresh(enqueue):
+    session = Mock()
+    session.get.return_value = entry(context_version(DATABASE))
+    assert cached_questions(session, "database-1", DATABASE) == (
+        ["How many trips?"],
+        False,
+    )
+    enqueue.assert_not_called()
+
+
+def test_get_questions_missing(enqueue):
+    session = Mock()
+    session.get.return_value = None
+    assert cached_questions(session, "database-1", DATABASE) == ([], True)
+    enqueue.assert_called_once_with(
+        session, "generate_questions", 1, {"context_id": "database-1"}
+    )
+
+
+@pytest.mark.parametrize(
+    "version, age", [("outdated", 0), (None, questions.QUESTIONS_TTL + 1)]
+)
+def test_get_questions_stale_while_revalidate(enqueue, version, age):
+    session = Mock()
+    session.get.return_value = entry(version or context_version(DATABASE), age)
+    # The previous questions are returned while new ones are generated
+    assert cached_questions(session, "database-1", DATABASE) == (
+        ["How many trips?"],
+        True,
+    )
+    enqueue.assert_called_once()
+
+
+def test_context_version_of_project():
+    project = SimpleNamespace(
+        name="Trips",
+        description="",
+        tables=[SimpleNamespace(schemaName="public", tableName="trip")],
+    )
+    version = context_version(DATABASE, project)
+    assert version != context_version(DATABASE)
+    project.tables.append(SimpleNamespace(schemaName="public", tableName="station"))
+    assert context_version(DATABASE, project) != version
+
+
+def test_context_version_columns():
+    # The endpoint only loads these columns of the database
+    loaded = SimpleNamespace(
+        **{
+            column.key: getattr(DATABASE, column.key)
+            for column in questions.VERSION_COLUMNS
+        }
+    )
+    assert context_version(loaded) == context_version(DATABASE)
+
+
+def test_generate_questions(monkeypatch):
+    monkeypatch.setattr(questions, "load_context", lambda *args: (DATABASE, None))
+    ask_questions = Mock(return_value=["Q1", "Q2", "Q3"])
+    monkeypatch.setattr(questions, "ask_questions", ask_questions)
+    session = Mock()
+    session.get.return_value = None
+    job = SimpleNamespace(payload={"context_id": "database-1"})
+
+    generate_questions(session, job, lambda *p: None)
+    stored = session.add.call_args[0][0]
+    assert stored.contextId == "database-1"
+    assert stored.questions == ["Q1", "Q2", "Q3"]
+    assert stored.version == context_version(DATABASE)
+
+    # Up to date, eg. generated by a previous job
+    session.get.return_value = stored
+    generate_questions(session, job, lambda *p: None)
+    ask_questions.assert_called_once()
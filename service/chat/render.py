@@ -1,28 +1,104 @@
+"""
+Render FusionCharts configurations to PNG with a headless Chromium.
+The browser is launched once, in a dedicated thread running its own event
+loop, and keeps a pool of pages where the FusionCharts scripts are already
+loaded. A chart is screenshot as soon as its renderComplete event fires.
+FusionCharts scripts are served from a local copy (see download_assets),
+the CDN is only used for the files missing from it.
+"""
 import asyncio
+import atexit
+import concurrent.futures
 import json
 import os
+import threading
+from functools import lru_cache
+
 import numpy as np
+import requests
 from playwright.async_api import async_playwright
 
-# Generate HTML for FusionCharts
+RENDER_POOL_SIZE = int(os.getenv("RENDER_POOL_SIZE", 2))  # Concurrent renders
+RENDER_PAGE_MAX_USES = int(os.getenv("RENDER_PAGE_MAX_USES", 50))  # Then recycled
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", 20))  # seconds
+
+FUSIONCHARTS_CDN = "https://cdn.fusioncharts.com/fusioncharts/latest/"
+FUSIONCHARTS_DIR = os.getenv(
+    "FUSIONCHARTS_DIR",
+    os.path.join(os.path.dirname(__file__), "assets", "fusioncharts"),
+)
+# Loaded by the pages
+FUSIONCHARTS_SCRIPTS = ["fusioncharts.js", "themes/fusioncharts.theme.fusion.js"]
+# Loaded on demand by fusioncharts.js, depending on the chart type
+FUSIONCHARTS_ASSETS = FUSIONCHARTS_SCRIPTS + [
+    "fusioncharts.charts.js",
+    "fusioncharts.powercharts.js",
+    "fusioncharts.widgets.js",
+    "fusioncharts.zoomline.js",
+]
+
+# Loaded once per page, charts are then rendered in the container
 html_template = """
 <html>
 <head>
-    <script type="text/javascript" src="https://cdn.fusioncharts.com/fusioncharts/latest/fusioncharts.js"></script>
-    <script type="text/javascript" src="https://cdn.fusioncharts.com/fusioncharts/latest/themes/fusioncharts.theme.fusion.js"></script>
+    {scripts}
+    <style>body {{ margin: 0; }}</style>
 </head>
 <body>
     <div id="chart-container"></div>
-    <script type="text/javascript">
-        FusionCharts.ready(function() {{
-            var chartObj = new FusionCharts(CHART_CONFIG);
-            chartObj.render();
-        }});
-    </script>
 </body>
 </html>
 """
 
+# Replace the chart of the page, resolve when it is drawn
+RENDER_SCRIPT = """
+(config) => new Promise((resolve, reject) => {
+    const previous = FusionCharts.items["ada-chart"];
+    if (previous) {
+        previous.dispose();
+    }
+    config.id = "ada-chart";
+    config.renderAt = "chart-container";
+    config.dataSource = config.dataSource || {};
+    // No animation, so the screenshot shows the final chart
+    config.dataSource.chart = {...config.dataSource.chart, animation: "0"};
+    config.events = {
+        renderComplete: () => resolve(true),
+        renderCancelled: () => reject(new Error("Chart rendering cancelled")),
+        dataLoadError: () => reject(new Error("Invalid chart data")),
+    };
+    FusionCharts.ready(() => new FusionCharts(config).render());
+})
+"""
+
+
+class RenderError(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def load_asset(path):
+    """Content of a local FusionCharts file, None if it was not downloaded"""
+    filename = os.path.normpath(os.path.join(FUSIONCHARTS_DIR, path))
+    if not filename.startswith(os.path.normpath(FUSIONCHARTS_DIR) + os.sep):
+        return None
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def download_assets(directory=FUSIONCHARTS_DIR):
+    """Copy the FusionCharts files from the CDN, to render charts offline"""
+    for path in FUSIONCHARTS_ASSETS:
+        response = requests.get(FUSIONCHARTS_CDN + path, timeout=30)
+        response.raise_for_status()
+        filename = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            f.write(response.content)
+    load_asset.cache_clear()
+
 
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -37,38 +113,171 @@ class NumpyEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
-async def render_chart_async(chart_config):
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        page = await browser.new_page()
+class ChartRenderer:
+    """Long-lived browser with a pool of pages ready to render charts"""
+
+    def __init__(self, pool_size=RENDER_POOL_SIZE, max_uses=RENDER_PAGE_MAX_USES):
+        self.pool_size = pool_size
+        self.max_uses = max_uses
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._pages = None  # asyncio.Queue of (page, uses), page is None if recycled
+        self._launch_lock = None
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, name="chart-renderer", daemon=True
+            )
+            self._thread.start()
+            try:
+                asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+            except Exception:
+                # eg. browser not installed, try again on the next render
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=10)
+                self._loop = None
+                self._thread = None
+                raise
 
+    def render(self, chart_config, timeout=RENDER_TIMEOUT):
+        """Return the PNG screenshot of the chart, blocks the calling thread"""
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(
+            self._render(chart_config, timeout), self._loop
+        )
         try:
-            chart_config_json = json.dumps(chart_config, cls=NumpyEncoder)
-            html = html_template.replace("CHART_CONFIG", chart_config_json)
-            await page.set_content(html)
-            await page.wait_for_timeout(5000)  # Wait for chart to render
-
-            # Capture screenshot
-            chart_image = await page.screenshot()
-            print("Chart rendered and screenshot captured successfully")
+            # Waits for a page, then for the chart, each up to timeout
+            return future.result(timeout=2 * timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise RenderError(f"Chart not rendered after {timeout} seconds")
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._close(), self._loop).result(
+                    timeout=10
+                )
+            finally:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=10)
+                self._loop = None
+                self._thread = None
+
+    async def _start(self):
+        self._playwright = await async_playwright().start()
+        self._launch_lock = asyncio.Lock()
+        await self._launch()
+
+    async def _launch(self):
+        previous = self._browser
+        self._browser = await self._playwright.chromium.launch(headless=True)
+        self._context = await self._browser.new_context()
+        await self._context.route(FUSIONCHARTS_CDN + "**", self._serve_asset)
+        # The pages of the previous browser are dropped, see _render
+        self._pages = asyncio.Queue()
+        for _ in range(self.pool_size):
+            self._pages.put_nowait((await self._new_page(), 0))
+        if previous is not None:
+            try:
+                await previous.close()
+            except Exception:
+                pass
+
+    async def _serve_asset(self, route):
+        content = load_asset(route.request.url[len(FUSIONCHARTS_CDN) :].split("?")[0])
+        if content is None:
+            await route.continue_()
+        else:
+            await route.fulfill(body=content, content_type="application/javascript")
+
+    async def _new_page(self):
+        page = await self._context.new_page()
+        scripts = "\n".join(
+            f'<script type="text/javascript" src="{FUSIONCHARTS_CDN + path}"></script>'
+            for path in FUSIONCHARTS_SCRIPTS
+        )
+        await page.set_content(html_template.format(scripts=scripts))
+        await page.wait_for_function("window.FusionCharts !== undefined")
+        return page
+
+    async def _render(self, chart_config, timeout):
+        async with self._launch_lock:
+            if not self._browser.is_connected():
+                # The browser crashed, start again with a new pool
+                await self._launch()
+
+        # The pool size bounds the number of concurrent renders
+        browser, pages = self._browser, self._pages
+        try:
+            # The pages of a crashed browser are not put back in its pool
+            page, uses = await asyncio.wait_for(pages.get(), timeout)
+        except asyncio.TimeoutError:
+            raise RenderError(f"No page available after {timeout} seconds")
+        healthy = False
+        try:
+            if page is None:
+                page = await self._new_page()
+            config = json.loads(json.dumps(chart_config, cls=NumpyEncoder))
+            try:
+                await asyncio.wait_for(page.evaluate(RENDER_SCRIPT, config), timeout)
+            except asyncio.TimeoutError:
+                raise RenderError(f"Chart not rendered after {timeout} seconds")
+            chart_image = await page.locator("#chart-container").screenshot()
+            healthy = True
+            return chart_image
         finally:
-            await browser.close()
+            uses += 1
+            if self._browser is not browser:
+                # Launched again during the render, the page is of the old browser
+                if page is not None:
+                    await self._close_page(page)
+            elif healthy and uses < self.max_uses:
+                self._pages.put_nowait((page, uses))
+            else:
+                # Recycle the page (memory of old charts, broken state, ...),
+                # a new one is created by the next render
+                self._pages.put_nowait((None, 0))
+                if page is not None:
+                    await self._close_page(page)
 
-    # if "dev" environment, save the image to a file
-    if os.getenv("ENV") == "dev":
-        with open("/tmp/chart.png", "wb") as f:
-            f.write(chart_image)
+    async def _close_page(self, page):
+        try:
+            await page.close()
+        except Exception:
+            pass
+
+    async def _close(self):
+        if self._browser is not None:
+            await self._browser.close()
+        if self._playwright is not None:
+            await self._playwright.stop()
+        self._browser = None
+        self._context = None
+        self._playwright = None
 
-    return chart_image
+
+renderer = ChartRenderer()
+atexit.register(renderer.close)
 
 
 def render_chart(chart_config):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(render_chart_async(chart_config))
-    finally:
-        loop.close()
+    chart_image = renderer.render(chart_config)
+    print("Chart rendered and screenshot captured successfully")
 
+    # if "dev" environment, save the image to a file
+    if os.getenv("ENV") == "dev":
+        with open("/tmp/chart.png", "wb") as f:
+            f.write(chart_image)
 
-# No cleanup function needed in this simplified version
+    return chart_image
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from chat.render import ChartRenderer, RenderError
+
+
+class FakePage:
+    def __init__(self, rendered):
+        self.rendered = rendered
+        self.closed = False
+
+    async def set_content(self, html):
+        pass
+
+    async def wait_for_function(self, expression):
+        pass
+
+    async def evaluate(self, script, config):
+        await self.rendered.wait()
+
+    def locator(self, selector):
+        return self
+
+    async def screenshot(self):
+        return b"png"
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBrowser:
+    def __init__(self, rendered):
+        self.rendered = rendered
+        self.connected = True
+        self.closed = False
+        self.pages = []
+
+    def is_connected(self):
+        return self.connected
+
+    async def new_context(self):
+        return self
+
+    async def route(self, url, handler):
+        pass
+
+    async def new_page(self):
+        page = FakePage(self.rendered)
+        self.pages.append(page)
+        return page
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeRenderer(ChartRenderer):
+    async def _start(self):
+        self.rendered = asyncio.Event()
+        self.browsers = []
+
+        async def launch(headless):
+            self.browsers.append(FakeBrowser(self.rendered))
+            return self.browsers[-1]
+
+        async def stop():
+            pass
+
+        self._playwright = SimpleNamespace(
+            chromium=SimpleNamespace(launch=launch), stop=stop
+        )
+        self._launch_lock = asyncio.Lock()
+        await self._launch()
+
+
+def test_relaunch_while_a_render_is_waiting():
+    renderer = FakeRenderer(pool_size=1)
+    renderer.start()
+    results = {}
+
+    def render(name, timeout):
+        try:
+            results[name] = renderer.render({}, timeout=timeout)
+        except RenderError as e:
+            results[name] = e
+
+    threads = []
+    for name, timeout in [("running", 5), ("waiting", 0.5), ("relaunched", 5)]:
+        if name == "relaunched":
+            # The browser crashes during the first render
+            renderer.browsers[0].connected = False
+        threads.append(threading.Thread(target=render, args=(name, timeout)))
+        threads[-1].start()
+        time.sleep(0.1)
+    renderer._loop.call_soon_threadsafe(renderer.rendered.set)
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert results["running"] == results["relaunched"] == b"png"
+    # Its pool was replaced, the render doesn't wait forever
+    assert isinstance(results["waiting"], RenderError)
+    old_browser, new_browser = renderer.browsers
+    assert old_browser.closed and old_browser.pages[0].closed
+    assert renderer._pages.qsize() == 1 and not new_browser.pages[0].closed
+    renderer.close()
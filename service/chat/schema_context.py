@@ -0,0 +1,132 @@
+"""
+Compact summary of the tables of a database (or project) added to the chat
+context, so the model doesn't have to explore information_schema first.
+The lines of the tables are compiled once per metadata version, then the
+tables most relevant to the question are kept within a token budget.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from chat.dbt_utils import FIELD_WEIGHTS, SearchIndex, tokenize
+
+SCHEMA_CONTEXT_TOKENS = int(os.getenv("SCHEMA_CONTEXT_TOKENS", 2000))
+SCHEMA_CONTEXT_CACHE_SIZE = int(os.getenv("SCHEMA_CONTEXT_CACHE_SIZE", 64))
+CHARACTERS_PER_TOKEN = 4  # Estimation, good enough for a budget
+DESCRIPTION_LENGTH = 100  # characters
+
+
+def estimate_tokens(text):
+    return len(text) // CHARACTERS_PER_TOKEN + 1
+
+
+def shorten(text, length=DESCRIPTION_LENGTH):
+    text = " ".join((text or "").split())
+    return text if len(text) <= length else text[: length - 3] + "..."
+
+
+class SchemaContext:
+    def __init__(self, tables):
+        self.tables = sorted(tables, key=lambda t: (t["schema"], t["name"]))
+        self.lines = [self._line(table) for table in self.tables]
+        # Without the columns, when the full line doesn't fit
+        self.short_lines = [
+            f"{table['schema']}.{table['name']} ({len(table['columns'])} columns)"
+            for table in self.tables
+        ]
+        self.index = SearchIndex(self._document(table) for table in self.tables)
+
+    @staticmethod
+    def _line(table):
+        """eg. public.station(id integer, name text) -- Bike stations"""
+        columns = ", ".join(
+            f"{column['name']} {column.get('type') or ''}".strip()
+            for column in table["columns"]
+        )
+        line = f"{table['schema']}.{table['name']}({columns})"
+        if table.get("is_view"):
+            line += " view"
+        if table.get("description"):
+            line += f" -- {shorten(table['description'])}"
+        return line
+
+    @staticmethod
+    def _document(table):
+        fields = {
+            "name": tokenize(table["schema"]) + tokenize(table["name"]),
+            "columns": [
+                token
+                for column in table["columns"]
+                for token in tokenize(column["name"])
+                + tokenize(column.get("description"))
+            ],
+            "description": tokenize(table.get("description")),
+        }
+        return [
+            token
+            for field, tokens in fields.items()
+            for token in tokens
+            for _ in range(FIELD_WEIGHTS[field])
+        ]
+
+    def rank(self, question=None):
+        """Tables matching the question first, then the others by name"""
+        matches = [document for _, document in self.index.search(question or "")]
+        matched = set(matches)
+        return matches + [i for i in range(len(self.tables)) if i not in matched]
+
+    def compile(self, question=None, budget=SCHEMA_CONTEXT_TOKENS):
+        """Lines of the most relevant tables, within budget tokens"""
+        lines = []
+        for position, table in enumerate(self.rank(question)):
+            for line in (self.lines[table], self.short_lines[table]):
+                tokens = estimate_tokens(line)
+                if tokens <= budget:
+                    lines.append(line)
+                    budget -= tokens
+                    break
+            else:
+                lines.append(f"... {len(self.tables) - position} more tables")
+                break
+        return lines
+
+
+schema_context_cache = OrderedDict()  # (database, project) -> (version, context)
+schema_context_cache_lock = threading.Lock()
+
+
+def metadata_version(database):
+    # The tables are reloaded by back.metadata, which sets metadataRefreshedAt
+    return str(database.metadataRefreshedAt or database.updatedAt)
+
+
+def project_filter(project):
+    if project is None:
+        return None
+    return frozenset((table.schemaName, table.tableName) for table in project.tables)
+
+
+def load_schema_context(database, project=None):
+    """SchemaContext of a database (or of the tables of a project), cached"""
+    if not database.tables_metadata:
+        return None
+    key = (database.id, project.id if project is not None else None)
+    tables = project_filter(project)
+    version = (metadata_version(database), tables)
+    with schema_context_cache_lock:
+        entry = schema_context_cache.get(key)
+        if entry is not None and entry[0] == version:
+            schema_context_cache.move_to_end(key)
+            return entry[1]
+
+    context = SchemaContext(
+        table
+        for table in database.tables_metadata
+        if tables is None or (table["schema"], table["name"]) in tables
+    )
+    with schema_context_cache_lock:
+        schema_context_cache[key] = (version, context)
+        schema_context_cache.move_to_end(key)
+        while len(schema_context_cache) > SCHEMA_CONTEXT_CACHE_SIZE:
+            schema_context_cache.popitem(last=False)
+    return context
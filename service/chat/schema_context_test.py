@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+from chat.schema_context import SchemaContext, load_schema_context, schema_context_cache
+
+
+def table(schema, name, columns, description=None):
+    return {
+        "schema": schema,
+        "name": name,
+        "description": description,
+        "is_view": False,
+        "version": None,
+        "columns": [
+            {"name": column, "type": "text", "nullable": True, "description": None}
+            for column in columns
+        ],
+    }
+
+
+TABLES = [
+    table("public", "station", ["id", "name", "city"], "Bike stations"),
+    table("public", "status", ["station_id", "bikes_available", "time"]),
+    table("public", "trip", ["id", "duration", "start_station_id", "bike_id"]),
+]
+
+
+def test_compile_ranks_tables_by_question():
+    schema = SchemaContext(TABLES)
+    lines = schema.compile("trips duration")
+    assert lines[0] == (
+        "public.trip(id text, duration text, start_station_id text, bike_id text)"
+    )
+    assert lines[1:] == [
+        "public.station(id text, name text, city text) -- Bike stations",
+        "public.status(station_id text, bikes_available text, time text)",
+    ]
+
+
+def test_compile_budget():
+    schema = SchemaContext(TABLES)
+    lines = schema.compile("stations", budget=25)
+    assert lines[0].startswith("public.station(")
+    # Without the columns, then truncated
+    assert lines[1:] == ["public.status (3 columns)", "... 1 more tables"]
+
+
+def test_load_schema_context_is_cached_per_version():
+    schema_context_cache.clear()
+    database = SimpleNamespace(
+        id=1, tables_metadata=TABLES, metadataRefreshedAt=1, updatedAt=None
+    )
+    project = SimpleNamespace(
+        id=2, tables=[SimpleNamespace(schemaName="public", tableName="trip")]
+    )
+    schema = load_schema_context(database)
+    assert load_schema_context(database) is schema
+    assert len(load_schema_context(database, project).tables) == 1
+
+    database.metadataRefreshedAt = 2
+    assert load_schema_context(database) is not schema
@@ -1,7 +1,10 @@
 import json
+import time
+from datetime import datetime, timezone
 
 from autochat.chat import OUTPUT_SIZE_LIMIT
 from autochat.utils import limit_data_size
+from back.sql_parser import referenced_tables
 
 RESULT_TEMPLATE = """Results {len_sample}/{len_total} rows:
 ```json
@@ -9,7 +12,10 @@ RESULT_TEMPLATE = """Results {len_sample}/{len_total} rows:
 ```
 """
 
+PRIVACY_TEMPLATE = "Columns hidden by the privacy mode: {columns}\n"
+
 JSON_OUTPUT_SIZE_LIMIT = OUTPUT_SIZE_LIMIT / 2  # Json is 2x larger than csv
+RESULT_SAMPLE_SIZE = 100  # Rows saved in Query.result
 
 ERROR_TEMPLATE = """An error occurred while executing the SQL query:
 ```error
@@ -17,18 +23,90 @@ ERROR_TEMPLATE = """An error occurred while executing the SQL query:
 ```Please correct the query and try again.
 """
 
+LIMIT_TEMPLATE = """The query exceeded the {code} limit of the database ({limit}).
+Don't run it again as is: add filters, aggregate the data or use a LIMIT.
+"""
+
+
+def row_char_count(row):
+    return sum(len(str(value)) + len(str(key)) + 1 for key, value in row.items())
+
 
-def run_sql(connection, sql):
+def query_error(error):
+    """
+    Structured description of a query error, eg.
+    {"error": "...", "code": "statement_timeout", "limit": 30}
+    """
+    return {
+        "error": str(error),
+        "code": getattr(error, "code", "error"),
+        "limit": getattr(error, "limit", None),
+    }
+
+
+def record_result(query, stream, rows, count, duration):
+    """
+    Save a sample of the result and the execution stats on a Query,
+    so it can be re-opened without running it again
+    """
+    query.result = {
+        "columns": stream.columns,
+        "rows": json.loads(json.dumps(rows[:RESULT_SAMPLE_SIZE], default=str)),
+        "count": count,
+        "size": stream.size,
+        "duration": round(duration, 3),
+        "cached": stream.cached,
+        "maskedColumns": stream.masked_columns,
+        "executedAt": datetime.now(timezone.utc).isoformat(),
+    }
+    query.tables = ",".join(referenced_tables(stream.sql, stream.datalake.dialect))
+
+
+def run_sql(connection, sql, query=None, on_stop=None):
+    """
+    Run the SQL and format its result for the chatbot
+    If a Query is given, the result is also recorded on it
+    on_stop(callback) registers the cancellation of the query, see
+    AbstractDatabase.query
+    """
+    start = time.monotonic()
+    remove = None
     try:
         # Assuming you have a Database instance named 'database'
         # TODO: switch to logger
         # print("Executing SQL query: {}".format(sql))
-        rows, count = connection.query(sql)
+        stream = connection.stream(sql)
+        remove = on_stop(stream.cancel) if on_stop else None
+        # Only keep the rows that can fit in the output, the others are counted
+        sample_size = RESULT_SAMPLE_SIZE if query is not None else 0
+        rows, char_count = [], 0
+        for batch in stream:
+            for row in batch.rows():
+                if char_count > JSON_OUTPUT_SIZE_LIMIT and len(rows) >= sample_size:
+                    break
+                rows.append(row)
+                char_count += row_char_count(row)
+        if remove:
+            remove()
+        count = connection.result_count(stream)
     except Exception as e:
+        if remove:
+            remove()
+        error = query_error(e)
+        if query is not None:
+            query.result = {
+                **error,
+                "duration": round(time.monotonic() - start, 3),
+            }
         # If there's an error executing the query, inform the user
         execution_response = ERROR_TEMPLATE.format(error=str(e))
+        if error["limit"] is not None:
+            execution_response += LIMIT_TEMPLATE.format(**error)
         return execution_response, False
     else:
+        if query is not None:
+            record_result(query, stream, rows, count, time.monotonic() - start)
+
         # Take every row until the total size is less than JSON_OUTPUT_SIZE_LIMIT
         results_limited = limit_data_size(rows, character_limit=JSON_OUTPUT_SIZE_LIMIT)
         results_dumps = json.dumps(results_limited, default=str)
@@ -37,6 +115,11 @@ def run_sql(connection, sql):
         execution_response = RESULT_TEMPLATE.format(
             sample=results_dumps,
             len_sample=len(results_limited),
-            len_total=count,
+            # At least the rows read when the total is unknown
+            len_total=count if count is not None else f"{stream.count}+",
         )
+        if stream.masked_columns:
+            execution_response += PRIVACY_TEMPLATE.format(
+                columns=", ".join(stream.masked_columns)
+            )
         return execution_response, True
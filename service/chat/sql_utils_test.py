@@ -0,0 +1,74 @@
+import threading
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+from back.datalake import DatalakeRegistry
+from chat.sql_utils import run_sql
+from chat.turns import MemoryTurnRegistry
+
+
+@pytest.fixture
+def datalake(sqlite_database):
+    database = sqlite_database(
+        2,
+        """
+        CREATE TABLE customer (id INTEGER, city TEXT);
+        INSERT INTO customer VALUES (1, 'Paris');
+        INSERT INTO customer VALUES (2, 'Lyon');
+        """,
+    )
+    return DatalakeRegistry.get(database)
+
+
+def test_run_sql_records_result(datalake):
+    query = SimpleNamespace(result=None, tables=None)
+    output, success = run_sql(datalake, "SELECT * FROM customer", query=query)
+    assert success
+    assert "Results 2/2 rows" in output
+    assert query.result["columns"] == ["id", "city"]
+    assert query.result["rows"] == [
+        {"id": 1, "city": "Paris"},
+        {"id": 2, "city": "Lyon"},
+    ]
+    assert query.result["count"] == 2
+    assert query.result["duration"] >= 0
+    assert query.tables == "customer"
+
+
+def test_run_sql_records_error(datalake):
+    query = SimpleNamespace(result=None, tables=None)
+    _, success = run_sql(datalake, "SELECT * FROM missing", query=query)
+    assert not success
+    assert "missing" in query.result["error"]
+
+
+def test_run_sql_cancelled_on_stop(datalake):
+    turns = MemoryTurnRegistry()
+    turns.start(1)
+    threading.Timer(0.2, turns.stop, [1]).start()
+    query = SimpleNamespace(result=None, tables=None)
+    sql = """
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n)
+    SELECT COUNT(*) AS count FROM (SELECT i FROM n LIMIT 1000000000)
+    """
+    output, success = run_sql(
+        datalake, sql, query=query, on_stop=partial(turns.on_stop, 1)
+    )
+    assert not success
+    assert query.result["error"] == "Query cancelled"
+    assert not turns._watched()
+
+
+def test_run_sql_limit_error(datalake):
+    datalake.statement_timeout = 0.2
+    query = SimpleNamespace(result=None, tables=None)
+    sql = """
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n)
+    SELECT COUNT(*) AS count FROM (SELECT i FROM n LIMIT 1000000000)
+    """
+    output, success = run_sql(datalake, sql, query=query)
+    assert not success
+    assert query.result["code"] == "statement_timeout"
+    assert query.result["limit"] == 0.2
+    assert "statement_timeout limit" in output
@@ -0,0 +1,334 @@
+"""
+Registry of the running chat turns, shared by the processes of the service.
+A turn is started once per conversation (duplicate asks are refused), can be
+stopped from any process, and runs the callbacks registered with on_stop in
+the process running it, eg. to cancel the query sent to the warehouse.
+Backends:
+- memory: a single process
+- sqlite: the processes of a host, stops are polled
+- postgres: every process using DATABASE_URL, stops are sent with NOTIFY
+"""
+import os
+import select
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+
+from sqlalchemy import text
+
+TURN_REGISTRY = os.getenv("TURN_REGISTRY", "memory")  # memory, sqlite, postgres
+TURN_REGISTRY_PATH = os.getenv("TURN_REGISTRY_PATH", "/tmp/ada/turns.sqlite")
+# A turn running for longer is considered dead (crashed process), and replaced
+TURN_TTL = int(os.getenv("TURN_TTL", 3600))  # seconds
+TURN_POLL_INTERVAL = 0.5  # seconds
+TURN_CHANNEL = "ada_turn_stop"
+
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class TurnRegistry(ABC):
+    def __init__(self):
+        self._callbacks = defaultdict(list)
+        self._callbacks_lock = threading.Lock()
+
+    @abstractmethod
+    def start(self, turn_id):
+        """Register a running turn, False if the turn is already running"""
+        pass
+
+    @abstractmethod
+    def stop(self, turn_id):
+        """Ask the turn to stop, False if it is not running"""
+        pass
+
+    @abstractmethod
+    def is_stopped(self, turn_id):
+        pass
+
+    @abstractmethod
+    def is_running(self, turn_id):
+        pass
+
+    @abstractmethod
+    def finish(self, turn_id):
+        pass
+
+    def on_stop(self, turn_id, callback):
+        """
+        Call callback() when the turn is stopped, from any process
+        Return a function removing the callback
+        """
+        turn_id = str(turn_id)
+        with self._callbacks_lock:
+            self._callbacks[turn_id].append(callback)
+
+        def remove():
+            with self._callbacks_lock:
+                if callback in self._callbacks.get(turn_id, []):
+                    self._callbacks[turn_id].remove(callback)
+                if not self._callbacks.get(turn_id):
+                    self._callbacks.pop(turn_id, None)
+
+        return remove
+
+    def _watched(self):
+        with self._callbacks_lock:
+            return list(self._callbacks)
+
+    def _notify(self, turn_id):
+        with self._callbacks_lock:
+            callbacks = self._callbacks.pop(str(turn_id), [])
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Stop callback of turn {turn_id} failed: {e}")
+
+
+class MemoryTurnRegistry(TurnRegistry):
+    def __init__(self):
+        super().__init__()
+        self.turns = {}  # turn_id -> (started_at, stopped)
+        self.lock = threading.Lock()
+
+    def start(self, turn_id):
+        turn_id = str(turn_id)
+        with self.lock:
+            turn = self.turns.get(turn_id)
+            if turn and turn[0] > time.time() - TURN_TTL:
+                return False
+            self.turns[turn_id] = (time.time(), False)
+            return True
+
+    def stop(self, turn_id):
+        turn_id = str(turn_id)
+        with self.lock:
+            if turn_id not in self.turns:
+                return False
+            self.turns[turn_id] = (self.turns[turn_id][0], True)
+        self._notify(turn_id)
+        return True
+
+    def is_stopped(self, turn_id):
+        turn = self.turns.get(str(turn_id))
+        return bool(turn and turn[1])
+
+    def is_running(self, turn_id):
+        return str(turn_id) in self.turns
+
+    def finish(self, turn_id):
+        with self.lock:
+            self.turns.pop(str(turn_id), None)
+
+
+class SQLiteTurnRegistry(TurnRegistry):
+    def __init__(self, path=TURN_REGISTRY_PATH):
+        super().__init__()
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._execute(
+            """
+            CREATE TABLE IF NOT EXISTS turn (
+                id TEXT PRIMARY KEY,
+                stopped INTEGER NOT NULL DEFAULT 0,
+                started_at REAL NOT NULL,
+                owner TEXT
+            )
+            """
+        )
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def _execute(self, sql, *params):
+        """Return the number of rows changed"""
+        connection = self._connect()
+        try:
+            return connection.execute(sql, params).rowcount
+        finally:
+            connection.close()
+
+    def _fetch(self, sql, *params):
+        connection = self._connect()
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def start(self, turn_id):
+        now = time.time()
+        changed = self._execute(
+            """
+            INSERT INTO turn (id, stopped, started_at, owner) VALUES (?, 0, ?, ?)
+            ON CONFLICT (id) DO UPDATE
+            SET stopped = 0, started_at = excluded.started_at, owner = excluded.owner
+            WHERE turn.started_at < ?
+            """,
+            str(turn_id),
+            now,
+            OWNER,
+            now - TURN_TTL,
+        )
+        return changed > 0
+
+    def stop(self, turn_id):
+        changed = self._execute(
+            "UPDATE turn SET stopped = 1 WHERE id = ?", str(turn_id)
+        )
+        if changed:
+            self._notify(turn_id)
+        return changed > 0
+
+    def is_stopped(self, turn_id):
+        rows = self._fetch("SELECT stopped FROM turn WHERE id = ?", str(turn_id))
+        return bool(rows and rows[0][0])
+
+    def is_running(self, turn_id):
+        return bool(self._fetch("SELECT 1 FROM turn WHERE id = ?", str(turn_id)))
+
+    def finish(self, turn_id):
+        self._execute("DELETE FROM turn WHERE id = ?", str(turn_id))
+
+    def on_stop(self, turn_id, callback):
+        remove = super().on_stop(turn_id, callback)
+        with self._watcher_lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(
+                    target=self._watch, name="turn-watcher", daemon=True
+                )
+                self._watcher.start()
+        return remove
+
+    def _watch(self):
+        # Stops from the other processes are only seen in the database
+        while True:
+            time.sleep(TURN_POLL_INTERVAL)
+            for turn_id in self._watched():
+                try:
+                    if self.is_stopped(turn_id):
+                        self._notify(turn_id)
+                except sqlite3.Error as e:
+                    print(f"Turn registry unavailable: {e}")
+
+
+class PostgresTurnRegistry(TurnRegistry):
+    """Turns are stored in the chat_turn table, stops are sent on TURN_CHANNEL"""
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        self._running = set()  # Turns started by this process
+        self._stopped = set()  # ... and stopped, received by the listener
+
+    def _execute(self, sql, **params):
+        """Return the number of rows changed"""
+        with self.engine.begin() as connection:
+            return connection.execute(text(sql), params).rowcount
+
+    def _first(self, sql, **params):
+        with self.engine.begin() as connection:
+            return connection.execute(text(sql), params).first()
+
+    def start(self, turn_id):
+        self._listen()
+        changed = self._execute(
+            """
+            INSERT INTO chat_turn (id, stopped, "startedAt", owner)
+            VALUES (:id, false, now(), :owner)
+            ON CONFLICT (id) DO UPDATE
+            SET stopped = false, "startedAt" = now(), owner = excluded.owner
+            WHERE chat_turn."startedAt" < now() - make_interval(secs => :ttl)
+            """,
+            id=str(turn_id),
+            owner=OWNER,
+            ttl=TURN_TTL,
+        )
+        if changed:
+            self._running.add(str(turn_id))
+            self._stopped.discard(str(turn_id))
+        return changed > 0
+
+    def stop(self, turn_id):
+        turn_id = str(turn_id)
+        with self.engine.begin() as connection:
+            result = connection.execute(
+                text("UPDATE chat_turn SET stopped = true WHERE id = :id"),
+                {"id": turn_id},
+            )
+            if result.rowcount:
+                # Sent to the listeners when the transaction is committed
+                connection.execute(
+                    text("SELECT pg_notify(:channel, :id)"),
+                    {"channel": TURN_CHANNEL, "id": turn_id},
+                )
+        if result.rowcount:
+            self._receive_stop(turn_id)
+        return result.rowcount > 0
+
+    def is_stopped(self, turn_id):
+        if str(turn_id) in self._stopped:
+            return True
+        row = self._first(
+            "SELECT stopped FROM chat_turn WHERE id = :id", id=str(turn_id)
+        )
+        return bool(row and row[0])
+
+    def is_running(self, turn_id):
+        row = self._first("SELECT 1 FROM chat_turn WHERE id = :id", id=str(turn_id))
+        return row is not None
+
+    def finish(self, turn_id):
+        self._running.discard(str(turn_id))
+        self._stopped.discard(str(turn_id))
+        self._execute("DELETE FROM chat_turn WHERE id = :id", id=str(turn_id))
+
+    def _receive_stop(self, turn_id):
+        if turn_id in self._running:
+            self._stopped.add(turn_id)
+        self._notify(turn_id)
+
+    def _listen(self):
+        with self._listener_lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(
+                    target=self._receive, name="turn-listener", daemon=True
+                )
+                self._listener.start()
+
+    def _receive(self):
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {TURN_CHANNEL}")
+            while True:
+                if select.select([dbapi_connection], [], [], 60) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    self._receive_stop(dbapi_connection.notifies.pop(0).payload)
+        except Exception as e:
+            print(f"Turn listener stopped: {e}")
+        finally:
+            connection.close()
+
+
+def create_registry(backend=TURN_REGISTRY):
+    if backend == "sqlite":
+        return SQLiteTurnRegistry()
+    if backend == "postgres":
+        from back.session import engine
+
+        return PostgresTurnRegistry(engine)
+    return MemoryTurnRegistry()
+
+
+turn_registry = create_registry()
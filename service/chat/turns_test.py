@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+from chat.turns import MemoryTurnRegistry, SQLiteTurnRegistry
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def registry(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteTurnRegistry(str(tmp_path / "turns.sqlite"))
+    return MemoryTurnRegistry()
+
+
+def test_turn_runs_once(registry):
+    assert registry.start(12)
+    assert not registry.start("12")
+    assert registry.is_running(12)
+    registry.finish(12)
+    assert not registry.is_running(12)
+    assert registry.start(12)
+
+
+def test_stop_turn(registry):
+    stopped = []
+    assert not registry.stop(12)
+    registry.start(12)
+    registry.on_stop(12, lambda: stopped.append(12))
+    remove = registry.on_stop(12, lambda: stopped.append("removed"))
+    remove()
+    assert not registry.is_stopped(12)
+    assert registry.stop(12)
+    assert registry.is_stopped(12)
+    assert stopped == [12]
+
+
+def test_stop_from_another_process(tmp_path):
+    path = str(tmp_path / "turns.sqlite")
+    worker, server = SQLiteTurnRegistry(path), SQLiteTurnRegistry(path)
+    worker.start(12)
+    assert not server.start(12)
+
+    stopped = threading.Event()
+    worker.on_stop(12, stopped.set)
+    assert server.stop(12)
+    assert worker.is_stopped(12)
+    assert stopped.wait(timeout=5)
@@ -0,0 +1,43 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+from back.datalake import DatalakeRegistry
+from back.query_cache import query_cache
+
+
+@pytest.fixture
+def sqlite_database(tmp_path):
+    """
+    Create a SQLite database from a script, return a Database-like object
+    to get its datalake from DatalakeRegistry, eg.
+    sqlite_database(1, "CREATE TABLE customer (id INTEGER);", max_rows=2)
+    """
+    database_ids = []
+
+    def create(database_id, script, **fields):
+        filename = str(tmp_path / f"database_{database_id}.sqlite")
+        connection = sqlite3.connect(filename)
+        connection.executescript(script)
+        connection.commit()
+        connection.close()
+        query_cache.invalidate(database_id)
+        database_ids.append(database_id)
+        return SimpleNamespace(
+            **{
+                "id": database_id,
+                "engine": "sqlite",
+                "details": {"filename": filename},
+                "safe_mode": True,
+                "privacy_mode": False,
+                "max_result_size": None,
+                "statement_timeout": None,
+                "max_rows": None,
+                "max_scanned_bytes": None,
+                **fields,
+            }
+        )
+
+    yield create
+    for database_id in database_ids:
+        DatalakeRegistry.invalidate(database_id)
@@ -1,6 +1,6 @@
 from functools import wraps
 
-from back.datalake import DatalakeFactory
+from back.datalake import DatalakeRegistry
 from back.models import Database, User
 from flask import g, jsonify, request
 
@@ -29,13 +29,7 @@ def database_middleware(f):
         database_id = request.json.get("databaseId")
         database = g.session.query(Database).filter_by(id=database_id).first()
         # Add a datalake object to the request
-        datalake = DatalakeFactory.create(
-            database.engine,
-            **database.details,
-        )
-        datalake.privacy_mode = database.privacy_mode
-        datalake.safe_mode = database.safe_mode
-        g.datalake = datalake
+        g.datalake = DatalakeRegistry.get(database)
 
         return f(*args, **kwargs)
 
@@ -37,28 +37,39 @@ export const loadQuery = async (id: number) => {
 
 export const executeQuery = async (
   databaseId: number,
-  sql: string
+  sql: string,
+  queryId: number | null = null,
+  cache: boolean = true
 ): Promise<{ rows: any[]; count: number }> => {
   return await axios
     .post('/api/query/_run', {
       query: sql,
-      databaseId: databaseId
+      databaseId: databaseId,
+      queryId: queryId,
+      cache: cache
     })
     .then((response) => {
+      // The query failed after the first rows were sent
+      if (response.data.error) {
+        throw new Error(response.data.error.error)
+      }
       return {
         rows: response.data.rows as any[],
         count: response.data.count as number
       }
     })
     .catch((e) => {
-      throw new Error(e.response.data.message)
+      throw new Error(e.response ? e.response.data.message : e.message)
     })
 }
 
 export const runQuery = async () => {
   loading.value = true
+  // The result is recorded on the saved query when its SQL is run
+  const savedQueryId = querySQL.value === queryRef.value?.sql ? queryId.value : null
   // @ts-ignore
-  return executeQuery(databaseSelectedId.value, querySQL.value)
+  // Run by the user: fresh results, not the cached ones
+  return executeQuery(databaseSelectedId.value, querySQL.value, savedQueryId, false)
     .then(({ rows, count }) => {
       queryError.value = null
       // @ts-ignore